@@ -0,0 +1,79 @@
+"""
+Write time vs. file size of `nifti_writer.save_nifti` on our volumes, for every compression level / thread count.
+
+    python benchmark_nifti_writer.py --files BDMAP_O/BDMAP_O0000001/ct.nii.gz BDMAP_O/BDMAP_O0000001/ct_care.nii.gz \
+        --levels 0 1 3 6 9 --threads 1 4 8 --out_csv resultsCSV/nifti_writer_benchmark.csv
+
+`.nii` (uncompressed) is always included as the reference. Every written file is read
+back with nibabel and compared to the source volume.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from nifti_writer import save_nifti
+
+
+def benchmark_file(path, levels, threads, work_dir, repeats):
+    nii = nib.load(path)
+    volume = np.asanyarray(nii.dataobj)     # keep the on-disk dtype, e.g. int16
+    img = nib.Nifti1Image(volume, nii.affine, nii.header)
+    settings = [(".nii", None, 1)] + [(".nii.gz", level, num_threads) for level in levels for num_threads in threads]
+    rows = []
+    for ext, level, num_threads in settings:
+        out_path = os.path.join(work_dir, "volume" + ext)
+        write_seconds = []
+        for _ in range(repeats):
+            tic = time.time()
+            save_nifti(img, out_path, compresslevel=1 if level is None else level, threads=num_threads)
+            write_seconds.append(time.time() - tic)
+        tic = time.time()
+        reread = np.asanyarray(nib.load(out_path).dataobj)
+        read_seconds = time.time() - tic
+        assert np.array_equal(reread, volume), f"{out_path} does not match {path}"
+        rows.append({
+            "file": path,
+            "shape": "x".join(map(str, volume.shape)),
+            "ext": ext,
+            "compresslevel": level,
+            "threads": num_threads,
+            "write_seconds": float(np.median(write_seconds)),
+            "read_seconds": read_seconds,
+            "size_mb": os.path.getsize(out_path) / 2 ** 20,
+            "raw_mb": volume.nbytes / 2 ** 20,
+        })
+        print(f"{os.path.basename(path)} {ext} level={level} threads={num_threads}: "
+              f"{rows[-1]['write_seconds']:.2f}s, {rows[-1]['size_mb']:.1f} MB")
+        os.remove(out_path)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NIfTI compression settings")
+    parser.add_argument('--files', type=str, nargs='+', required=True, help="volumes to re-write, e.g. ct.nii.gz")
+    parser.add_argument('--levels', type=int, nargs='+', default=[0, 1, 3, 6, 9])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--repeats', type=int, default=3, help="the median write time is reported")
+    parser.add_argument('--work_dir', type=str, default=None, help="where files are written (default: $TMPDIR)")
+    parser.add_argument('--out_csv', type=str, default="resultsCSV/nifti_writer_benchmark.csv")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="nifti_writer_", dir=args.work_dir)
+    try:
+        rows = []
+        for path in args.files:
+            rows += benchmark_file(path, args.levels, args.threads, work_dir, args.repeats)
+    finally:
+        shutil.rmtree(work_dir)
+
+    df = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(args.out_csv) or ".", exist_ok=True)
+    df.to_csv(args.out_csv, index=False)
+    summary = df.groupby(["ext", "compresslevel", "threads"], dropna=False)[["write_seconds", "read_seconds", "size_mb"]].mean()
+    print(summary.to_string(float_format="%.2f"))
@@ -118,4 +118,23 @@ def get_psnr_3d(arr1, arr2, size_average=True, PIXEL_MAX=1.0):
     if size_average:
         return psnr.mean()
     else:
-        return psnr
\ No newline at end of file
+        return psnr
+
+
+def get_flicker_3d(arr1, arr2):
+    """
+    Slice-to-slice flicker of arr1 w.r.t. arr2: mean |(arr1[z+1] - arr1[z]) - (arr2[z+1] - arr2[z])| over z.
+    :param arr1:
+        Format-[H W D], EnhancedImage [0,1]
+    :param arr2:
+        Format-[H W D], OriImage [0,1]
+    :return:
+        Format-None, 0 when arr1 changes along z exactly as arr2
+    """
+    if torch.is_tensor(arr1):
+        arr1 = arr1.cpu().detach().numpy()
+    if torch.is_tensor(arr2):
+        arr2 = arr2.cpu().detach().numpy()
+    arr1 = arr1.astype(np.float32)
+    arr2 = arr2.astype(np.float32)
+    return np.abs(np.diff(arr1, axis=2) - np.diff(arr2, axis=2)).mean()
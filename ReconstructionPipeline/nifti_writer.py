@@ -0,0 +1,102 @@
+"""
+Shared NIfTI writer of the pipeline (enhanced `ct_care.nii.gz`, re-saved `ct.nii.gz`, nnUNet `pred*.nii.gz`).
+
+nibabel always writes `.nii.gz` with a single-threaded zlib stream. Here the compression
+level is a parameter, and with `threads > 1` the stream is cut into blocks that are
+compressed in parallel, each block one gzip member. A concatenation of gzip members is
+a valid gzip file (RFC 1952), read as usual by nibabel, SimpleITK/ITK, `zcat`, etc.
+A `.nii` path is written uncompressed, for intermediate files.
+"""
+import gzip
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+from nibabel.fileholders import FileHolder
+
+
+class ParallelGzipWriter:
+    """Write-only gzip file object, every `block_size` bytes are compressed by a thread pool.
+
+    zlib releases the GIL, so `threads` blocks are compressed at the same time. At most
+    `2 * threads` blocks are held in memory; members are written in order.
+    """
+    def __init__(self, path, compresslevel=1, threads=4, block_size=4 << 20):
+        self.fileobj = open(path, "wb")
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.max_pending = 2 * threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offset = 0     # uncompressed bytes written, what `tell` reports (nibabel pads the header with it)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self.buffer += data
+        self.offset += data.nbytes
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return data.nbytes
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.fileobj.closed:
+            return
+        if self.buffer or self.offset == 0:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_nifti_file(path, compresslevel=1, threads=1, compressed=None):
+    """Open `path` for writing, gzip-compressed if it ends with `.gz` (or if `compressed`)."""
+    if compressed is None:
+        compressed = path.endswith(".gz")
+    if not compressed:
+        return open(path, "wb")
+    if threads > 1:
+        return ParallelGzipWriter(path, compresslevel=compresslevel, threads=threads)
+    return gzip.open(path, "wb", compresslevel=compresslevel)
+
+
+def save_nifti(img, path, compresslevel=1, threads=1):
+    """`nib.save` replacement for single-file NIfTI images (`.nii.gz` or `.nii`).
+
+    The file is written under a `.part` name and renamed once complete.
+    """
+    assert isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)), f"{type(img).__name__} is not a single-file NIfTI image"
+    tmp_path = path + ".part"
+    with open_nifti_file(tmp_path, compresslevel, threads, compressed=path.endswith(".gz")) as f:
+        img.to_file_map({"image": FileHolder(fileobj=f)})
+    os.replace(tmp_path, path)
+
+
+def add_writer_args(parser):
+    """`--compresslevel` / `--compress_threads` for the scripts writing volumes."""
+    parser.add_argument('--compresslevel', type=int, default=1,
+                        help="gzip level of the written .nii.gz volumes (0-9), 1 is nibabel's default")
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help="threads compressing each written .nii.gz volume, >1 writes block-parallel gzip")
+    return parser
@@ -18,6 +18,7 @@ import pandas as pd
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from metric_utils import get_ssim_3d, get_psnr_3d
+from nifti_writer import save_nifti, add_writer_args
 
 def _gather_latest_eval(method_folder):
     """提取最新 eval 子目录路径（如果有则返回绝对路径，否则返回 None）。"""
@@ -40,7 +41,7 @@ def _gather_latest_eval(method_folder):
 # ------------------------------ 子进程函数 --------------------------------- #
 def process_folder(args):
     """对单个 method_folder 进行完整处理，返回 (case_id, ssim_3d, psnr_3d)。"""
-    method_folder, nii_out_folder, CARE = args
+    method_folder, nii_out_folder, CARE, writer_kwargs = args
     case_id = "_".join(method_folder.split("/")[-1].split("-")[-1].split("_")[:2])
 
     # 建好输出目录
@@ -75,13 +76,13 @@ def process_folder(args):
     # 保存预测 nifti
     if not CARE:
         pred_save = ((image_pred * 2 - 1) * 1000).astype(np.int16).clip(-1000, 1000)
-        nib.save(nib.Nifti1Image(pred_save, nii_gt.affine, nii_gt.header),
-                os.path.join(out_case_dir, "ct.nii.gz"))
+        save_nifti(nib.Nifti1Image(pred_save, nii_gt.affine, nii_gt.header),
+                   os.path.join(out_case_dir, "ct.nii.gz"), **writer_kwargs)
 
     return case_id, ssim_3d, psnr_3d
 # --------------------------------------------------------------------------- #
 
-def extract_experimental_results_mp(num_views, CARE=False, n_workers=None):
+def extract_experimental_results_mp(num_views, CARE=False, n_workers=None, writer_kwargs=None):
     methods = ["intratomo", 'nerf', 'tensorf', 'naf', 'FDK', "SART", "ASD_POCS", "Lineformer"]
     ignore_ids = ["lty"]
 
@@ -116,7 +117,7 @@ def extract_experimental_results_mp(num_views, CARE=False, n_workers=None):
         results, psnr_vals, ssim_vals = [], [], []
         with ProcessPoolExecutor(max_workers=n_workers) as exe:
             tasks = [exe.submit(process_folder,
-                                (mf, nii_out_folder, CARE))
+                                (mf, nii_out_folder, CARE, writer_kwargs or dict()))
                      for mf in method_folders]
 
             for fut in tqdm(as_completed(tasks), total=len(tasks),
@@ -169,7 +170,7 @@ def write_results_to_csv(results, output_csv):
 # --------------------------------------------------------------------------
 def _process_r2_case(args):
     """对单个 r2_gaussian method_folder 完整计算并返回结果."""
-    (method_folder, nii_out_folder, CARE) = args
+    (method_folder, nii_out_folder, CARE, writer_kwargs) = args
     # import yaml, nibabel as nib, numpy as np
 
     # 解析 case_id
@@ -223,8 +224,8 @@ def _process_r2_case(args):
     if not CARE:
         pred_save = np.clip(((image_pred_raw * 2 - 1) * 1000).astype(np.int16),
                             -1000, 1000)
-        nib.save(nib.Nifti1Image(pred_save, nii_gt.affine, nii_gt.header),
-                os.path.join(out_case_dir, "ct.nii.gz"))
+        save_nifti(nib.Nifti1Image(pred_save, nii_gt.affine, nii_gt.header),
+                   os.path.join(out_case_dir, "ct.nii.gz"), **writer_kwargs)
 
     return case_id, ssim_3d, psnr_3d
 
@@ -233,7 +234,7 @@ def _process_r2_case(args):
 # 并行入口函数
 # --------------------------------------------------------------------------
 def extract_experimental_results_r2_gaussian_mp(num_views,
-                                                CARE=False, n_workers=None):
+                                                CARE=False, n_workers=None, writer_kwargs=None):
     """
     r2_gaussian 版本的多进程计算函数。
     与 extract_experimental_results_mp 并存，不会存在重名冲突。
@@ -274,7 +275,7 @@ def extract_experimental_results_r2_gaussian_mp(num_views,
 
         results, psnr_vals, ssim_vals = [], [], []
         with ProcessPoolExecutor(max_workers=n_workers) as exe:
-            tasks = [exe.submit(_process_r2_case, (mf, nii_out_folder, CARE))
+            tasks = [exe.submit(_process_r2_case, (mf, nii_out_folder, CARE, writer_kwargs or dict()))
                      for mf in method_folders]
 
             for fut in tqdm(as_completed(tasks), total=len(tasks),
@@ -307,11 +308,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate metrics")
     parser.add_argument('--num_views', type=int, default=50)
     parser.add_argument('--CARE', action="store_true")  # TODO
+    add_writer_args(parser)
     args = parser.parse_args()
+    writer_kwargs = dict(compresslevel=args.compresslevel, threads=args.compress_threads)
 
     num_views = args.num_views  # Replace with the actual number of views to filter
 
     # NOTE: multi-processing
-    extract_experimental_results_mp(num_views, args.CARE, n_workers=32)
-    extract_experimental_results_r2_gaussian_mp(num_views, args.CARE, n_workers=32)
+    extract_experimental_results_mp(num_views, args.CARE, n_workers=32, writer_kwargs=writer_kwargs)
+    extract_experimental_results_r2_gaussian_mp(num_views, args.CARE, n_workers=32, writer_kwargs=writer_kwargs)
 
@@ -16,6 +16,22 @@ from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 from nnunetv2.imageio.nibabel_reader_writer import NibabelIO
 import os
 import pandas as pd
+import numpy as np
+import nibabel
+from concurrent.futures import ThreadPoolExecutor
+
+from nifti_writer import save_nifti, add_writer_args
+
+
+def resave_segmentations(seg_paths, compresslevel=1, threads=1, workers=1):
+    """Re-write the segmentations exported by nnUNet (`nib.save`) with `nifti_writer.save_nifti`."""
+    def resave(seg_path):
+        seg_nib = nibabel.load(seg_path)
+        seg_nib = nibabel.Nifti1Image(np.asanyarray(seg_nib.dataobj), seg_nib.affine, seg_nib.header)   # NOTE: read before the file is replaced
+        save_nifti(seg_nib, seg_path, compresslevel=compresslevel, threads=threads)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(resave, [seg_path for seg_path in seg_paths if os.path.exists(seg_path)]))
 
 def split_files(files_input, files_output, num_parts, part_id):
     """
@@ -60,6 +76,7 @@ def parse_args():
     parser.add_argument('--workers', type=int, default=1, 
                         help="Number of worker processes for preprocessing and segmentation export")
     parser.add_argument('--CARE',  action='store_true')
+    add_writer_args(parser)
     return parser.parse_args()
 
 
@@ -128,6 +145,12 @@ def main():
         part_id=0
     )
 
+    # nnUNet writes with nibabel's gzip level 1, re-write with other writer settings
+    if args.compresslevel != 1 or args.compress_threads > 1:
+        file_ending = predictor.dataset_json["file_ending"]
+        resave_segmentations([file_output + file_ending for file_output in files_output],
+                             compresslevel=args.compresslevel, threads=args.compress_threads, workers=args.workers)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
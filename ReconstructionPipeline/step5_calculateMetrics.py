@@ -67,7 +67,7 @@ def cal_dice_nsd(pred, truth, spacing_mm, tolerance=2):
     return dice, nsd
 
 def process_case(case):
-    case, CARE = case
+    case, CARE, pred_mask_root = case
     case_id = os.path.basename(case)
     gt_path = os.path.join(case, "gt.nii.gz")
     if CARE:
@@ -150,7 +150,7 @@ if __name__ == "__main__":
     print("calculate on total of ", len(cases), "cases")
     results = []
     with ProcessPoolExecutor(max_workers=36) as exe:
-        tasks = [exe.submit(process_case, (case, args.CARE)) for case in cases]
+        tasks = [exe.submit(process_case, (case, args.CARE, pred_mask_root)) for case in cases]
         for fut in tqdm(as_completed(tasks), total=len(tasks),
                         desc=args.pred_path, dynamic_ncols=True):
             res = fut.result()
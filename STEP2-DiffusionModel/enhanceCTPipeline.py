@@ -85,6 +85,41 @@ def init_unet(pretrained_model_name_or_path, zero_cond_conv_in=False):
 
 
 class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modified 3 lines lol
+    _prompt_cache = None    # prompt -> (prompt_embeds, negative_prompt_embeds), see `build_prompt_cache`
+
+    @torch.no_grad()
+    def build_prompt_cache(self, prompts, negative_prompt=None):
+        """Run the text encoder ONCE for a fixed set of prompts (e.g. the two CT phases).
+
+        Afterwards `__call__` gathers the cached rows for every prompt of a batch, so the 
+        text encoder never runs in the hot loop and can be released by `free_text_encoder`.
+        """
+        prompts = list(dict.fromkeys(prompts))  # unique, keep order
+        prompt_embeds, negative_prompt_embeds = self.encode_prompt(
+            prompts,
+            self._execution_device,
+            1,
+            True,   # always keep the negative embeddings, guidance may be turned on per call
+            negative_prompt=[negative_prompt] * len(prompts) if isinstance(negative_prompt, str) else negative_prompt,
+        )
+        self._prompt_cache = {
+            prompt: (prompt_embeds[i:i + 1], negative_prompt_embeds[i:i + 1]) for i, prompt in enumerate(prompts)
+        }
+        return self._prompt_cache
+
+    def get_cached_prompt_embeds(self, prompt):
+        """Gather `(prompt_embeds, negative_prompt_embeds)` rows of a batch of prompts from the cache."""
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        prompt_embeds = torch.cat([self._prompt_cache[p][0] for p in prompt])
+        negative_prompt_embeds = torch.cat([self._prompt_cache[p][1] for p in prompt])
+        return prompt_embeds, negative_prompt_embeds
+
+    def free_text_encoder(self):
+        """Drop the text encoder after warm-up, only cached prompts can be used afterwards."""
+        self.text_encoder = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     # NOTE: COPIED from diffusers repo
     @torch.no_grad()
     # @replace_example_docstring(EXAMPLE_DOC_STRING)
@@ -240,6 +275,13 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
             height, width = height * self.vae_scale_factor, width * self.vae_scale_factor
         # to deal with lora scaling and other possible forward hooks
 
+        # 0.1 Gather pre-computed text embeddings if all prompts of the batch are cached
+        if (self._prompt_cache is not None and prompt is not None and prompt_embeds is None 
+                and negative_prompt is None and negative_prompt_embeds is None 
+                and all(p in self._prompt_cache for p in ([prompt] if isinstance(prompt, str) else prompt))):
+            prompt_embeds, negative_prompt_embeds = self.get_cached_prompt_embeds(prompt)
+            prompt = None
+
         # 1. Check inputs. Raise error if not correct
         self.check_inputs(
             prompt,
@@ -421,30 +463,35 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
 
 if __name__ == "__main__":
     """Method 1: StableDiffusionPipeline"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch_dtype = torch.float16 if device == "cuda" else torch.float32   # float16 is very slow on CPU
     # Setting up models in the pipeline.
     finetuned_vae_name_or_path = "../STEP1-AutoEncoderModel/klvae/logs/vae_kl6_lr4_std/checkpoint-150000"
     finetuned_unet_name_or_path = "../STEP2-DiffusionModel/logs/l2_cat_df4_noblur/checkpoint-50000"
     # load vae
     vae = AutoencoderKL.from_pretrained(
             finetuned_vae_name_or_path, subfolder="vae", #revision=args.revision, variant=args.variant,
-            torch_dtype=torch.float16
+            torch_dtype=torch_dtype
         )
     # load unet
     args = SimpleNamespace(pretrained_model_name_or_path="stable-diffusion-v1-5/stable-diffusion-v1-5")
     unet = init_unet(args.pretrained_model_name_or_path, zero_cond_conv_in=True)
     unet_ckpt = safetensors.torch.load_file(os.path.join(finetuned_unet_name_or_path, "unet", "diffusion_pytorch_model.safetensors"))
     unet.load_state_dict(unet_ckpt, strict=True)
-    unet = unet.half()
+    unet = unet.to(torch_dtype)
     # construct pipeline
     pipe = ConcatInputStableDiffusionPipeline.from_pretrained(
         "stable-diffusion-v1-5/stable-diffusion-v1-5", 
         unet=unet,
         vae=vae,
         safety_checker=None,
-        torch_dtype=torch.float16)
+        torch_dtype=torch_dtype)
     pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)  # 使用DDIM调度器
     pipe.set_progress_bar_config(disable=True)
-    pipe = pipe.to("cuda")
+    pipe = pipe.to(device)
+    # text embeddings of the two CT phases are computed once, then the text encoder is released
+    pipe.build_prompt_cache(["An Arterial CT slice.", "A Portal-venous CT slice."])
+    pipe.free_text_encoder()
 
     # Dataset settings"
     data_dir = "/projects/bodymaps/Data/AbdomenAtlasPro"
@@ -501,8 +548,8 @@ if __name__ == "__main__":
 
             # --- Step 1: 图像编码为潜变量 ---
             # image = (torch.from_numpy(input_image.copy())[None].permute(0, 3, 1, 2)).to("cuda").half() * 2 - 1  # [-1, 1]
-            raw_image = batch["pixel_values"].to("cuda").half()   
-            cond_image = batch["cond_pixel_values"].to("cuda").half()   # same thing as `pixel_values`
+            raw_image = batch["pixel_values"].to(device, dtype=torch_dtype)   
+            cond_image = batch["cond_pixel_values"].to(device, dtype=torch_dtype)   # same thing as `pixel_values`
             prompt = batch["input_prompt"]
             slice_idx = batch["slice_idx"]
             with torch.no_grad():
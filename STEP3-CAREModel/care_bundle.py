@@ -0,0 +1,86 @@
+import json
+
+import diffusers
+import safetensors.torch
+import torch
+from accelerate import init_empty_weights
+from diffusers import AutoencoderKL, UNet2DConditionModel
+from safetensors import safe_open
+
+BUNDLE_FORMAT = "care-bundle-v1"
+
+
+def save_care_bundle(path, unet, vae, scheduler, prompt_cache, metadata=None, torch_dtype=None):
+    """Write ONE self-contained CARE file: 8-channel UNet, fine-tuned VAE and cached phase embeddings.
+
+    Tensors are stored under `unet.` / `vae.` / `prompt_cache.<i>.` prefixes, the model and
+    scheduler configs and the cached prompts in the safetensors metadata (JSON strings).
+    Weights are stored in `torch_dtype` (default: as they are), the dtype they are loaded in.
+    """
+    def cast(tensor):
+        tensor = tensor.detach().to("cpu")
+        return tensor.to(torch_dtype) if torch_dtype is not None and tensor.is_floating_point() else tensor
+
+    tensors = dict()
+    for prefix, model in (("unet.", unet), ("vae.", vae)):
+        tensors.update({prefix + name: cast(tensor) for name, tensor in model.state_dict().items()})
+    prompts = list(prompt_cache.keys())
+    for i, prompt in enumerate(prompts):
+        prompt_embeds, negative_prompt_embeds = prompt_cache[prompt]
+        tensors[f"prompt_cache.{i}.prompt_embeds"] = cast(prompt_embeds)
+        tensors[f"prompt_cache.{i}.negative_prompt_embeds"] = cast(negative_prompt_embeds)
+    tensors = {name: tensor.contiguous() for name, tensor in tensors.items()}
+
+    bundle_metadata = {
+        "format": BUNDLE_FORMAT,
+        "unet_config": unet.to_json_string(),   # with `_class_name` and `_diffusers_version`
+        "vae_config": vae.to_json_string(),
+        "scheduler_config": scheduler.to_json_string(),
+        "prompts": json.dumps(prompts),
+        "metadata": json.dumps(metadata or dict(), default=str),
+    }
+    safetensors.torch.save_file(tensors, path, metadata=bundle_metadata)
+
+
+def read_bundle_metadata(path):
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata()
+    if metadata is None or metadata.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"{path} is not a CARE bundle (see `export_care_bundle.py`)")
+    return {key: json.loads(value) for key, value in metadata.items() if key != "format"}
+
+
+def load_bundle_state_dict(path, prefix, torch_dtype=None, device="cpu"):
+    """Tensors under `prefix` (e.g. `unet.`), read from the memory-mapped file straight onto `device`."""
+    state_dict = dict()
+    with safe_open(path, framework="pt", device=str(device)) as f:
+        for name in f.keys():
+            if name.startswith(prefix):
+                tensor = f.get_tensor(name)
+                if torch_dtype is not None and tensor.is_floating_point() and tensor.dtype != torch_dtype:
+                    tensor = tensor.to(torch_dtype)
+                state_dict[name[len(prefix):]] = tensor
+    return state_dict
+
+
+def _build_model(model_cls, config, state_dict):
+    # NOTE: the modules are created without allocating weights, the loaded tensors are used as they are
+    with init_empty_weights():
+        model = model_cls.from_config(config)
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    return model.eval()
+
+
+def load_care_bundle(path, torch_dtype=None, device="cpu"):
+    """Components of a CARE bundle: unet, vae, scheduler, prompt_cache (prompt -> (embeds, negative embeds)) and metadata."""
+    bundle_metadata = read_bundle_metadata(path)
+    unet = _build_model(UNet2DConditionModel, bundle_metadata["unet_config"],
+                        load_bundle_state_dict(path, "unet.", torch_dtype, device))
+    vae = _build_model(AutoencoderKL, bundle_metadata["vae_config"],
+                       load_bundle_state_dict(path, "vae.", torch_dtype, device))
+    scheduler_config = bundle_metadata["scheduler_config"]
+    scheduler = getattr(diffusers, scheduler_config["_class_name"]).from_config(scheduler_config)
+    prompt_embeds = load_bundle_state_dict(path, "prompt_cache.", torch_dtype, device)
+    prompt_cache = {prompt: (prompt_embeds[f"{i}.prompt_embeds"], prompt_embeds[f"{i}.negative_prompt_embeds"])
+                    for i, prompt in enumerate(bundle_metadata["prompts"])}
+    return dict(unet=unet, vae=vae, scheduler=scheduler, prompt_cache=prompt_cache, metadata=bundle_metadata["metadata"])
@@ -0,0 +1,39 @@
+"""
+nnUNet anatomy segmentator of the CARE loss, shared by `train_text_to_image.py` and `train_distill.py`.
+
+The decoded x0 prediction (HU, in [-1000, 1000]) is normalized as nnUNet was trained
+(`ct_preprocessing_for_nnunet`) and segmented by the frozen network of `load_seg_model`.
+"""
+import torch
+
+
+def load_seg_model(seg_model_path, device):
+    """Frozen nnUNet network of a trained model folder and the CT intensity statistics of its training set."""
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    predictor = nnUNetPredictor(
+        tile_step_size=0.5,
+        use_gaussian=True,
+        use_mirroring=True,
+        perform_everything_on_device=False,     # False when encountering memory constraints
+        device=device,
+        verbose=False,
+        verbose_preprocessing=False,
+        allow_tqdm=True
+    )
+    predictor.initialize_from_trained_model_folder(
+        seg_model_path,
+        use_folds=('all',),
+        checkpoint_name='checkpoint_final.pth',
+    )
+    seg_model = predictor.network.to(device)
+    seg_model.eval()
+    seg_model.requires_grad_(False)
+    trainset_meta = predictor.plans_manager.plans["foreground_intensity_properties_per_channel"]["0"]
+    return seg_model, trainset_meta
+
+
+def ct_preprocessing_for_nnunet(image, trainset_meta):
+    image = torch.clamp(image, trainset_meta["percentile_00_5"], trainset_meta["percentile_99_5"])
+    image -= trainset_meta["mean"]
+    image /= trainset_meta["std"]
+    return image
@@ -4,13 +4,17 @@ import numpy as np
 import nibabel as nib
 import albumentations as A
 import cv2
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import random
 import time
 from tqdm import tqdm
 import pandas as pd
 import h5py
 
+ARTERIAL_PROMPT = "An Arterial CT slice."
+VENOUS_PROMPT = "A Portal-venous CT slice."
+INFERENCE_PROMPTS = [ARTERIAL_PROMPT, VENOUS_PROMPT]    # the only prompts `CTDatasetInference` can produce
+
 def collate_fn(examples):
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
         pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
@@ -29,16 +33,25 @@ def collate_fn(examples):
 def collate_fn_inference(examples):
         # pixel_values = torch.stack([example["pixel_values"] for example in examples])
         # pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-        cond_pixel_values = torch.stack([example["cond_pixel_values"] for example in examples])
+        cached = [example["cond_pixel_values"] is None for example in examples]
+        cond_pixel_values = [example["cond_pixel_values"] for example in examples if example["cond_pixel_values"] is not None]
+        cond_pixel_values = torch.stack(cond_pixel_values) if len(cond_pixel_values) > 0 else torch.zeros(0)
         cond_pixel_values = cond_pixel_values.to(memory_format=torch.contiguous_format).float()
         input_prompt = [example["input_prompt"] for example in examples]
         slice_idx = [example["slice_idx"] for example in examples]
+        bdmap_id = [example["bdmap_id"] for example in examples]
+        channel_weights = torch.stack([example["channel_weights"] for example in examples])
+        window_class = [example["window_class"] for example in examples]
         return {
             # "pixel_values": pixel_values, 
             "input_prompt": input_prompt,   # NOTE: different from training
-            "cond_pixel_values": cond_pixel_values,
+            "cond_pixel_values": cond_pixel_values,     # NOTE: only the windows that are not `cached`
+            "cached": cached,   # latents in the latent cache, slices not read
             # "gt_pixel_values": gt_pixel_values,
-            "slice_idx": slice_idx
+            "slice_idx": slice_idx,
+            "bdmap_id": bdmap_id,   # NOTE: a batch may span several CT volumes
+            "channel_weights": channel_weights,
+            "window_class": window_class,   # "empty" / "uncertain" / "body", see `classify_window`
         }
 
 def varifyh5(filename): # read the h5 file to see if the conversion is finished or not
@@ -89,9 +102,12 @@ def load_CT_slice(ct_path, slice_idx=None):
     cond_slice = (cond_slice + 1000.) / 2000.       # [-1000, 1000] --> [0, 1]
     return ct_slice, cond_slice, gt_slice  # (H W 3)[0, 1]
 
-def load_CT_slice_from_nfiti(ct_data, slice_idx=None):
+def load_CT_slice_from_nfiti(ct_data, slice_idx=None, decoded_path=None):
     """For any nii data during inference: ranging from [-1000, 1000], shape of (H W D) """
-    ct_slice = ct_data.dataobj[:, :, slice_idx:slice_idx + 3].copy() 
+    if decoded_path is not None and os.path.exists(decoded_path):  # decoded once by `VolumePrefetcher`
+        ct_slice = np.load(decoded_path, mmap_mode="r")[:, :, slice_idx:slice_idx + 3].copy()
+    else:
+        ct_slice = ct_data.dataobj[:, :, slice_idx:slice_idx + 3].copy() 
             
     # target range: [-1000, 1000] -> [-1, 1]
     ct_slice[ct_slice > 1000.] = 1000.    # clipping range and normalize
@@ -174,12 +190,119 @@ class ReconCTDataset(Dataset):
         return inputs.input_ids 
     
 
+BLENDING_WEIGHTS = {    # weights of each channel (slice) in a 3-slice window
+    "uniform": [1., 1., 1.],
+    "center": [1., 2., 1.],
+    "center_only": [0., 1., 0.],
+}
+
+def get_window_starts(z_shape, slice_stride=1):
+    """First slice of every 3-slice window; the last window always ends at the last slice."""
+    window_starts = list(range(0, z_shape - 3 + 1, slice_stride))
+    if window_starts[-1] != z_shape - 3:    # boundary: make sure the last slices are covered
+        window_starts.append(z_shape - 3)
+    return window_starts
+
+def get_window_weights(window_starts, z_shape, blending="uniform"):
+    """Per-window channel weights of shape (num_windows, 3) for blending overlapping windows.
+
+    A slice that gets zero weight from every window covering it (e.g. the first slice 
+    with `center_only`, or every slice between two centers with `slice_stride` > 1) 
+    falls back to uniform weights, so each slice is always reconstructed.
+    """
+    window_weights = np.tile(np.asarray(BLENDING_WEIGHTS[blending]), (len(window_starts), 1))
+    slice_ids = np.asarray(window_starts)[:, None] + np.arange(3)[None, :]  # (num_windows, 3)
+    slice_weights = np.zeros(z_shape)
+    np.add.at(slice_weights, slice_ids, window_weights)
+    uncovered = slice_weights[slice_ids] == 0
+    window_weights[uncovered] = 1.
+    return window_weights
+
+
+WINDOW_CLASSES = ["empty", "uncertain", "body"]
+
+
+def classify_window(ct_window, body_hu=-500., empty_fraction=0.005, body_fraction=0.02):
+    """Cheap pre-pass on a (H W 3) [0, 1] window: "empty" (air / table only), "body" or "uncertain".
+
+    The body mask is every 4th pixel above `body_hu`; the window is "empty" when its most
+    covered slice has less than `empty_fraction` of body pixels and no bone, "body" above
+    `body_fraction`.
+    """
+    ct_window = ct_window[::4, ::4]
+    fraction = (ct_window > (body_hu + 1000.) / 2000.).mean(axis=(0, 1)).max()
+    has_bone = (ct_window > (300. + 1000.) / 2000.).any()
+    if fraction < empty_fraction and not has_bone:
+        return "empty"
+    return "body" if fraction >= body_fraction else "uncertain"
+
+
+def get_padded_shape(shape, multiple=64):
+    """Smallest (H W) >= `shape` in multiples of `multiple` pixels (64 px = 8 latent pixels, what the UNet needs)."""
+    return tuple(int(np.ceil(s / multiple)) * multiple for s in shape)
+
+
+class ShapeGroupedBatchSampler(Sampler):
+    """Batches of consecutive windows of a `ConcatDataset` of `CTDatasetInference` that never mix input shapes.
+
+    The window order is kept (the enhancer blends the windows of a volume in order): a
+    batch is only cut early where a volume of another shape starts.
+    """
+    def __init__(self, ct_datasets, batch_size):
+        self.batches = []
+        start, run_shape, run = 0, None, []
+        for ct_dataset in ct_datasets:
+            if ct_dataset.input_shape != run_shape:
+                self.batches += [run[i:i + batch_size] for i in range(0, len(run), batch_size)]
+                run_shape, run = ct_dataset.input_shape, []
+            run += range(start, start + len(ct_dataset))
+            start += len(ct_dataset)
+        self.batches += [run[i:i + batch_size] for i in range(0, len(run), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class LaneBatchSampler(Sampler):
+    """Batches of a `ConcatDataset` of `CTDatasetInference` for the warm start of the enhancer.
+
+    Every volume is cut into (at most) `batch_size` lanes of consecutive windows and batch
+    t holds the t-th window of every lane, so a batch holds windows of ONE volume and its
+    i-th window is always on lane i.
+    """
+    def __init__(self, ct_datasets, batch_size):
+        self.batches = []
+        start = 0
+        for ct_dataset in ct_datasets:
+            num_windows = len(ct_dataset)
+            lane_length = int(np.ceil(num_windows / batch_size))
+            for t in range(lane_length):
+                self.batches.append([start + lane_start + t for lane_start in range(0, num_windows, lane_length)
+                                     if lane_start + t < num_windows])
+            start += num_windows
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 class CTDatasetInference(Dataset):    # for a single CT volume
-    def __init__(self, file_path, image_transforms=None, cond_transforms=None):
+    def __init__(self, file_path, image_transforms=None, cond_transforms=None, slice_stride=1, blending="uniform", 
+                 native_resolution=False, background_kwargs=None):
         """ (inference on CT volume only)
         Args:
             file_path (string): The CT volume to inference (.nii.gz).
             transform (albumentations.Compose): Transformations to apply to 2D slices. 
+            slice_stride (int): Step between two 3-slice windows, 1 (every slice is denoised 3 times) to 3 (once).
+            blending (string): How overlapping windows are averaged, one of `BLENDING_WEIGHTS`.
+            native_resolution (bool): Skip `image_transforms`, only zero-pad the slices (bottom / right) to 
+                `get_padded_shape`; the enhancer crops the outputs back.
+            background_kwargs (dict): Thresholds of `classify_window`, every window gets a "window_class".
         """
         # read CT volume data
         self.file_path = file_path
@@ -188,6 +311,14 @@ class CTDatasetInference(Dataset):    # for a single CT volume
         # self.ct_volume_data = self.ct_volume_nii.get_fdata()
         self.ct_xyz_shape = self.ct_volume_nii.shape   # (H W D)
         self.ct_z_shape = self.ct_xyz_shape[2]
+        self.window_starts = get_window_starts(self.ct_z_shape, slice_stride)   # 3 adjacent clices as input unit
+        self.window_weights = get_window_weights(self.window_starts, self.ct_z_shape, blending)
+        self.decoded_path = None    # raw copy of the volume, set by the enhancer when it prefetches
+        self.native_resolution = native_resolution
+        self.background_kwargs = background_kwargs or dict()
+        self.cached_classes = None  # (Z,) `WINDOW_CLASSES` index per first slice, -1: not cached, set with a latent cache
+        self.skip_empty = False     # empty windows are skipped by the enhancer (`--skip_background`), their slices are read
+        self.input_shape = get_padded_shape(self.ct_xyz_shape[:2]) if native_resolution else None  # None: `image_transforms`
         
         # normalization
         self.norm_to_zero_centered = A.Normalize(
@@ -202,30 +333,54 @@ class CTDatasetInference(Dataset):    # for a single CT volume
         self.image_transforms = image_transforms
         self.cond_transforms = cond_transforms  # NOTE: useless
 
-    def __len__(self):
-        return self.ct_z_shape-3 + 1   # 3 adjacent clices as input unit
+    def skip_slices(self, num_slices):
+        """Drop the windows that only cover the first `num_slices` slices (already enhanced, e.g. on resume)."""
+        keep = [idx for idx, start in enumerate(self.window_starts) if start + 2 >= num_slices]
+        self.window_starts = [self.window_starts[idx] for idx in keep]
+        self.window_weights = self.window_weights[keep]
 
-    def __getitem__(self, slice_idx): # slice_idx will always in order by setting `shuffle=False`
-        cond_ct_slice_raw = load_CT_slice_from_nfiti(self.ct_volume_nii, slice_idx)     # [0, 1]
-        cond_ct_slice = self.image_transforms(image=cond_ct_slice_raw)["image"]
-
-        cond_ct_slice = HWCarrayToCHWtensor(p=1.)(
-            image=self.norm_to_zero_centered(
-                image=cond_ct_slice)["image"]
-                )["image"] # array to tensor    [0, 1] -> ~[-1, 1]
+    def __len__(self):
+        return len(self.window_starts)
+
+    def is_cached(self, slice_idx):
+        """The latents of the window are cached and its slices are not read (but for skipped empty windows, the background fill needs them)."""
+        if self.cached_classes is None or self.cached_classes[slice_idx] < 0:
+            return False
+        return not (self.skip_empty and self.cached_classes[slice_idx] == WINDOW_CLASSES.index("empty"))
+
+    def __getitem__(self, window_idx): # window_idx will always in order by setting `shuffle=False`
+        slice_idx = self.window_starts[window_idx]
+        if self.is_cached(slice_idx):
+            cond_ct_slice, window_class = None, WINDOW_CLASSES[self.cached_classes[slice_idx]]
+        else:
+            cond_ct_slice_raw = load_CT_slice_from_nfiti(self.ct_volume_nii, slice_idx, self.decoded_path)     # [0, 1]
+            window_class = classify_window(cond_ct_slice_raw, **self.background_kwargs)
+            if self.native_resolution:  # NOTE: no resampling, 0 is air (-1000 HU)
+                pad_h, pad_w = self.input_shape[0] - cond_ct_slice_raw.shape[0], self.input_shape[1] - cond_ct_slice_raw.shape[1]
+                cond_ct_slice = np.pad(cond_ct_slice_raw, ((0, pad_h), (0, pad_w), (0, 0)))
+            else:
+                cond_ct_slice = self.image_transforms(image=cond_ct_slice_raw)["image"]
+
+            cond_ct_slice = HWCarrayToCHWtensor(p=1.)(
+                image=self.norm_to_zero_centered(
+                    image=cond_ct_slice)["image"]
+                    )["image"] # array to tensor    [0, 1] -> ~[-1, 1]
         
         if "arterial" in self.id_map[self.id_map["BDMAP Name"]==self.bdmap_id]["Original Name"].item().lower():
-            text_prompt = "An Arterial CT slice."
+            text_prompt = ARTERIAL_PROMPT
         elif "venous" in self.id_map[self.id_map["BDMAP Name"]==self.bdmap_id]["Original Name"].item().lower():
-            text_prompt = "A Portal-venous CT slice."
+            text_prompt = VENOUS_PROMPT
         else:
-            text_prompt = "An Arterial CT slice."   # default
+            text_prompt = ARTERIAL_PROMPT   # default
 
         example = dict()
         # example["pixel_values"] = cond_ct_slice # NOTE: useless
         example["cond_pixel_values"] = cond_ct_slice
         example["input_prompt"] = text_prompt
         example["slice_idx"] = slice_idx    # haha.
+        example["bdmap_id"] = self.bdmap_id
+        example["channel_weights"] = torch.from_numpy(self.window_weights[window_idx]).float()
+        example["window_class"] = window_class
 
         return example  # Shape: (C, H, W)
 
@@ -0,0 +1,124 @@
+"""
+Fidelity report of a tiny latent decoder (`train_tiny_decoder.py`) against the full fine-tuned VAE decoder.
+
+Evenly spaced 3-slice windows of held-out cases, of both the reconstruction (`BDMAP_O_{dataset}`)
+and the ground-truth CT (`BDMAP_O`), are VAE-encoded once and decoded by both decoders:
+
+    python eval_tiny_decoder.py --dataset nerf_50 --max_cases 5 \
+        --finetuned_vae_name_or_path=$FT_VAE_NAME \
+        --tiny_decoder_path logs/tiny_decoder/checkpoint-50000
+    # report: resultsCSVsweep/BDMAP_O_nerf_50_tiny_decoder.csv
+
+SSIM / PSNR / MAE (HU) of the tiny decoder w.r.t. the full decoder, the PSNR of both w.r.t. the
+CT itself, and the decode time per slice of both.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import torch
+from diffusers import AutoencoderKL
+
+from dataset import load_CT_slice_from_nfiti
+from tiny_decoder import load_tiny_decoder
+
+sys.path.append("../ReconstructionPipeline")
+from metric_utils import get_ssim_3d, get_psnr_3d
+
+
+def load_windows(ct_path, num_windows, resolution=512):
+    """(N 3 H W) evenly spaced windows of a CT in [-1, 1], resized as the enhancer does."""
+    ct_data = nib.load(ct_path)
+    z_shape = ct_data.shape[2]
+    windows = [load_CT_slice_from_nfiti(ct_data, slice_idx) for slice_idx in np.linspace(0, z_shape - 3, num_windows).astype(int)]
+    windows = [cv2.resize(window, (resolution, resolution), interpolation=cv2.INTER_CUBIC) for window in windows]
+    return torch.from_numpy(np.stack(windows)).permute(0, 3, 1, 2).float() * 2 - 1
+
+
+def timed_decode(decoder, latents, batch_size):
+    """Images in [0, 1] as (H W N*3) float arrays and seconds per slice of `decoder.decode(latents)`."""
+    images, seconds = [], 0.
+    for chunk in latents.split(batch_size):
+        if chunk.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        image = decoder.decode(chunk, return_dict=False)[0]
+        if chunk.is_cuda:
+            torch.cuda.synchronize()
+        seconds += time.perf_counter() - start
+        images.append((image.float().clamp(-1, 1) * 0.5 + 0.5).cpu())
+    images = torch.cat(images).permute(2, 3, 0, 1)   # (N 3 H W) -> (H W N 3)
+    return images.reshape(*images.shape[:2], -1).numpy(), seconds / len(latents)
+
+
+@torch.no_grad()
+def evaluate_case(vae, tiny, ct_path, args, torch_dtype):
+    windows = load_windows(ct_path, args.windows_per_case)
+    latents = torch.cat([vae.encode(chunk.to(args.device, torch_dtype)).latent_dist.mode()
+                         for chunk in windows.split(args.batch_size)]) * vae.config.scaling_factor
+    full_image, full_seconds = timed_decode(vae, latents / vae.config.scaling_factor, args.batch_size)
+    tiny_image, tiny_seconds = timed_decode(tiny, latents, args.batch_size)     # NOTE: the tiny decoder takes the scaled latents
+    ct_image = windows.permute(2, 3, 0, 1).reshape(*windows.shape[2:], -1).numpy() * 0.5 + 0.5
+    return {
+        "ssim_vs_full": get_ssim_3d(tiny_image, full_image) * 100,
+        "psnr_vs_full": get_psnr_3d(tiny_image, full_image),
+        "mae_hu_vs_full": np.abs(tiny_image - full_image).mean() * 2000,
+        "psnr_full_vs_ct": get_psnr_3d(full_image, ct_image.clip(0, 1)),
+        "psnr_tiny_vs_ct": get_psnr_3d(tiny_image, ct_image.clip(0, 1)),
+        "full_ms_per_slice": full_seconds * 1000,
+        "tiny_ms_per_slice": tiny_seconds * 1000,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fidelity of a tiny latent decoder against the full VAE decoder.")
+    parser.add_argument("--dataset", type=str, required=True, help="e.g. nerf_50, reads `BDMAP_O_{dataset}`.")
+    parser.add_argument("--data_root", type=str, default="../ReconstructionPipeline",
+                        help="Folder holding `BDMAP_O` (ground truth) and `BDMAP_O_{dataset}`.")
+    parser.add_argument("--split_csv", type=str, default="splits/BDMAP_O_AV_meta_test.csv")
+    parser.add_argument("--max_cases", type=int, default=5)
+    parser.add_argument("--windows_per_case", type=int, default=32)
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, required=True)
+    parser.add_argument("--tiny_decoder_path", type=str, required=True, help="Checkpoint folder of `train_tiny_decoder.py`.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--report_dir", type=str, default="resultsCSVsweep")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch_dtype = getattr(torch, args.dtype)
+    vae = AutoencoderKL.from_pretrained(args.finetuned_vae_name_or_path, subfolder="vae", torch_dtype=torch_dtype).to(args.device)
+    tiny = load_tiny_decoder(args.tiny_decoder_path, torch_dtype=torch_dtype, device=args.device)
+
+    bdmap_ids = pd.read_csv(args.split_csv)["bdmap_id"].apply(lambda x: x[:-2]).tolist()[:args.max_cases]
+    per_case = []
+    for bdmap_id in bdmap_ids:
+        for source, folder in (("reconstruction", f"BDMAP_O_{args.dataset}"), ("ground_truth", "BDMAP_O")):
+            ct_path = os.path.join(args.data_root, folder, bdmap_id, "ct.nii.gz")
+            if not os.path.exists(ct_path):
+                print(f"\033[31mMissing {ct_path}, skipped\033[0m")
+                continue
+            per_case.append(dict(bdmap_id=bdmap_id, source=source, **evaluate_case(vae, tiny, ct_path, args, torch_dtype)))
+
+    per_case = pd.DataFrame(per_case)
+    summary = per_case.drop(columns="bdmap_id").groupby("source", sort=False).mean().reset_index()
+    summary["decode_speedup"] = summary["full_ms_per_slice"] / summary["tiny_ms_per_slice"]
+    os.makedirs(args.report_dir, exist_ok=True)
+    report_csv = os.path.join(args.report_dir, f"BDMAP_O_{args.dataset}_tiny_decoder.csv")
+    summary.to_csv(report_csv, index=False)
+    per_case.to_csv(report_csv.replace(".csv", "_per_case.csv"), index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.round(3))
+    print(f"Tiny decoder report saved to {report_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Export a trained CARE model as ONE self-contained safetensors file for `testEnhanceCTPipeline.py --care_bundle`.
+
+    python export_care_bundle.py \
+        --finetuned_vae_name_or_path=$FT_VAE_NAME \
+        --finetuned_unet_name_or_path="logs/nerf_50/checkpoint-50000" \
+        --sd_model_name_or_path=$SD_MODEL_NAME \
+        --output_path="logs/nerf_50/care_bundle_fp16.safetensors" --dtype float16
+
+The bundle holds the 8-channel UNet (config and fine-tuned weights), the fine-tuned VAE,
+the scheduler config and the text embeddings of the inference prompts, stored in `--dtype`
+so that the enhancer memory-maps them without any conversion.
+"""
+import argparse
+import os
+
+import torch
+from diffusers import AutoencoderKL
+
+from care_bundle import save_care_bundle, load_care_bundle
+from dataset import INFERENCE_PROMPTS
+from testEnhanceCTPipeline import ConcatInputStableDiffusionPipeline, init_unet, load_unet_weights, TORCH_DTYPES
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a CARE model as a single-file bundle.")
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, required=True)
+    parser.add_argument("--finetuned_unet_name_or_path", type=str, required=True, help="e.g. logs/nerf_50/checkpoint-50000")
+    parser.add_argument("--sd_model_name_or_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True, help="e.g. logs/nerf_50/care_bundle_fp16.safetensors")
+    parser.add_argument("--dtype", type=str, default="float16", choices=list(TORCH_DTYPES.keys()),
+                        help="Dtype the bundle is stored (and loaded) in: float16 for GPUs, float32 / bfloat16 for CPUs.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Where the prompts are encoded.")
+    args = parser.parse_args()
+
+    # same models as the enhancer builds without a bundle, in float32
+    vae = AutoencoderKL.from_pretrained(args.finetuned_vae_name_or_path, subfolder="vae")
+    unet = init_unet(args.sd_model_name_or_path, zero_cond_conv_in=True)
+    load_unet_weights(unet, args.finetuned_unet_name_or_path)
+    pipe = ConcatInputStableDiffusionPipeline.from_pretrained(args.sd_model_name_or_path, unet=unet, vae=vae, safety_checker=None)
+    pipe = pipe.to(args.device)
+    prompt_cache = pipe.build_prompt_cache(INFERENCE_PROMPTS)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+    save_care_bundle(args.output_path, pipe.unet, pipe.vae, pipe.scheduler, prompt_cache,
+                     metadata=dict(finetuned_vae=os.path.abspath(args.finetuned_vae_name_or_path),
+                                   finetuned_unet=os.path.abspath(args.finetuned_unet_name_or_path),
+                                   sd_model=args.sd_model_name_or_path,
+                                   dtype=args.dtype),
+                     torch_dtype=TORCH_DTYPES[args.dtype])
+
+    # round trip: every tensor of the bundle matches the exported models
+    components = load_care_bundle(args.output_path)
+    for name in ("unet", "vae"):
+        exported = getattr(pipe, name).state_dict()
+        for key, tensor in components[name].state_dict().items():
+            assert torch.equal(tensor, exported[key].detach().cpu().to(tensor.dtype)), f"{name}.{key} differs"
+    print(f"wrote {args.output_path} ({os.path.getsize(args.output_path) / 2 ** 30:.2f} GB, {args.dtype})")
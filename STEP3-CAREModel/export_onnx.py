@@ -0,0 +1,135 @@
+"""
+Export a trained CARE model to ONNX graphs for `testEnhanceCTPipeline.py --backend onnx` (see `onnx_pipeline.py`).
+
+    python export_onnx.py \
+        --finetuned_vae_name_or_path=$FT_VAE_NAME \
+        --finetuned_unet_name_or_path="logs/nerf_50/checkpoint-50000" \
+        --sd_model_name_or_path=$SD_MODEL_NAME \
+        --output_dir="logs/nerf_50/onnx"
+
+or `--care_bundle logs/nerf_50/care_bundle.safetensors` instead of the three model paths.
+Graphs are exported in float32 with dynamic batch / height / width, then every graph is
+checked against the torch model on a random input.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from diffusers import AutoencoderKL, DDIMScheduler
+
+from dataset import INFERENCE_PROMPTS
+from testEnhanceCTPipeline import ConcatInputStableDiffusionPipeline, init_unet, load_unet_weights
+
+
+class UNetGraph(nn.Module):
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+
+class VaeEncoderGraph(nn.Module):
+    """Image -> moments (mean and logvar) of the latent distribution, sampled by the runtime."""
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, image):
+        moments = self.vae.encoder(image)
+        if self.vae.quant_conv is not None:
+            moments = self.vae.quant_conv(moments)
+        return moments
+
+
+class VaeDecoderGraph(nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent):
+        return self.vae.decode(latent, return_dict=False)[0]
+
+
+def export_graph(model, inputs, input_names, dynamic_axes, output_name, path, opset):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(model, inputs, path, input_names=input_names, output_names=[output_name],
+                      dynamic_axes={**dynamic_axes, output_name: {0: "batch", 2: "height", 3: "width"}},
+                      opset_version=opset, do_constant_folding=True)
+
+
+@torch.no_grad()
+def check_graph(model, inputs, input_names, path):
+    import onnxruntime as ort
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    expected = model(*inputs).numpy()
+    actual = session.run(None, {name: x.numpy() for name, x in zip(input_names, inputs)})[0]
+    print(f"{path}: max abs diff vs torch {np.abs(actual - expected).max():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a CARE model to ONNX.")
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, default=None)
+    parser.add_argument("--finetuned_unet_name_or_path", type=str, default=None, help="e.g. logs/nerf_50/checkpoint-50000")
+    parser.add_argument("--sd_model_name_or_path", type=str, default=None)
+    parser.add_argument("--care_bundle", type=str, default=None, help="Single-file bundle of `export_care_bundle.py` instead.")
+    parser.add_argument("--output_dir", type=str, required=True, help="e.g. logs/nerf_50/onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--resolution", type=int, default=512, help="Size of the example inputs.")
+    parser.add_argument("--skip_check", action="store_true", help="Do not compare ONNX Runtime with torch.")
+    args = parser.parse_args()
+
+    if args.care_bundle is not None:
+        pipe = ConcatInputStableDiffusionPipeline.from_care_bundle(args.care_bundle, torch_dtype=torch.float32)
+    else:
+        assert None not in (args.finetuned_vae_name_or_path, args.finetuned_unet_name_or_path, args.sd_model_name_or_path), \
+            "give `--care_bundle`, or the three model paths"
+        vae = AutoencoderKL.from_pretrained(args.finetuned_vae_name_or_path, subfolder="vae")
+        unet = init_unet(args.sd_model_name_or_path, zero_cond_conv_in=True)
+        load_unet_weights(unet, args.finetuned_unet_name_or_path)
+        pipe = ConcatInputStableDiffusionPipeline.from_pretrained(args.sd_model_name_or_path, unet=unet, vae=vae, safety_checker=None)
+        pipe.build_prompt_cache(INFERENCE_PROMPTS)
+    pipe.unet.eval()
+    pipe.vae.eval()
+
+    # inputs of the same shapes as in the enhancer (a guided batch of 2)
+    latent_size = args.resolution // pipe.vae_scale_factor
+    latent_channels = pipe.vae.config.latent_channels
+    prompt_embeds = torch.cat([pipe._prompt_cache[p][0] for p in INFERENCE_PROMPTS]).float().cpu()
+    graphs = {
+        "unet": (UNetGraph(pipe.unet),
+                 (torch.randn(2, pipe.unet.config.in_channels, latent_size, latent_size), torch.tensor([999, 999]), prompt_embeds),
+                 ["sample", "timestep", "encoder_hidden_states"],
+                 {"sample": {0: "batch", 2: "height", 3: "width"}, "timestep": {0: "batch"}, "encoder_hidden_states": {0: "batch"}},
+                 "noise_pred"),
+        "vae_encoder": (VaeEncoderGraph(pipe.vae), (torch.randn(2, 3, args.resolution, args.resolution),),
+                        ["image"], {"image": {0: "batch", 2: "height", 3: "width"}}, "moments"),
+        "vae_decoder": (VaeDecoderGraph(pipe.vae), (torch.randn(2, latent_channels, latent_size, latent_size),),
+                        ["latent"], {"latent": {0: "batch", 2: "height", 3: "width"}}, "image"),
+    }
+    for name, (model, inputs, input_names, dynamic_axes, output_name) in graphs.items():
+        path = os.path.join(args.output_dir, name, "model.onnx")   # NOTE: one folder per graph, the UNet weights are external data
+        export_graph(model, inputs, input_names, dynamic_axes, output_name, path, args.opset)
+        if not args.skip_check:
+            check_graph(model, inputs, input_names, path)
+
+    # phase embeddings and everything the runtime needs besides the graphs
+    prompts = list(pipe._prompt_cache.keys())
+    np.savez(os.path.join(args.output_dir, "prompt_embeds.npz"),
+             prompt_embeds=torch.cat([pipe._prompt_cache[p][0] for p in prompts]).float().cpu().numpy(),
+             negative_prompt_embeds=torch.cat([pipe._prompt_cache[p][1] for p in prompts]).float().cpu().numpy())
+    with open(os.path.join(args.output_dir, "care_onnx.json"), "w") as f:
+        json.dump({
+            "prompts": prompts,
+            "scheduler_config": json.loads(DDIMScheduler.from_config(pipe.scheduler.config).to_json_string()),
+            "scaling_factor": pipe.vae.config.scaling_factor,
+            "vae_scale_factor": pipe.vae_scale_factor,
+            "source": args.care_bundle or dict(finetuned_vae=args.finetuned_vae_name_or_path,
+                                               finetuned_unet=args.finetuned_unet_name_or_path,
+                                               sd_model=args.sd_model_name_or_path),
+        }, f, indent=2)
+    print(f"ONNX graphs written to {args.output_dir}")
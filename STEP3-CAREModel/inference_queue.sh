@@ -1,27 +1,28 @@
-
-bash inference.sh nerf_50
-bash inference.sh nerf_200
-
-bash inference.sh FDK_50
-bash inference.sh FDK_200
-
-bash inference.sh Lineformer_50
-bash inference.sh Lineformer_200
-
-bash inference.sh naf_50
-bash inference.sh naf_200
-
-bash inference.sh tensorf_50
-bash inference.sh tensorf_200
-
-bash inference.sh ASD_POCS_50
-bash inference.sh ASD_POCS_200
-
-bash inference.sh intratomo_50
-bash inference.sh intratomo_200
-
-# bash inference.sh SART_50
-# bash inference.sh SART_200
-
-# bash inference.sh r2_gaussian_50
-# bash inference.sh r2_gaussian_200
\ No newline at end of file
+export SD_MODEL_NAME="stable-diffusion-v1-5/stable-diffusion-v1-5"
+export FT_VAE_NAME="../STEP1-AutoEncoderModel/klvae/logs/klvae/checkpoint-150000"
+export CKPT_EPOCH="50000"
+
+# NOTE: every worker claims cases of ALL datasets below through lock files (`ct_care.lock`),
+#   so the GPUs stay busy until the whole sweep is done. More workers (other nodes on the
+#   same shared storage) can join at any time; claims of crashed workers expire after `--lock_timeout`
+#   and are redone by the workers still waiting for the last cases.
+DATASETS="nerf_50 nerf_200 FDK_50 FDK_200 Lineformer_50 Lineformer_200 naf_50 naf_200 tensorf_50 tensorf_200 ASD_POCS_50 ASD_POCS_200 intratomo_50 intratomo_200"
+# DATASETS="$DATASETS SART_50 SART_200 r2_gaussian_50 r2_gaussian_200"
+GPUS=${GPUS:-"0 1 2 3"}
+
+for GPU in $GPUS; do
+  CUDA_VISIBLE_DEVICES=$GPU python -W ignore testEnhanceCTPipeline.py \
+    --queue \
+    --datasets $DATASETS \
+    --input_path "../ReconstructionPipeline/BDMAP_O_{dataset}" \
+    --output_path "../ReconstructionPipeline/BDMAP_O_{dataset}" \
+    --finetuned_vae_name_or_path=$FT_VAE_NAME \
+    --finetuned_unet_name_or_path="logs/{dataset}/checkpoint-$CKPT_EPOCH" \
+    --sd_model_name_or_path=$SD_MODEL_NAME &
+done
+wait
+
+# the sequential version:
+# bash inference.sh nerf_50
+# bash inference.sh nerf_200
+# ...
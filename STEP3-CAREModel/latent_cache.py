@@ -0,0 +1,138 @@
+"""
+On-disk cache of the VAE latents of the input windows (`cond_latents`), for `testEnhanceCTPipeline.py --latent_cache_dir`.
+
+Sweeps over UNet checkpoints, samplers or step counts re-encode the same inputs with the
+same VAE. Here every case gets one store, keyed by the content hash of the input NIfTI,
+the VAE (checkpoint path and the size / mtime of its weight files, quantization, dtype)
+and the resize settings:
+
+    <cache_dir>/<bdmap_id>_<key>/meta.json          settings of the key, last use
+    <cache_dir>/<bdmap_id>_<key>/latents.npy        (Z C h w) float16, memory-mapped, row = first slice of the window
+    <cache_dir>/<bdmap_id>_<key>/window_class.npy   (Z,) int8 index in `dataset.WINDOW_CLASSES`, -1: not cached
+
+Windows found in the store are neither read from the NIfTI nor VAE-encoded. The least
+recently used stores are evicted when the cache grows over `max_gb`; stores used in the
+last `min_idle_seconds`, by any process sharing the cache directory, are kept.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+def file_sha1(path, chunk_size=16 << 20):
+    """Hash of the compressed file content, much cheaper than decoding it."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def weights_stamp(path):
+    """(file, size, mtime) of the weight files under `path` (or of the file), a checkpoint re-trained in place gets a new stamp."""
+    if os.path.isfile(path):
+        return [(os.path.basename(path), os.path.getsize(path), os.path.getmtime(path))]
+    return sorted((os.path.relpath(os.path.join(root, name), path), os.path.getsize(os.path.join(root, name)),
+                   os.path.getmtime(os.path.join(root, name)))
+                  for root, _, names in os.walk(path) for name in names)   # NOTE: [] for a hub model id
+
+
+def _dir_bytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class CaseLatents:
+    """The latent store of ONE case. `latents.npy` is allocated with the first window put into it."""
+    def __init__(self, cache, store_dir, z_shape):
+        self.cache = cache
+        self.store_dir = store_dir
+        self.z_shape = z_shape
+        self.latents = None
+        self.last_touch = time.time()
+        latents_path = os.path.join(store_dir, "latents.npy")
+        classes_path = os.path.join(store_dir, "window_class.npy")
+        if os.path.exists(classes_path) and os.path.exists(latents_path):
+            self.window_class = np.load(classes_path, mmap_mode="r+")
+            self.latents = np.load(latents_path, mmap_mode="r+")
+        else:
+            self.window_class = np.lib.format.open_memmap(classes_path, mode="w+", dtype=np.int8, shape=(z_shape,))
+            self.window_class[:] = -1
+
+    def touch(self, interval=60):
+        """Mark the store as used (the mtime of `meta.json`), so that no other process evicts it meanwhile."""
+        if time.time() - self.last_touch >= interval:
+            os.utime(os.path.join(self.store_dir, "meta.json"))
+            self.last_touch = time.time()
+
+    def get(self, slice_idx):
+        """(N C h w) float16 latents of the windows starting at `slice_idx`."""
+        assert (self.window_class[slice_idx] >= 0).all()
+        self.touch()
+        return np.asarray(self.latents[slice_idx])
+
+    def put(self, slice_idx, latents, window_class):
+        """Store (N C h w) `latents` and the class indices of the windows starting at `slice_idx`."""
+        if self.latents is None:
+            shape = (self.z_shape,) + latents.shape[1:]
+            self.cache.evict(reserve_bytes=np.prod(shape) * 2)
+            self.latents = np.lib.format.open_memmap(os.path.join(self.store_dir, "latents.npy"), mode="w+",
+                                                     dtype=np.float16, shape=shape)
+        self.latents[slice_idx] = latents
+        self.window_class[slice_idx] = window_class     # NOTE: after the latents, a window is only valid once both are set
+        self.touch()
+
+    def close(self):
+        for array in (self.latents, self.window_class):
+            if array is not None:
+                array.flush()
+        self.touch(interval=0)
+        self.cache.in_use.discard(self.store_dir)
+
+
+class LatentCache:
+    """Directory of per-case latent stores, evicted least recently used first above `max_gb`.
+
+    Stores used in the last `min_idle_seconds` may be memory-mapped by another enhancer on the
+    same directory (`--queue`) and are never evicted; open stores refresh their last use.
+    """
+    def __init__(self, cache_dir, max_gb=20., min_idle_seconds=3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_gb * 2 ** 30
+        self.min_idle_seconds = min_idle_seconds
+        self.in_use = set()     # stores opened by this process, never evicted
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def open(self, bdmap_id, file_path, z_shape, settings):
+        """The store of `file_path` encoded with `settings` (VAE, resize), created if needed."""
+        key = dict(input_sha1=file_sha1(file_path), z_shape=z_shape, **settings)
+        key_hash = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        store_dir = os.path.join(self.cache_dir, f"{bdmap_id}_{key_hash}")
+        os.makedirs(store_dir, exist_ok=True)
+        meta_path = os.path.join(store_dir, "meta.json")
+        with open(meta_path + ".part", "w") as f:
+            json.dump({"key": key, "last_used": time.time()}, f, indent=2, default=str)
+        os.replace(meta_path + ".part", meta_path)  # NOTE: its mtime is the last use, for the LRU eviction
+        self.in_use.add(store_dir)
+        return CaseLatents(self, store_dir, z_shape)
+
+    def evict(self, reserve_bytes=0):
+        """Delete the least recently used stores until `reserve_bytes` more fit under the size cap."""
+        stores = []
+        for entry in os.scandir(self.cache_dir):
+            meta_path = os.path.join(entry.path, "meta.json")
+            if entry.is_dir() and not entry.name.endswith(".trash") and os.path.exists(meta_path):
+                stores.append((os.path.getmtime(meta_path), entry.path, _dir_bytes(entry.path)))
+        total = sum(nbytes for _, _, nbytes in stores)
+        for last_used, store_dir, nbytes in sorted(stores):
+            if total + reserve_bytes <= self.max_bytes:
+                break
+            if store_dir in self.in_use or time.time() - last_used < self.min_idle_seconds:
+                continue
+            trash_dir = store_dir + ".trash"
+            os.rename(store_dir, trash_dir)     # atomic, as `SlabCheckpoint.remove`
+            shutil.rmtree(trash_dir, ignore_errors=True)
+            total -= nbytes
@@ -0,0 +1,127 @@
+import os
+import resource
+import threading
+import time
+
+import torch
+
+GB = 2 ** 30
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def in_use_bytes(device):
+    """Memory held by this process: allocated CUDA memory, or the resident set size on CPU."""
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    return _rss_bytes()
+
+
+def peak_memory_bytes(device):
+    """Peak memory of this process so far: allocated CUDA memory, or the peak resident set size on CPU."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024    # KB on Linux
+
+
+def measure_peak_bytes(fn, device):
+    """Peak memory of `fn()` above the memory in use before the call."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    # NOTE: on CPU the resident set size is sampled by a thread while `fn` runs
+    base = _rss_bytes()
+    peak = [base]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], _rss_bytes())
+            time.sleep(0.002)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn()
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak[0], _rss_bytes()) - base
+
+
+@torch.no_grad()
+def fit_memory_cost(fn, device, sizes=(1, 2)):
+    """Peak memory of `fn(n)` as `fixed + per_sample * n`, from two probes."""
+    peaks = [measure_peak_bytes(lambda: fn(n), device) for n in sizes]
+    per_sample = max((peaks[1] - peaks[0]) / (sizes[1] - sizes[0]), 0.)
+    fixed = max(peaks[0] - per_sample * sizes[0], 0.)
+    return fixed, per_sample
+
+
+def plan_batch_sizes(pipe, max_memory_gb, max_batch_size=64, max_vae_batch_size=None, guidance=True, 
+                     resolution=512, safety=0.9):
+    """Largest denoising batch and VAE slice that keep the process under `max_memory_gb`.
+
+    The UNet, VAE encoder and VAE decoder are probed with 1 and 2 samples of `resolution`
+    (an int, or the (H W) of the largest input) on the pipeline's device and dtype. The UNet
+    batch (doubled by classifier-free guidance when `guidance`) takes whatever the weights
+    leave, up to `max_batch_size`; the VAE then encodes / decodes `vae_batch_size` images
+    per call (at most `max_vae_batch_size`), and when even one image does not fit, in tiles.
+    The plan is applied to `pipe` (`vae_batch_size`, VAE tiling) and returned.
+    """
+    device, dtype = pipe.device, pipe.unet.dtype
+    budget = max_memory_gb * GB * safety - in_use_bytes(device)     # weights (and anything else) are already loaded
+    height, width = (resolution, resolution) if isinstance(resolution, int) else resolution
+    latent_height, latent_width = height // pipe.vae_scale_factor, width // pipe.vae_scale_factor
+    unet_samples = 2 if guidance else 1
+    prompt_embeds = next(iter(pipe._prompt_cache.values()))[0].to(device, dtype)
+    timestep = torch.tensor([pipe.scheduler.config.num_train_timesteps // 2], device=device)
+
+    def run_unet(n):
+        sample = torch.randn(n * unet_samples, pipe.unet.config.in_channels, latent_height, latent_width, device=device, dtype=dtype)
+        pipe.unet(sample, timestep, encoder_hidden_states=prompt_embeds.expand(len(sample), -1, -1), return_dict=False)
+
+    def run_encode(n):
+        pipe.vae.encode(torch.randn(n, 3, height, width, device=device, dtype=dtype)).latent_dist.sample()
+
+    def run_decode(n):
+        pipe.vae.decode(torch.randn(n, pipe.vae.config.latent_channels, latent_height, latent_width, device=device, dtype=dtype))
+
+    # what a batch keeps between the stages: input images, cond / noisy latents and the decoded float32 windows
+    kept_per_sample = (3 * height * width * (dtype.itemsize + 4)
+                       + 2 * pipe.vae.config.latent_channels * latent_height * latent_width * dtype.itemsize)
+    unet_fixed, unet_per_sample = fit_memory_cost(run_unet, device)
+    batch_size = min(max_batch_size, int((budget - unet_fixed) // (unet_per_sample + kept_per_sample)))
+    if batch_size < 1:
+        raise ValueError(f"--max_memory_gb {max_memory_gb}: the weights and one UNet step already need "
+                         f"{(max_memory_gb * GB * safety - budget + unet_fixed + unet_per_sample) / GB:.1f} GB")
+
+    vae_budget = budget - batch_size * kept_per_sample
+    encode_fixed, encode_per_sample = fit_memory_cost(run_encode, device)
+    decode_fixed, decode_per_sample = fit_memory_cost(run_decode, device)
+    vae_per_sample = max(encode_per_sample, decode_per_sample, 1.)
+    vae_batch_size = min(batch_size, max_vae_batch_size or batch_size, 
+                         int((vae_budget - max(encode_fixed, decode_fixed)) // vae_per_sample))
+    vae_tiling = vae_batch_size < 1
+    if vae_tiling:  # NOTE: the default tile is the whole 512x512 image, use quarters
+        pipe.vae.enable_tiling()
+        pipe.vae.tile_sample_min_size = min(height, width) // 2
+        pipe.vae.tile_latent_min_size = min(latent_height, latent_width) // 2
+        vae_batch_size = 1
+    pipe.vae_batch_size = vae_batch_size
+
+    plan = dict(batch_size=batch_size, vae_batch_size=vae_batch_size, vae_tiling=vae_tiling,
+                budget_gb=budget / GB, unet_gb_per_window=unet_per_sample / GB,
+                vae_gb_per_image=vae_per_sample / GB)
+    print("memory plan: " + ", ".join(f"{k} {v:.2f}" if isinstance(v, float) else f"{k} {v}" for k, v in plan.items()))
+    return plan
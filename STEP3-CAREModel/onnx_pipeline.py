@@ -0,0 +1,152 @@
+"""
+ONNX Runtime backend of the concat-input CARE pipeline: numpy + onnxruntime only, no torch / diffusers.
+
+The graphs and the phase embeddings are written by `export_onnx.py`:
+
+    <onnx_dir>/care_onnx.json       prompts, scheduler config, VAE scaling
+    <onnx_dir>/prompt_embeds.npz    cached (negative) prompt embeddings of the inference prompts
+    <onnx_dir>/unet/model.onnx      (sample 8ch, timestep, encoder_hidden_states) -> noise
+    <onnx_dir>/vae_encoder/model.onnx   image -> latent moments (mean, logvar)
+    <onnx_dir>/vae_decoder/model.onnx   unscaled latents -> image
+
+Only the DDIM sampler (eta = 0) is implemented, it is the default sampler of the enhancer.
+"""
+import json
+import os
+
+import numpy as np
+import onnxruntime as ort
+
+
+class NumpyDDIMScheduler:
+    """`diffusers.DDIMScheduler` (eta = 0, epsilon prediction) in numpy, built from the same config."""
+    def __init__(self, config):
+        self.config = config
+        num_train_timesteps = config["num_train_timesteps"]
+        if config["beta_schedule"] == "scaled_linear":
+            betas = np.linspace(config["beta_start"] ** 0.5, config["beta_end"] ** 0.5, num_train_timesteps, dtype=np.float32) ** 2
+        elif config["beta_schedule"] == "linear":
+            betas = np.linspace(config["beta_start"], config["beta_end"], num_train_timesteps, dtype=np.float32)
+        else:
+            raise NotImplementedError(f"beta_schedule {config['beta_schedule']}")
+        if config.get("prediction_type", "epsilon") != "epsilon":
+            raise NotImplementedError(f"prediction_type {config['prediction_type']}")
+        self.alphas_cumprod = np.cumprod(1. - betas, dtype=np.float32)
+        self.final_alpha_cumprod = np.float32(1.) if config.get("set_alpha_to_one", True) else self.alphas_cumprod[0]
+        self.timesteps = None
+
+    def set_timesteps(self, num_inference_steps):
+        num_train_timesteps = self.config["num_train_timesteps"]
+        spacing = self.config.get("timestep_spacing", "leading")
+        if spacing == "leading":
+            step_ratio = num_train_timesteps // num_inference_steps
+            timesteps = (np.arange(0, num_inference_steps) * step_ratio).round()[::-1] + self.config.get("steps_offset", 0)
+        elif spacing == "trailing":
+            step_ratio = num_train_timesteps / num_inference_steps
+            timesteps = np.round(np.arange(num_train_timesteps, 0, -step_ratio)) - 1
+        elif spacing == "linspace":
+            timesteps = np.linspace(0, num_train_timesteps - 1, num_inference_steps).round()[::-1]
+        else:
+            raise NotImplementedError(f"timestep_spacing {spacing}")
+        self.num_inference_steps = num_inference_steps
+        self.timesteps = timesteps.astype(np.int64)
+
+    def step(self, noise_pred, t, latents):
+        prev_t = t - self.config["num_train_timesteps"] // self.num_inference_steps
+        alpha_prod_t = self.alphas_cumprod[t]
+        alpha_prod_t_prev = self.alphas_cumprod[prev_t] if prev_t >= 0 else self.final_alpha_cumprod
+        pred_original_sample = (latents - np.sqrt(1 - alpha_prod_t) * noise_pred) / np.sqrt(alpha_prod_t)
+        return np.sqrt(alpha_prod_t_prev) * pred_original_sample + np.sqrt(1 - alpha_prod_t_prev) * noise_pred
+
+    def add_noise(self, original_samples, noise, t):
+        alpha_prod_t = self.alphas_cumprod[t]
+        return np.sqrt(alpha_prod_t) * original_samples + np.sqrt(1 - alpha_prod_t) * noise
+
+
+class OnnxCAREPipeline:
+    """DDIM (or one direct step) over ONNX Runtime CPU sessions, same arguments as `ConcatInputStableDiffusionPipeline`."""
+    def __init__(self, onnx_dir, num_threads=None, providers=("CPUExecutionProvider",)):
+        with open(os.path.join(onnx_dir, "care_onnx.json")) as f:
+            self.config = json.load(f)
+        embeds = np.load(os.path.join(onnx_dir, "prompt_embeds.npz"))
+        self.prompt_cache = {prompt: (embeds["prompt_embeds"][i:i + 1], embeds["negative_prompt_embeds"][i:i + 1])
+                             for i, prompt in enumerate(self.config["prompts"])}
+        self.scheduler = NumpyDDIMScheduler(self.config["scheduler_config"])
+        self.scaling_factor = self.config["scaling_factor"]
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.sessions = {name: ort.InferenceSession(os.path.join(onnx_dir, name, "model.onnx"), options, providers=list(providers))
+                         for name in ("unet", "vae_encoder", "vae_decoder")}
+        self.vae_batch_size = None  # images per VAE call (None: all), as `ConcatInputStableDiffusionPipeline.vae_batch_size`
+
+    def _run(self, name, **inputs):
+        return self.sessions[name].run(None, {k: np.ascontiguousarray(v) for k, v in inputs.items()})[0]
+
+    def get_cached_prompt_embeds(self, prompt):
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        return (np.concatenate([self.prompt_cache[p][0] for p in prompt]),
+                np.concatenate([self.prompt_cache[p][1] for p in prompt]))
+
+    def vae_encode(self, image, rng=None):
+        """Scaled latents of `image` (B 3 H W) in [-1, 1], sampled from the latent distribution."""
+        rng = np.random.default_rng() if rng is None else rng
+        latents = []
+        for chunk in np.array_split(image, max(1, int(np.ceil(len(image) / (self.vae_batch_size or len(image)))))):
+            mean, logvar = np.split(self._run("vae_encoder", image=chunk.astype(np.float32)), 2, axis=1)
+            std = np.exp(0.5 * np.clip(logvar, -30., 20.))
+            latents.append(mean + std * rng.standard_normal(mean.shape, dtype=np.float32))
+        return np.concatenate(latents) * self.scaling_factor
+
+    def vae_decode(self, latents):
+        """Images (B 3 H W) in [0, 1] of scaled `latents`."""
+        latents = latents / self.scaling_factor
+        images = [self._run("vae_decoder", latent=chunk.astype(np.float32))
+                  for chunk in np.array_split(latents, max(1, int(np.ceil(len(latents) / (self.vae_batch_size or len(latents))))))]
+        return np.clip(np.concatenate(images) / 2 + 0.5, 0., 1.)
+
+    def unet(self, sample, timestep, encoder_hidden_states):
+        return self._run("unet", sample=sample.astype(np.float32),
+                         timestep=np.full((len(sample),), timestep, dtype=np.int64),
+                         encoder_hidden_states=encoder_hidden_states.astype(np.float32))
+
+    def __call__(self, prompt, cond_latents, latents=None, num_inference_steps=50, guidance_scale=7.5,
+                 guidance_interval=None, strength=1.0, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        prompt_embeds, negative_prompt_embeds = self.get_cached_prompt_embeds(prompt)
+        guided_embeds = np.concatenate([negative_prompt_embeds, prompt_embeds])
+        do_classifier_free_guidance = guidance_scale > 1
+
+        self.scheduler.set_timesteps(num_inference_steps)
+        timesteps = self.scheduler.timesteps
+        noise = rng.standard_normal(cond_latents.shape, dtype=np.float32) if latents is None else latents
+        if strength < 1.0:  # img2img-style, as `ConcatInputStableDiffusionPipeline.get_timesteps`
+            init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+            timesteps = timesteps[max(num_inference_steps - init_timestep, 0):]
+            latents = self.scheduler.add_noise(cond_latents, noise, timesteps[0])
+        else:
+            latents = noise     # DDIM: init_noise_sigma is 1
+
+        for i, t in enumerate(timesteps):
+            do_guidance_step = do_classifier_free_guidance and (
+                guidance_interval is None or guidance_interval[0] <= i / len(timesteps) < guidance_interval[1])
+            if do_guidance_step:
+                sample = np.concatenate([np.concatenate([latents] * 2), np.concatenate([cond_latents] * 2)], axis=1)
+                noise_pred_uncond, noise_pred_text = np.split(self.unet(sample, t, guided_embeds), 2)
+                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+            else:
+                noise_pred = self.unet(np.concatenate([latents, cond_latents], axis=1), t, prompt_embeds)
+            latents = self.scheduler.step(noise_pred, t, latents)
+        return self.vae_decode(latents)
+
+    def predict_direct(self, prompt, cond_latents, latents=None, timestep=499, rng=None):
+        """One UNet pass at `timestep`, x0 from the predicted noise, then a VAE decode."""
+        rng = np.random.default_rng() if rng is None else rng
+        prompt_embeds, _ = self.get_cached_prompt_embeds(prompt)
+        latents = rng.standard_normal(cond_latents.shape, dtype=np.float32) if latents is None else latents
+        noise_pred = self.unet(np.concatenate([latents, cond_latents], axis=1), timestep, prompt_embeds)
+        alpha_prod_t = self.scheduler.alphas_cumprod[timestep]
+        latents_pred = (latents - np.sqrt(1 - alpha_prod_t) * noise_pred) / np.sqrt(alpha_prod_t)
+        return self.vae_decode(latents_pred)
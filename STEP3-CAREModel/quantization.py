@@ -0,0 +1,98 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, convert, get_default_qconfig, prepare, quantize_dynamic
+
+from dataset import CTDatasetInference, collate_fn_inference
+
+QUANTIZE_MODES = ["none", "dynamic", "static"]
+
+
+def quantize_dynamic_int8(model):
+    """int8 weights for every `nn.Linear` (attention / feed-forward), activations quantized on the fly."""
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def prepare_static_int8(model, backend="x86"):
+    """Wrap every `nn.Conv2d` / `nn.Linear` in QuantStub / DeQuantStub and attach observers.
+
+    The diffusers UNet and VAE cannot be traced (FX) and use functional ops between layers,
+    so each layer is quantized on its own: int8 in, int8 weights, float out. Run
+    calibration batches through `model`, then `convert_static_int8`.
+
+    NOTE: experimental. Nothing is fused, every layer pays a quantize / dequantize of its
+    activations, so this is often slower than float32; `quantize_dynamic_int8` is the
+    supported mode.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = get_default_qconfig(backend)
+
+    def wrap(module):
+        for name, child in module.named_children():
+            if isinstance(child, (nn.Conv2d, nn.Linear)):
+                wrapped = QuantWrapper(child)
+                wrapped.qconfig = qconfig
+                setattr(module, name, wrapped)
+            else:
+                wrap(child)
+
+    wrap(model)
+    return prepare(model, inplace=True)
+
+
+def convert_static_int8(model):
+    return convert(model, inplace=True)
+
+
+def get_calibration_batches(data_dir, bdmap_ids, image_transforms, num_windows=8, batch_size=8, slice_stride=1,
+                            native_resolution=False):
+    """Collated inference batches of `num_windows` evenly spaced windows of each case in `data_dir` (a `BDMAP_O_*` folder)."""
+    examples = []
+    for bdmap_id in bdmap_ids:
+        ct_dataset = CTDatasetInference(file_path=f"{data_dir}/{bdmap_id}/ct.nii.gz",
+                                        image_transforms=image_transforms,
+                                        cond_transforms=image_transforms,
+                                        slice_stride=slice_stride,
+                                        native_resolution=native_resolution)
+        window_indices = np.unique(np.linspace(0, len(ct_dataset) - 1, num_windows).round().astype(int))
+        examples += [ct_dataset[idx] for idx in window_indices]
+    by_shape = dict()   # one input shape per batch
+    for example in examples:
+        by_shape.setdefault(tuple(example["cond_pixel_values"].shape), []).append(example)
+    return [collate_fn_inference(group[i:i + batch_size]) for group in by_shape.values() 
+            for i in range(0, len(group), batch_size)]
+
+
+@torch.no_grad()
+def calibrate(pipe, batches, mode="sample", pipe_kwargs=None):
+    """Run the whole enhancement (VAE encode, denoising, VAE decode) on calibration batches."""
+    generate = pipe.predict_direct if mode == "direct" else pipe
+    for batch in batches:
+        cond_latents = pipe.vae_encode(batch["cond_pixel_values"].to(pipe.device, dtype=pipe.unet.dtype))
+        generate(prompt=batch["input_prompt"], latents=torch.randn_like(cond_latents), cond_latents=cond_latents,
+                 output_type="pt", **(pipe_kwargs or dict()))
+
+
+def quantize_pipeline(pipe, quantize, float_unet, float_vae, calibration_batches=None, mode="sample", pipe_kwargs=None):
+    """Set int8 copies of the float UNet and VAE on `pipe` (CPU, float32), the float models are kept as they are.
+
+    `quantize="dynamic"` only quantizes the linear layers; `"static"` (experimental, see
+    `prepare_static_int8`) also the convolutions, with activation ranges observed on
+    `calibration_batches` (see `get_calibration_batches`).
+    """
+    pipe.unet, pipe.vae = copy.deepcopy(float_unet), copy.deepcopy(float_vae)
+    if quantize == "dynamic":
+        quantize_dynamic_int8(pipe.unet)
+        quantize_dynamic_int8(pipe.vae)
+    elif quantize == "static":
+        assert calibration_batches, "static quantization needs calibration batches"
+        prepare_static_int8(pipe.unet)
+        prepare_static_int8(pipe.vae)
+        calibrate(pipe, calibration_batches, mode=mode, pipe_kwargs=pipe_kwargs)
+        convert_static_int8(pipe.unet)
+        convert_static_int8(pipe.vae)
+    else:
+        raise ValueError(f"unknown quantization {quantize}, one of {QUANTIZE_MODES[1:]}")
+    return pipe
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ReconstructionPipeline"))
+from nifti_writer import open_nifti_file
+
+
+class StreamingNiftiWriter:
+    """Write an int16 NIfTI volume slice by slice along z, without holding the volume in memory.
+
+    NIfTI stores voxels in Fortran order, so every axial slice is one contiguous block of
+    the file: the header is written first, then slices are appended in z order. The file
+    is written under a `.part` name and renamed when the last slice is written, so a
+    killed process never leaves a truncated `ct_care.nii.gz` behind.
+    `compresslevel` / `threads` are those of `nifti_writer.open_nifti_file`.
+    """
+    def __init__(self, save_path, shape, affine, header, compresslevel=1, threads=1):
+        self.save_path = save_path
+        self.tmp_path = save_path + ".part"
+        self.shape = tuple(shape)
+        self.num_written = 0
+        self.on_close = []  # called once the file is in place, e.g. `SlabCheckpoint.remove`
+
+        # same header as `nib.Nifti1Image(volume, affine, header)` + `set_data_dtype(np.int16)` would give
+        out_nii = nib.Nifti1Image(np.broadcast_to(np.int16(0), self.shape), affine, header)
+        out_nii.header.set_data_dtype(np.int16)
+        out_nii.update_header()
+        self.header = out_nii.header
+        self.header.set_slope_inter(1., 0.)
+        self.header["vox_offset"] = 0   # let nibabel place the data right after header and extensions
+        self.dtype = np.dtype(np.int16).newbyteorder(self.header.endianness)
+
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        self.fileobj = open_nifti_file(self.tmp_path, compresslevel, threads, compressed=save_path.endswith(".gz"))
+        self.header.write_to(self.fileobj)
+        self.fileobj.write(b"\x00" * (int(self.header["vox_offset"]) - self.fileobj.tell()))
+
+    def write_slice(self, ct_slice):
+        """Append the next axial slice, (H W) int16."""
+        assert ct_slice.shape == self.shape[:2], f"slice shape {ct_slice.shape} != volume shape {self.shape[:2]}"
+        self.fileobj.write(np.asarray(ct_slice, dtype=self.dtype).tobytes(order="F"))
+        self.num_written += 1
+
+    def close(self):
+        self.fileobj.close()
+        if self.num_written != self.shape[2]:
+            raise RuntimeError(f"{self.save_path}: only {self.num_written}/{self.shape[2]} slices were written")
+        os.replace(self.tmp_path, self.save_path)   # atomic
+        for callback in self.on_close:
+            callback()
+
+
+class AsyncSliceWriter:
+    """Compress and write the slices of a `StreamingNiftiWriter` in a background thread.
+
+    `write_slice` only blocks when `max_pending` slices are queued (reported as
+    `stall_seconds`), `close` returns at once and `join` waits until the file is in place.
+    """
+    def __init__(self, writer, max_pending=64):
+        self.writer = writer
+        self.shape = writer.shape
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.stall_seconds = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def on_close(self):
+        return self.writer.on_close
+
+    def _run(self):
+        while True:
+            ct_slice = self.queue.get()
+            try:
+                if ct_slice is None:
+                    if self.error is None:
+                        self.writer.close()
+                    return
+                if self.error is None:
+                    self.writer.write_slice(ct_slice)
+            except Exception as e:  # re-raised by `join`, keep draining so that producers never block
+                self.error = e
+
+    def write_slice(self, ct_slice):
+        tic = time.time()
+        self.queue.put(ct_slice)
+        self.stall_seconds += time.time() - tic
+
+    def close(self):
+        self.queue.put(None)
+
+    def join(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class VolumePrefetcher:
+    """Decode the upcoming input volumes ONCE, in background threads, to raw `.npy` files.
+
+    Slicing a `.nii.gz` proxy decompresses the stream up to the requested slice for every
+    window. Here volume `idx` is decoded at most `max_ahead` cases ahead of the case being
+    denoised (`advance`) and memory-mapped by the dataloader workers afterwards; `release`
+    deletes it when its case is done. A `None` file path is never decoded (e.g. latents cached).
+    """
+    def __init__(self, file_paths, decode_dir=None, max_ahead=2, num_threads=2):
+        self.file_paths = list(file_paths)
+        self.decode_dir = tempfile.mkdtemp(prefix="care_decoded_", dir=decode_dir)
+        self.decoded_paths = [os.path.join(self.decode_dir, f"{idx:05d}.npy") for idx in range(len(self.file_paths))]
+        self.max_ahead = max_ahead
+        self.current = 0
+        self.released = set()
+        self.closed = False
+        self.decode_seconds = 0.
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.thread = threading.Thread(target=self._schedule, daemon=True)
+        self.thread.start()
+
+    def _schedule(self):
+        for idx in range(len(self.file_paths)):
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or idx <= self.current + self.max_ahead)
+                if self.closed:
+                    return
+            self.pool.submit(self._decode, idx)
+
+    def _decode(self, idx):
+        if self.file_paths[idx] is None:
+            return
+        tic = time.time()
+        volume = np.asanyarray(nib.load(self.file_paths[idx]).dataobj)
+        tmp_path = self.decoded_paths[idx] + ".part"
+        with open(tmp_path, "wb") as f:
+            np.save(f, volume)
+        with self.condition:
+            if self.closed or idx in self.released:     # too late, the case was read from the `.nii.gz`
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, self.decoded_paths[idx])   # atomic, workers never see a partial file
+            self.decode_seconds += time.time() - tic
+
+    def advance(self, idx):
+        """Volume `idx` is being denoised, decode up to `idx + max_ahead`."""
+        with self.condition:
+            self.current = max(self.current, idx)
+            self.condition.notify_all()
+
+    def release(self, idx):
+        with self.condition:
+            self.released.add(idx)
+            if os.path.exists(self.decoded_paths[idx]):
+                os.remove(self.decoded_paths[idx])
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.pool.shutdown(wait=True)
+        shutil.rmtree(self.decode_dir, ignore_errors=True)
+
+
+class SlabCheckpoint:
+    """Sidecar store of the finished slices of ONE volume, to resume an interrupted run.
+
+    Finished int16 slices are saved next to the output in slabs of `slab_size` slices
+    (`slab_XXXXX.npy`, each written atomically), so at most one slab of work is lost.
+    The store is keyed by `key` (case, checkpoint and sampler settings): a store written
+    with other settings is discarded. `remove` deletes it once the final NIfTI is in place.
+    """
+    def __init__(self, sidecar_dir, key, slab_size=32):
+        self.sidecar_dir = sidecar_dir
+        self.key = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        self.slab_size = slab_size
+        self.buffer = []    # finished slices of the slab under construction
+
+        meta_path = os.path.join(sidecar_dir, "meta.json")
+        if os.path.isdir(sidecar_dir):
+            try:
+                with open(meta_path) as f:
+                    valid = json.load(f)["key"] == self.key
+            except (OSError, ValueError, KeyError):
+                valid = False
+            if not valid:   # other model or sampler settings
+                shutil.rmtree(sidecar_dir)
+        if not os.path.isdir(sidecar_dir):
+            os.makedirs(sidecar_dir)
+            with open(meta_path + ".part", "w") as f:
+                json.dump({"key": self.key, "settings": key}, f, indent=2, default=str)
+            os.replace(meta_path + ".part", meta_path)
+
+        # slabs written by previous runs, contiguous from the first slice
+        self.slabs = []     # (first slice, number of slices)
+        self.num_slices = 0
+        while os.path.exists(self._slab_path(self.num_slices)):
+            num_slab_slices = np.load(self._slab_path(self.num_slices), mmap_mode="r").shape[2]
+            self.slabs.append((self.num_slices, num_slab_slices))
+            self.num_slices += num_slab_slices
+
+    def _slab_path(self, first_slice):
+        return os.path.join(self.sidecar_dir, f"slab_{first_slice:05d}.npy")
+
+    def load(self):
+        """Yield the stored slices in z order, (H W) int16."""
+        for first_slice, _ in self.slabs:
+            slab = np.load(self._slab_path(first_slice))
+            for z in range(slab.shape[2]):
+                yield slab[:, :, z]
+
+    def add(self, ct_slice):
+        """Store the next finished slice, a slab is saved as soon as it is full."""
+        self.buffer.append(ct_slice)
+        if len(self.buffer) == self.slab_size:
+            slab_path = self._slab_path(self.num_slices)
+            with open(slab_path + ".part", "wb") as f:
+                np.save(f, np.stack(self.buffer, axis=2))
+            os.replace(slab_path + ".part", slab_path)  # atomic
+            self.slabs.append((self.num_slices, len(self.buffer)))
+            self.num_slices += len(self.buffer)
+            self.buffer = []
+
+    def remove(self):
+        trash_dir = self.sidecar_dir + ".trash"
+        if os.path.isdir(trash_dir):
+            shutil.rmtree(trash_dir)
+        os.rename(self.sidecar_dir, trash_dir)  # atomic, the store is gone even if the deletion is interrupted
+        shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+class SliceAccumulator:
+    """Blend overlapping 3-slice windows of ONE volume with a rolling buffer.
+
+    Only slices that still expect contributions from some window are kept (float32, on
+    the device of the windows). As soon as every window covering a slice is done, the
+    slice is normalized, converted to int16 and handed to the writer, so peak memory
+    depends on how far apart the in-flight windows are, not on the volume depth.
+
+    With a `checkpoint` (`SlabCheckpoint`), the slices stored by a previous run are
+    written first and the contributions of later windows to them are ignored.
+    """
+    def __init__(self, writer, window_starts, checkpoint=None):
+        self.writer = writer
+        self.height, self.width, self.z_shape = writer.shape
+        # number of windows that still have to contribute to each slice
+        self.pending = np.zeros(self.z_shape, dtype=np.int64)
+        np.add.at(self.pending, np.asarray(window_starts)[:, None] + np.arange(3)[None, :], 1)
+        self.slices = dict()    # slice index -> weighted sum, (H W) float32 tensor
+        self.weights = dict()   # slice index -> sum of weights
+        self.finished = dict()  # slice index -> int16 slice waiting for an earlier slice
+        self.next_slice = 0     # next slice to be written
+        self.checkpoint = checkpoint
+        if checkpoint is not None:  # resume
+            writer.on_close.append(checkpoint.remove)   # final NIfTI is in place, the partial results are obsolete
+            for ct_slice in checkpoint.load():
+                self.writer.write_slice(ct_slice)
+                self.next_slice += 1
+            self.pending[:self.next_slice] = 0
+        self.first_slice = self.next_slice  # slices before were restored from the checkpoint
+
+    def add(self, slice_idx, windows, channel_weights):
+        """Add N enhanced windows, (N 3 H W) tensor in [0, 1], starting at `slice_idx` (N,).
+
+        The overlapping windows are scatter-added in one go, then merged into the rolling buffer.
+        """
+        slice_idx = np.asarray(slice_idx)
+        channel_weights = np.asarray(channel_weights, dtype=np.float32)  # (N 3)
+        assert windows.shape[1:] == (3, self.height, self.width), f"window shape {tuple(windows.shape)}"
+        z = (slice_idx[:, None] + np.arange(3)[None, :]).flatten()     # slice of every frame, (N*3,)
+        frame_weights = torch.from_numpy(channel_weights).to(windows.device)
+        weighted = (windows.float() * frame_weights[:, :, None, None]).flatten(0, 1)  # weighting each frame
+        channel_weights = channel_weights.flatten()
+        keep = z >= self.first_slice    # frames of restored slices are dropped
+        if not keep.all():
+            z, channel_weights = z[keep], channel_weights[keep]
+            weighted = weighted[torch.from_numpy(keep).to(windows.device)]
+        if len(z) == 0:
+            return
+        z_min = z.min()
+        span = z.max() - z_min + 1
+
+        summed = torch.zeros((span, self.height, self.width), dtype=torch.float32, device=windows.device)
+        summed.index_add_(0, torch.from_numpy(z - z_min).to(windows.device), weighted)
+        summed_weights = np.bincount(z - z_min, weights=channel_weights, minlength=span)
+        counts = np.bincount(z - z_min, minlength=span)
+
+        for offset in np.nonzero(counts)[0]:
+            z_idx = int(z_min + offset)
+            if z_idx in self.slices:
+                self.slices[z_idx] += summed[offset]
+                self.weights[z_idx] += summed_weights[offset]
+            else:
+                self.slices[z_idx] = summed[offset].clone()
+                self.weights[z_idx] = summed_weights[offset]
+            self.pending[z_idx] -= counts[offset]
+            if self.pending[z_idx] == 0:
+                self.finished[z_idx] = self._finalize(z_idx)
+        self._flush()
+
+    def _finalize(self, z):
+        ct_slice = self.slices.pop(z) / self.weights.pop(z)
+        return ((ct_slice * 2 - 1) * 1000).to(torch.int16).cpu().numpy()    # [0, 1] --> [-1000, 1000]
+
+    def _flush(self):
+        while self.next_slice in self.finished:     # slices are written strictly in z order
+            ct_slice = self.finished.pop(self.next_slice)
+            self.writer.write_slice(ct_slice)
+            if self.checkpoint is not None:
+                self.checkpoint.add(ct_slice)
+            self.next_slice += 1
+
+    @property
+    def done(self):
+        return self.next_slice == self.z_shape
+
+    def close(self):
+        self.writer.close()
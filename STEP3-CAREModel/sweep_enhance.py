@@ -0,0 +1,267 @@
+"""
+Run a held-out subset of one reconstruction dataset through several settings of
+`testEnhanceCTPipeline.py` and report the speed of each setting together with the
+pixel-wise metrics (SSIM / PSNR / slice-to-slice flicker from `metric_utils`), relative to the first setting.
+With `--anatomy`, the enhanced CTs are also segmented (`step3_nnUNetPredict.py`) and the
+anatomy-aware metrics (NSD / clDice from `step5_calculateMetrics.py`) are reported.
+
+Every argument that is not listed below is forwarded to `testEnhanceCTPipeline.py`, e.g.:
+
+    python -W ignore sweep_enhance.py --sweep stride --dataset nerf_50 --max_cases 5 \
+        --finetuned_vae_name_or_path=$FT_VAE_NAME \
+        --finetuned_unet_name_or_path="logs/nerf_50/checkpoint-50000" \
+        --sd_model_name_or_path=$SD_MODEL_NAME
+
+    python -W ignore sweep_enhance.py --sweep sampler --dataset nerf_50 --anatomy --seg_checkpoint $CKPT_PATH ...
+"""
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+sys.path.append("../ReconstructionPipeline")
+from metric_utils import get_ssim_3d, get_psnr_3d, get_flicker_3d
+from step5_calculateMetrics import process_case, LARGE_LABEL, SMALL_LABEL, VESSEL_LABEL, NON_PDAC_LABEL, PDAC_LABEL, TUBULAR_LABEL
+
+
+SWEEPS = {  # sweep name -> {setting name: extra arguments of `testEnhanceCTPipeline.py`}
+    "stride": {
+        "stride1_uniform":      ["--slice_stride", "1", "--blending", "uniform"],  # NOTE: the default, 3x denoising
+        "stride1_center":       ["--slice_stride", "1", "--blending", "center"],
+        "stride1_center_only":  ["--slice_stride", "1", "--blending", "center_only"],
+        "stride2_uniform":      ["--slice_stride", "2", "--blending", "uniform"],
+        "stride2_center":       ["--slice_stride", "2", "--blending", "center"],
+        "stride3_uniform":      ["--slice_stride", "3", "--blending", "uniform"],  # every slice denoised once
+    },
+    "sampler": {
+        "ddim_50":          ["--scheduler", "ddim", "--num_inference_steps", "50"],  # NOTE: the default
+        "ddim_25":          ["--scheduler", "ddim", "--num_inference_steps", "25"],
+        "ddim_10":          ["--scheduler", "ddim", "--num_inference_steps", "10"],
+        "dpmsolver++_20":   ["--scheduler", "dpmsolver++", "--num_inference_steps", "20"],
+        "dpmsolver++_10":   ["--scheduler", "dpmsolver++", "--num_inference_steps", "10"],
+        "unipc_20":         ["--scheduler", "unipc", "--num_inference_steps", "20"],
+        "unipc_10":         ["--scheduler", "unipc", "--num_inference_steps", "10"],
+        "euler_30":         ["--scheduler", "euler", "--num_inference_steps", "30"],
+        "euler_20":         ["--scheduler", "euler", "--num_inference_steps", "20"],
+    },
+    "guidance": {
+        "cfg_7.5":          ["--guidance_scale", "7.5"],   # NOTE: the default, every step on a doubled batch
+        "no_cfg":           ["--guidance_scale", "1"],
+        "cfg_first_30":     ["--guidance_scale", "7.5", "--guidance_interval", "0", "0.3"],
+        "cfg_first_50":     ["--guidance_scale", "7.5", "--guidance_interval", "0", "0.5"],
+        "cfg_last_30":      ["--guidance_scale", "7.5", "--guidance_interval", "0.7", "1"],
+        "cfg_middle_40":    ["--guidance_scale", "7.5", "--guidance_interval", "0.3", "0.7"],
+    },
+    "strength": {
+        "strength_1.0":     ["--strength", "1.0"],  # NOTE: the default, from pure noise
+        "strength_0.7":     ["--strength", "0.7"],
+        "strength_0.5":     ["--strength", "0.5"],
+        "strength_0.3":     ["--strength", "0.3"],
+        "strength_0.2":     ["--strength", "0.2"],
+    },
+    "direct": {
+        "ddim_50":          ["--mode", "sample"],  # NOTE: the default
+        "direct_t499":      ["--mode", "direct", "--direct_timestep", "499"],   # as in training / validation
+        "direct_t299":      ["--mode", "direct", "--direct_timestep", "299"],
+        "direct_t699":      ["--mode", "direct", "--direct_timestep", "699"],
+        "direct_t999":      ["--mode", "direct", "--direct_timestep", "999"],
+    },
+    "quantize": {   # NOTE: CPU, pass e.g. --num_threads / --num_procs through to the enhancer
+        "float32":          ["--device", "cpu", "--dtype", "float32"],
+        "dynamic_int8":     ["--device", "cpu", "--dtype", "float32", "--quantize", "dynamic"],
+        "static_int8":      ["--device", "cpu", "--dtype", "float32", "--quantize", "static"],
+    },
+    "backend": {    # NOTE: CPU, pass `--onnx_dir` (ignored by the torch setting) through to the enhancer
+        "torch_cpu":        ["--device", "cpu", "--dtype", "float32"],
+        "onnx_cpu":         ["--device", "cpu", "--backend", "onnx"],
+    },
+    "resolution": {
+        "resize_512":       [],   # NOTE: the default, resized to 512x512 and back
+        "native":           ["--native_resolution"],
+    },
+    "warm_start": {  # NOTE: experimental, the windows of a lane restart from the previous one
+        "cold":             [],   # NOTE: the default, every window from pure noise
+        "warm_0.5":         ["--warm_start", "0.5"],
+        "warm_0.3":         ["--warm_start", "0.3"],
+        "warm_0.2":         ["--warm_start", "0.2"],
+    },
+    "early_stop": {
+        "all_steps":        [],   # NOTE: the default, every window runs every step
+        "converge_0.01":    ["--convergence_threshold", "0.01"],
+        "converge_0.005":   ["--convergence_threshold", "0.005"],
+        "converge_0.002":   ["--convergence_threshold", "0.002"],
+    },
+    "distill": {    # NOTE: the students of `train_distill.py --output_dir {student_dir}`, no 1-step student (epsilon UNet)
+        "teacher_ddim_50":  [],   # NOTE: the default
+        "student_4":        ["--finetuned_unet_name_or_path", "{student_dir}/student-4steps", "--scheduler", "ddim_trailing",
+                             "--num_inference_steps", "4", "--guidance_scale", "1"],
+        "student_2":        ["--finetuned_unet_name_or_path", "{student_dir}/student-2steps", "--scheduler", "ddim_trailing",
+                             "--num_inference_steps", "2", "--guidance_scale", "1"],
+    },
+    "background": {
+        "all_windows":      [],   # NOTE: the default, every window is denoised
+        "passthrough":      ["--skip_background", "--background_fill", "passthrough"],
+        "air":              ["--skip_background", "--background_fill", "air"],
+    },
+}
+ANATOMY_METRICS = {     # metric group -> column prefix and labels, same as `step5_calculateMetrics.py`
+    "large_nsd": LARGE_LABEL,
+    "small_nsd": SMALL_LABEL,
+    "vessel_cldice": VESSEL_LABEL,
+    "nonpdac_nsd": NON_PDAC_LABEL,
+    "pdac_nsd": PDAC_LABEL,
+    "tubular_cldice": TUBULAR_LABEL,
+}
+ANATOMY_COLUMNS = [f"{group}_{label}" for group, labels in ANATOMY_METRICS.items() for label in labels]
+
+
+def pixel_metrics(case):
+    """SSIM / PSNR / slice-to-slice flicker (HU) of one enhanced case, same normalization as `step2_extractAndpixelMetric.py`."""
+    case_id, pred_path, gt_path = case
+    image_pred = nib.load(pred_path).get_fdata() / 1000 / 2 + 0.5
+    gt_data = nib.load(gt_path).get_fdata() / 1000 / 2 + 0.5
+    ssim_3d = get_ssim_3d(image_pred.clip(0, 1), gt_data.clip(0, 1)) * 100
+    psnr_3d = get_psnr_3d(image_pred.clip(0, 1), gt_data.clip(0, 1))
+    flicker_hu = get_flicker_3d(image_pred.clip(0, 1), gt_data.clip(0, 1)) * 2000
+    return case_id, ssim_3d, psnr_3d, flicker_hu
+
+
+def run_setting(args, enhancer_args, setting_args, output_dir):
+    """Enhance the held-out subset with one setting, timing is written to `stats.csv`."""
+    cmd = [
+        sys.executable, "-W", "ignore", "testEnhanceCTPipeline.py",
+        "--input_path", os.path.join(args.data_root, f"BDMAP_O_{args.dataset}"),
+        "--output_path", output_dir,
+        "--split_csv", args.split_csv,
+        "--max_cases", str(args.max_cases),
+        "--stats_csv", os.path.join(output_dir, "stats.csv"),
+        "--overwrite",
+    ] + enhancer_args + [arg.format(student_dir=args.student_dir) for arg in setting_args]
+    print(" ".join(cmd))
+    subprocess.run(cmd, check=True)
+
+
+def segment_setting(args, output_dir):
+    """Segment the enhanced CTs of one setting into `pred_care.nii.gz` with the anatomy segmentator."""
+    stats = pd.read_csv(os.path.join(output_dir, "stats.csv"))
+    for case_id in stats["bdmap_id"]:   # nnUNet does not overwrite, predictions of a previous run are stale
+        pred_path = os.path.join(output_dir, case_id, "pred_care.nii.gz")
+        if os.path.exists(pred_path):
+            os.remove(pred_path)
+    cmd = [
+        sys.executable, "step3_nnUNetPredict.py", "--CARE",
+        "--pth", os.path.abspath(output_dir),
+        "--checkpoint", os.path.abspath(args.seg_checkpoint),
+        "--workers", str(args.workers),
+    ]
+    print(" ".join(cmd))
+    subprocess.run(cmd, check=True, cwd=args.data_root)
+
+
+def evaluate_setting(args, output_dir):
+    """Per-case speed and metrics of one setting."""
+    stats = pd.read_csv(os.path.join(output_dir, "stats.csv"))
+    cases = [(case_id,
+              os.path.join(output_dir, case_id, "ct_care.nii.gz"),
+              os.path.join(args.data_root, "BDMAP_O", case_id, "ct.nii.gz"))
+             for case_id in stats["bdmap_id"]]
+    with ProcessPoolExecutor(max_workers=args.workers) as exe:
+        metrics = pd.DataFrame(list(exe.map(pixel_metrics, cases)), columns=["bdmap_id", "ssim_3d", "psnr_3d", "flicker_hu"])
+    per_case = stats.merge(metrics, on="bdmap_id")
+    if args.anatomy:
+        cases = [(os.path.join(args.data_root, "BDMAP_O", case_id), True, output_dir) for case_id in stats["bdmap_id"]]
+        with ProcessPoolExecutor(max_workers=args.workers) as exe:
+            anatomy = pd.DataFrame(list(exe.map(process_case, cases)), columns=["bdmap_id"] + ANATOMY_COLUMNS)
+        per_case = per_case.merge(anatomy, on="bdmap_id")
+    return per_case
+
+
+def summarize(name, per_case):
+    summary = {
+        "setting": name,
+        "num_cases": len(per_case),
+        "num_slices": per_case["num_slices"].sum(),
+        "num_windows": per_case["num_windows"].sum(),
+        "seconds": per_case["seconds"].sum(),
+        "slices_per_sec": per_case["num_slices"].sum() / per_case["seconds"].sum(),
+        "ssim_3d": per_case["ssim_3d"].mean(),
+        "psnr_3d": per_case["psnr_3d"].mean(),
+        "flicker_hu": per_case["flicker_hu"].mean(),
+    }
+    if "peak_memory_gb" in per_case:
+        summary["peak_memory_gb"] = per_case["peak_memory_gb"].max()
+    if "mean_steps_used" in per_case:
+        summary["mean_steps_used"] = per_case["mean_steps_used"].mean()
+    if "num_skipped_slices" in per_case:
+        summary["skipped_slice_fraction"] = per_case["num_skipped_slices"].sum() / per_case["num_slices"].sum()
+    for group, labels in ANATOMY_METRICS.items():  # mean over cases and labels, NaN (absent label) ignored
+        columns = [f"{group}_{label}" for label in labels]
+        if all(column in per_case for column in columns):
+            summary[group] = np.nanmean(per_case[columns].values)
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quality-versus-speed sweep of the CARE enhancer.")
+    parser.add_argument("--sweep", type=str, required=True, choices=list(SWEEPS.keys()))
+    parser.add_argument("--dataset", type=str, required=True, help="e.g. nerf_50, reads `BDMAP_O_{dataset}`.")
+    parser.add_argument("--data_root", type=str, default="../ReconstructionPipeline",
+                        help="Folder holding `BDMAP_O` (ground truth) and `BDMAP_O_{dataset}`.")
+    parser.add_argument("--split_csv", type=str, default="splits/BDMAP_O_AV_meta_test.csv")
+    parser.add_argument("--max_cases", type=int, default=5, help="Size of the held-out subset.")
+    parser.add_argument("--output_root", type=str, default="sweeps", help="Enhanced volumes of every setting.")
+    parser.add_argument("--report_dir", type=str, default="resultsCSVsweep")
+    parser.add_argument("--workers", type=int, default=8, help="Processes for metric computation.")
+    parser.add_argument("--skip_inference", action="store_true", help="Only (re-)compute the report.")
+    parser.add_argument("--anatomy", action="store_true", help="Also report NSD / clDice of the segmented CTs.")
+    parser.add_argument("--seg_checkpoint", type=str, default=os.environ.get("CKPT_PATH"),
+                        help="Anatomy segmentator folder, for `--anatomy`.")
+    parser.add_argument("--student_dir", type=str, default=None, help="Output folder of `train_distill.py`, for `--sweep distill`.")
+    return parser.parse_known_args()   # unknown arguments go to `testEnhanceCTPipeline.py`
+
+
+def main():
+    args, enhancer_args = parse_args()
+    if args.anatomy and not args.skip_inference:
+        assert args.seg_checkpoint is not None, "`--anatomy` needs `--seg_checkpoint` (or $CKPT_PATH)"
+    if args.sweep == "distill" and not args.skip_inference:
+        assert args.student_dir is not None, "`--sweep distill` needs `--student_dir`"
+    os.makedirs(args.report_dir, exist_ok=True)
+
+    summary, per_case_all = [], []
+    for name, setting_args in SWEEPS[args.sweep].items():
+        output_dir = os.path.join(args.output_root, f"{args.dataset}_{args.sweep}", name)
+        if not args.skip_inference:
+            run_setting(args, enhancer_args, setting_args, output_dir)
+            if args.anatomy:
+                segment_setting(args, output_dir)
+        per_case = evaluate_setting(args, output_dir)
+        per_case.insert(0, "setting", name)
+        per_case_all.append(per_case)
+        summary.append(summarize(name, per_case))
+
+    summary = pd.DataFrame(summary)
+    reference = summary.iloc[0]     # NOTE: the first setting of a sweep is the reference
+    summary["speedup"] = reference["seconds"] / summary["seconds"]
+    summary["delta_ssim_3d"] = summary["ssim_3d"] - reference["ssim_3d"]
+    summary["delta_psnr_3d"] = summary["psnr_3d"] - reference["psnr_3d"]
+    summary["delta_flicker_hu"] = summary["flicker_hu"] - reference["flicker_hu"]
+    for group in ANATOMY_METRICS:
+        if group in summary:
+            summary[f"delta_{group}"] = summary[group] - reference[group]
+
+    report_csv = os.path.join(args.report_dir, f"BDMAP_O_{args.dataset}_{args.sweep}.csv")
+    summary.to_csv(report_csv, index=False)
+    pd.concat(per_case_all).to_csv(report_csv.replace(".csv", "_per_case.csv"), index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary.round(3))
+    print(f"Sweep report saved to {report_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline, AutoencoderKL, UNet2DConditionModel
 
 from diffusers.utils.torch_utils import randn_tensor
-from diffusers import DDIMScheduler, DDPMScheduler
+from diffusers import DDIMScheduler, DDPMScheduler, DPMSolverMultistepScheduler, UniPCMultistepScheduler, EulerDiscreteScheduler
 import torch
 import torch.nn as nn
 from PIL import Image
@@ -13,9 +13,13 @@ import numpy as np
 from tqdm import tqdm
 import albumentations as A
 import argparse
+import shutil
+import subprocess
+import sys
+import time
 from torch.utils.data import Dataset
 
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from diffusers.callbacks import MultiPipelineCallbacks, PipelineCallback
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import retrieve_timesteps, StableDiffusionPipelineOutput
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img import retrieve_latents
@@ -23,7 +27,16 @@ from diffusers.utils import is_torch_xla_available
 from types import SimpleNamespace
 import cv2
 import safetensors
-from dataset import CTDatasetInference, collate_fn_inference
+from dataset import CTDatasetInference, collate_fn_inference, INFERENCE_PROMPTS, BLENDING_WEIGHTS, ShapeGroupedBatchSampler, \
+    LaneBatchSampler, WINDOW_CLASSES, get_padded_shape
+from streaming_volume import StreamingNiftiWriter, AsyncSliceWriter, SliceAccumulator, SlabCheckpoint, VolumePrefetcher
+from work_queue import CaseQueue
+from care_bundle import load_care_bundle, load_bundle_state_dict
+from memory_budget import plan_batch_sizes, peak_memory_bytes, GB
+from latent_cache import LatentCache, weights_stamp
+from quantization import QUANTIZE_MODES, quantize_pipeline, get_calibration_batches
+from tiny_decoder import load_tiny_decoder
+from nifti_writer import add_writer_args   # ../ReconstructionPipeline, on the path through `streaming_volume`
 
 import pandas as pd
 
@@ -136,6 +149,34 @@ class HWCarrayToCHWtensor(A.ImageOnlyTransform):
 #                 "slice_idx": slice_idx}
 
 
+# got these from latent diffusion code:
+def predict_start_from_noise(x_t, t, noise, alphas_cumprod):
+    def extract_into_tensor(a, t, x_shape):
+        b, *_ = t.shape
+        out = a.gather(-1, t)
+        return out.reshape(b, *((1,) * (len(x_shape) - 1)))
+    
+    sqrt_recip_alphas_cumprod = torch.sqrt(1. / alphas_cumprod)
+    sqrt_recipm1_alphas_cumprod = torch.sqrt(1. / alphas_cumprod - 1)
+    return (
+            extract_into_tensor(sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
+            extract_into_tensor(sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
+    )
+
+
+PER_SAMPLE_SCHEDULER_STATE = ("model_outputs", "last_sample")   # what the multistep samplers keep of earlier steps
+
+
+def prune_scheduler_state(scheduler, keep):
+    """Keep the samples `keep` (bool mask) in the per-sample state of a (multistep) scheduler."""
+    for name in PER_SAMPLE_SCHEDULER_STATE:
+        value = getattr(scheduler, name, None)
+        if torch.is_tensor(value):
+            setattr(scheduler, name, value[keep])
+        elif isinstance(value, list):
+            setattr(scheduler, name, [v[keep] if torch.is_tensor(v) else v for v in value])
+
+
 def init_unet(pretrained_model_name_or_path, zero_cond_conv_in=False):
     # 加载预训练模型
     unet = UNet2DConditionModel.from_pretrained(
@@ -190,6 +231,80 @@ def init_unet(pretrained_model_name_or_path, zero_cond_conv_in=False):
 
 
 class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modified 3 lines lol
+    _prompt_cache = None    # prompt -> (prompt_embeds, negative_prompt_embeds), see `build_prompt_cache`
+    vae_batch_size = None   # images per VAE encode / decode call (None: all), see `memory_budget.plan_batch_sizes`
+    latent_decoder = None   # decodes instead of the VAE decoder, e.g. the preview decoder of `tiny_decoder.py`
+
+    @torch.no_grad()
+    def build_prompt_cache(self, prompts, negative_prompt=None):
+        """Run the text encoder ONCE for a fixed set of prompts (e.g. the two CT phases).
+
+        Afterwards `__call__` gathers the cached rows for every prompt of a batch, so the 
+        text encoder never runs in the hot loop and can be released by `free_text_encoder`.
+        """
+        prompts = list(dict.fromkeys(prompts))  # unique, keep order
+        prompt_embeds, negative_prompt_embeds = self.encode_prompt(
+            prompts,
+            self._execution_device,
+            1,
+            True,   # always keep the negative embeddings, guidance may be turned on per call
+            negative_prompt=[negative_prompt] * len(prompts) if isinstance(negative_prompt, str) else negative_prompt,
+        )
+        self._prompt_cache = {
+            prompt: (prompt_embeds[i:i + 1], negative_prompt_embeds[i:i + 1]) for i, prompt in enumerate(prompts)
+        }
+        return self._prompt_cache
+
+    def get_cached_prompt_embeds(self, prompt):
+        """Gather `(prompt_embeds, negative_prompt_embeds)` rows of a batch of prompts from the cache."""
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        prompt_embeds = torch.cat([self._prompt_cache[p][0] for p in prompt])
+        negative_prompt_embeds = torch.cat([self._prompt_cache[p][1] for p in prompt])
+        return prompt_embeds, negative_prompt_embeds
+
+    def get_timesteps(self, num_inference_steps, strength):
+        """Last `strength` fraction of the schedule, same as `StableDiffusionImg2ImgPipeline.get_timesteps`."""
+        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+        t_start = max(num_inference_steps - init_timestep, 0)
+        timesteps = self.scheduler.timesteps[t_start * self.scheduler.order :]
+        if hasattr(self.scheduler, "set_begin_index"):
+            self.scheduler.set_begin_index(t_start * self.scheduler.order)
+        return timesteps, num_inference_steps - t_start
+
+    @classmethod
+    def from_care_bundle(cls, bundle_path, torch_dtype=None, device="cpu"):
+        """Pipeline from ONE CARE bundle file (`export_care_bundle.py`), without the SD checkpoint and text encoder.
+
+        Weights are read from the memory-mapped file straight onto `device` in `torch_dtype`,
+        the phase embeddings come with the bundle, so only cached prompts can be used.
+        """
+        components = load_care_bundle(bundle_path, torch_dtype=torch_dtype, device=device)
+        pipe = cls(vae=components["vae"], text_encoder=None, tokenizer=None, unet=components["unet"],
+                   scheduler=components["scheduler"], safety_checker=None, feature_extractor=None,
+                   requires_safety_checker=False)
+        pipe._prompt_cache = components["prompt_cache"]
+        return pipe
+
+    def vae_encode(self, image):
+        """Scaled latents of `image`, `vae_batch_size` images per VAE call."""
+        latents = [self.vae.encode(chunk).latent_dist.sample() for chunk in image.split(self.vae_batch_size or len(image))]
+        return torch.cat(latents) * self.vae.config.scaling_factor
+
+    def vae_decode(self, latents, generator=None):
+        """Images of scaled `latents`, `vae_batch_size` latents per VAE call (`latent_decoder` if set)."""
+        if self.latent_decoder is None:
+            decoder, latents = self.vae, latents / self.vae.config.scaling_factor
+        else:   # NOTE: the tiny decoder takes the scaled latents
+            decoder = self.latent_decoder
+        return torch.cat([decoder.decode(chunk, return_dict=False, generator=generator)[0]
+                          for chunk in latents.split(self.vae_batch_size or len(latents))])
+
+    def free_text_encoder(self):
+        """Drop the text encoder after warm-up, only cached prompts can be used afterwards."""
+        self.text_encoder = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     # NOTE: COPIED from diffusers repo
     @torch.no_grad()
     # @replace_example_docstring(EXAMPLE_DOC_STRING)
@@ -202,12 +317,17 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
         timesteps: List[int] = None,
         sigmas: List[float] = None,
         guidance_scale: float = 7.5,
+        guidance_interval: Optional[Tuple[float, float]] = None,    # NOTE: added for skipping CFG on most steps
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_images_per_prompt: Optional[int] = 1,
         eta: float = 0.0,
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         latents: Optional[torch.Tensor] = None,
         cond_latents = None, # NOTE: added for concating a image's latents
+        strength: float = 1.0,  # NOTE: added for starting from the noised `cond_latents`
+        init_latents: Optional[torch.Tensor] = None,    # NOTE: added, noised instead of `cond_latents` (warm start)
+        convergence_threshold: Optional[float] = None,  # NOTE: added, per-sample early stopping
+        convergence_min_steps: int = 10,
         prompt_embeds: Optional[torch.Tensor] = None,
         negative_prompt_embeds: Optional[torch.Tensor] = None,
         ip_adapter_image = None,
@@ -247,6 +367,10 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
             guidance_scale (`float`, *optional*, defaults to 7.5):
                 A higher guidance scale value encourages the model to generate images closely linked to the text
                 `prompt` at the expense of lower image quality. Guidance scale is enabled when `guidance_scale > 1`.
+            guidance_interval (`Tuple[float, float]`, *optional*):
+                Only apply classifier-free guidance on the steps whose position in the schedule, `step / num_steps`,
+                lies in `[start, end)`, e.g. `(0.0, 0.3)` for the first 30% of the steps. The other steps run the
+                UNet on the conditional batch only (half the batch size). If not defined, every step is guided.
             negative_prompt (`str` or `List[str]`, *optional*):
                 The prompt or prompts to guide what to not include in image generation. If not defined, you need to
                 pass `negative_prompt_embeds` instead. Ignored when not using guidance (`guidance_scale < 1`).
@@ -264,6 +388,20 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 tensor is generated by sampling using the supplied random `generator`.
             cond_latents (`torch.Tensor`):
                 Pre-generated latents of the target image. Used to guide diffusion process for controlable generation.
+            strength (`float`, *optional*, defaults to 1.0):
+                Img2img-style partial denoising. When `strength < 1`, `cond_latents` are noised (with `latents` as the
+                noise, if given) to the timestep at `strength` of the schedule and only the remaining
+                `int(num_inference_steps * strength)` steps are run. `1.0` starts from pure noise as before.
+            init_latents (`torch.Tensor`, *optional*):
+                Latents noised instead of `cond_latents` when `strength < 1`, e.g. the final latents of the
+                neighbouring window (`--warm_start`).
+            convergence_threshold (`float`, *optional*):
+                Per-sample early stopping. After `convergence_min_steps` steps, a sample whose predicted x0 changed
+                by less than this fraction (mean absolute change over mean absolute value) since the previous step
+                stops with that x0 and leaves the batch, the other samples go on with a smaller UNet batch. The
+                steps used by every sample are kept in `self.steps_used`. If not defined, every step is run.
+            convergence_min_steps (`int`, *optional*, defaults to 10):
+                Steps every sample runs before it may stop.
             prompt_embeds (`torch.Tensor`, *optional*):
                 Pre-generated text embeddings. Can be used to easily tweak text inputs (prompt weighting). If not
                 provided, text embeddings are generated from the `prompt` input argument.
@@ -343,8 +481,17 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 else self.unet.config.sample_size[1]
             )
             height, width = height * self.vae_scale_factor, width * self.vae_scale_factor
+        if cond_latents is not None:    # NOTE: the output size follows the condition, e.g. at native resolution
+            height, width = cond_latents.shape[-2] * self.vae_scale_factor, cond_latents.shape[-1] * self.vae_scale_factor
         # to deal with lora scaling and other possible forward hooks
 
+        # 0.1 Gather pre-computed text embeddings if all prompts of the batch are cached
+        if (self._prompt_cache is not None and prompt is not None and prompt_embeds is None 
+                and negative_prompt is None and negative_prompt_embeds is None 
+                and all(p in self._prompt_cache for p in ([prompt] if isinstance(prompt, str) else prompt))):
+            prompt_embeds, negative_prompt_embeds = self.get_cached_prompt_embeds(prompt)
+            prompt = None
+
         # 1. Check inputs. Raise error if not correct
         self.check_inputs(
             prompt,
@@ -359,6 +506,15 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
             callback_on_step_end_tensor_inputs,
         )
 
+        if guidance_interval is not None and (ip_adapter_image is not None or ip_adapter_image_embeds is not None):
+            raise ValueError("`guidance_interval` is not supported together with IP-Adapter.")
+        if convergence_threshold is not None and (ip_adapter_image is not None or ip_adapter_image_embeds is not None 
+                                                  or callback_on_step_end is not None):
+            raise ValueError("`convergence_threshold` is not supported together with IP-Adapter or `callback_on_step_end`.")
+
+        if not 0 < strength <= 1:
+            raise ValueError(f"The value of strength should in (0.0, 1.0] but is {strength}")
+
         self._guidance_scale = guidance_scale
         self._guidance_rescale = guidance_rescale
         self._clip_skip = clip_skip
@@ -411,19 +567,28 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
         timesteps, num_inference_steps = retrieve_timesteps(
             self.scheduler, num_inference_steps, device, timesteps, sigmas
         )
+        if strength < 1.0:
+            timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength)
 
         # 5. Prepare latent variables
         num_channels_latents = self.unet.config.in_channels
-        latents = self.prepare_latents(
-            batch_size * num_images_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            prompt_embeds.dtype,
-            device,
-            generator,
-            latents,
-        )
+        if strength < 1.0:  # NOTE: the degraded CT's latents, noised to the first remaining timestep
+            init_latents = cond_latents if init_latents is None else init_latents.to(device, cond_latents.dtype)
+            noise = latents if latents is not None else randn_tensor(
+                cond_latents.shape, generator=generator, device=device, dtype=cond_latents.dtype)
+            latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
+            latents = self.scheduler.add_noise(init_latents, noise.to(device, cond_latents.dtype), latent_timestep)
+        else:
+            latents = self.prepare_latents(
+                batch_size * num_images_per_prompt,
+                num_channels_latents,
+                height,
+                width,
+                prompt_embeds.dtype,
+                device,
+                generator,
+                latents,
+            )
 
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
@@ -443,6 +608,17 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 guidance_scale_tensor, embedding_dim=self.unet.config.time_cond_proj_dim
             ).to(device=device, dtype=latents.dtype)
 
+        # 6.3 Conditional half of the text embeddings, for the steps without guidance
+        prompt_embeds_cond = prompt_embeds.chunk(2)[1] if self.do_classifier_free_guidance else prompt_embeds
+
+        # 6.4 Per-sample early stopping (NOTE: added): converged samples leave the batch, see `convergence_threshold`
+        stop_early = convergence_threshold is not None
+        active = torch.arange(latents.shape[0], device=device)     # samples still denoised
+        steps_used = torch.full((latents.shape[0],), len(timesteps), dtype=torch.long)
+        final_latents = torch.empty_like(latents) if stop_early else None
+        alphas_cumprod = self.scheduler.alphas_cumprod.to(device, torch.float32)
+        prev_x0 = None
+
         # 7. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         self._num_timesteps = len(timesteps)
@@ -451,16 +627,18 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 if self.interrupt:
                     continue
 
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
-                cond_latent_input = torch.cat([cond_latents] * 2) if self.do_classifier_free_guidance else cond_latents  # NOTE: added
+                # expand the latents if we are doing classifier free guidance (on this step)
+                do_guidance_step = self.do_classifier_free_guidance and (
+                    guidance_interval is None or guidance_interval[0] <= i / len(timesteps) < guidance_interval[1])
+                latent_model_input = torch.cat([latents] * 2) if do_guidance_step else latents
+                cond_latent_input = torch.cat([cond_latents] * 2) if do_guidance_step else cond_latents  # NOTE: added
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                 # predict the noise residual
                 noise_pred = self.unet(
                     torch.cat([latent_model_input, cond_latent_input], dim=1),   # NOTE: concate input!!!
                     t,
-                    encoder_hidden_states=prompt_embeds,
+                    encoder_hidden_states=prompt_embeds if do_guidance_step else prompt_embeds_cond,
                     timestep_cond=timestep_cond,
                     cross_attention_kwargs=self.cross_attention_kwargs,
                     added_cond_kwargs=added_cond_kwargs,
@@ -468,17 +646,38 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 )[0]
 
                 # perform guidance
-                if self.do_classifier_free_guidance:
+                if do_guidance_step:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-                if self.do_classifier_free_guidance and self.guidance_rescale > 0.0:
+                if do_guidance_step and self.guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
                     noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=self.guidance_rescale)
 
                 # compute the previous noisy sample x_t -> x_t-1
                 latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
 
+                if stop_early:  # NOTE: added, x0 predicted at this step vs the previous one
+                    t_idx = t.float().round().long().to(device).expand(len(latents))
+                    x0 = predict_start_from_noise(latent_model_input[-len(latents):].float(), t_idx, noise_pred.float(), alphas_cumprod)
+                    if prev_x0 is not None and convergence_min_steps <= i + 1 < len(timesteps):
+                        change = (x0 - prev_x0).flatten(1).abs().mean(1) / prev_x0.flatten(1).abs().mean(1).clamp_min(1e-6)
+                        converged = change < convergence_threshold
+                        if converged.any():
+                            final_latents[active[converged]] = x0[converged].to(final_latents.dtype)
+                            steps_used[active[converged].cpu()] = i + 1
+                            keep = ~converged
+                            active, latents, cond_latents, x0 = active[keep], latents[keep], cond_latents[keep], x0[keep]
+                            prompt_embeds_cond = prompt_embeds_cond[keep]
+                            if self.do_classifier_free_guidance:
+                                prompt_embeds = torch.cat([prompt_embeds.chunk(2)[0][keep], prompt_embeds_cond])
+                            if timestep_cond is not None:
+                                timestep_cond = timestep_cond[keep]
+                            prune_scheduler_state(self.scheduler, keep)
+                            if len(active) == 0:
+                                break
+                    prev_x0 = x0
+
                 if callback_on_step_end is not None:
                     callback_kwargs = {}
                     for k in callback_on_step_end_tensor_inputs:
@@ -499,10 +698,13 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
+        if stop_early:
+            final_latents[active] = latents
+            latents = final_latents
+        self.steps_used = steps_used    # NOTE: added, steps run for every sample
+
         if not output_type == "latent":
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False, generator=generator)[
-                0
-            ]
+            image = self.vae_decode(latents, generator=generator)   # NOTE: sliced, see `vae_batch_size`
             image, has_nsfw_concept = self.run_safety_checker(image, device, prompt_embeds.dtype)
         else:
             image = latents
@@ -522,137 +724,884 @@ class ConcatInputStableDiffusionPipeline(StableDiffusionPipeline):  # ONLY modif
 
         return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept)
 
+    @torch.no_grad()
+    def predict_direct(
+        self,
+        prompt: Union[str, List[str]] = None,
+        latents: Optional[torch.Tensor] = None,
+        cond_latents = None,
+        timestep: int = 499,
+        prompt_embeds: Optional[torch.Tensor] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        output_type: Optional[str] = "pil",
+        return_dict: bool = True,
+    ):
+        """One-step enhancement: ONE UNet pass at `timestep`, x0 from the predicted noise, then a VAE decode.
+
+        Same path as the "direct" validation images and the CARE loss of `train_text_to_image.py`:
+        `latents` (pure noise by default) are taken as x_t, no classifier-free guidance.
+        """
+        device = self._execution_device
+        if prompt_embeds is None:
+            if self._prompt_cache is not None and all(p in self._prompt_cache for p in ([prompt] if isinstance(prompt, str) else prompt)):
+                prompt_embeds, _ = self.get_cached_prompt_embeds(prompt)
+            else:
+                prompt_embeds, _ = self.encode_prompt(prompt, device, 1, False)
+        if latents is None:
+            latents = randn_tensor(cond_latents.shape, generator=generator, device=device, dtype=cond_latents.dtype)
+
+        t = torch.full((latents.shape[0],), timestep, dtype=torch.long, device=device)
+        noise_pred = self.unet(
+            torch.cat([latents, cond_latents], dim=1),   # NOTE: concate input!!!
+            t,
+            encoder_hidden_states=prompt_embeds.to(device),
+            return_dict=False,
+        )[0]
+        latents_pred = predict_start_from_noise(latents, t, noise_pred, self.scheduler.alphas_cumprod.to(device))   # SDSeg equation (2)
+        latents_pred = latents_pred.to(latents.dtype)
+
+        if not output_type == "latent":
+            image = self.vae_decode(latents_pred, generator=generator)
+            image = self.image_processor.postprocess(image, output_type=output_type, do_denormalize=[True] * image.shape[0])
+        else:
+            image = latents_pred
+
+        # Offload all models
+        self.maybe_free_model_hooks()
+
+        if not return_dict:
+            return (image, None)
+
+        return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=None)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Process input and output paths along with a BDMAP ID.")
-    parser.add_argument("--input_path", type=str, required=True, help="Path to the input directory.")
-    parser.add_argument("--output_path", type=str, required=True, help="Path to the output directory.")
-    parser.add_argument("--finetuned_vae_name_or_path", type=str, required=True, help="Path to the output directory.")
-    parser.add_argument("--finetuned_unet_name_or_path", type=str, required=True, help="Path to the output directory.")
-    parser.add_argument("--sd_model_name_or_path", type=str, required=True, help="Path to the output directory.")
-    parser.add_argument("--overwrite", action="store_true")
-    args = parser.parse_args()
 
-    """Method 1: StableDiffusionPipeline"""
-    # Setting up models in the pipeline.
-    finetuned_vae_name_or_path = args.finetuned_vae_name_or_path#"./VAE"
-    finetuned_unet_name_or_path = args.finetuned_unet_name_or_path#"./UNet"
-    # load vae
-    vae = AutoencoderKL.from_pretrained(
-            finetuned_vae_name_or_path, subfolder="vae", #revision=args.revision, variant=args.variant,
-            torch_dtype=torch.float16
+class OnnxPipelineAdapter:
+    """What `enhance_ct_volumes` uses of `ConcatInputStableDiffusionPipeline`, over an `onnx_pipeline.OnnxCAREPipeline`.
+
+    ONNX Runtime CPU sessions, float32: torch tensors are only converted at the boundary.
+    """
+    device = torch.device("cpu")
+    dtype = torch.float32
+
+    def __init__(self, onnx_pipe):
+        self.onnx_pipe = onnx_pipe
+
+    @property
+    def vae_batch_size(self):
+        return self.onnx_pipe.vae_batch_size
+
+    @vae_batch_size.setter
+    def vae_batch_size(self, vae_batch_size):
+        self.onnx_pipe.vae_batch_size = vae_batch_size
+
+    def vae_encode(self, image):
+        return torch.from_numpy(self.onnx_pipe.vae_encode(image.numpy()))
+
+    def __call__(self, prompt, latents, cond_latents, output_type="pt", **kwargs):
+        assert output_type == "pt", "the ONNX backend only returns images in [0, 1]"
+        images = self.onnx_pipe(prompt, cond_latents.numpy(), latents=latents.numpy(), **kwargs)
+        return StableDiffusionPipelineOutput(images=torch.from_numpy(images), nsfw_content_detected=None)
+
+    def predict_direct(self, prompt, latents, cond_latents, output_type="pt", **kwargs):
+        assert output_type == "pt", "the ONNX backend only returns images in [0, 1]"
+        images = self.onnx_pipe.predict_direct(prompt, cond_latents.numpy(), latents=latents.numpy(), **kwargs)
+        return StableDiffusionPipelineOutput(images=torch.from_numpy(images), nsfw_content_detected=None)
+
+
+def load_onnx_pipeline(onnx_dir, num_threads=None):
+    from onnx_pipeline import OnnxCAREPipeline    # NOTE: onnxruntime is only needed by this backend
+    return OnnxPipelineAdapter(OnnxCAREPipeline(onnx_dir, num_threads=num_threads))
+
+
+def write_inference_stats(stats, output_csv):
+    """One row per enhanced case, e.g. for `sweep_enhance.py` to compute slices/sec."""
+    os.makedirs(os.path.dirname(os.path.abspath(output_csv)), exist_ok=True)
+    pd.DataFrame(stats).to_csv(output_csv, index=False)
+
+
+SCHEDULERS = {    # name -> (scheduler class, extra config)
+    "ddim": (DDIMScheduler, {}),
+    "ddim_trailing": (DDIMScheduler, {"timestep_spacing": "trailing"}),    # NOTE: starts at t=999, for the students of `train_distill.py`
+    "dpmsolver++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "solver_order": 2}),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "euler": (EulerDiscreteScheduler, {}),
+}
+
+
+def get_scheduler(name, scheduler_config):
+    """Sampler used for inference, built from the scheduler config of the SD checkpoint."""
+    scheduler_cls, extra_config = SCHEDULERS[name]
+    return scheduler_cls.from_config(scheduler_config, **extra_config)
+
+
+def get_cond_latents(pipe, cond_image, image_row, window_idx, bdmap_ids, slice_idx, window_class, latent_caches=None):
+    """Condition latents of the windows `window_idx` of a batch.
+
+    Windows in the latent cache (`latent_cache.CaseLatents`) are read from it, the others are
+    VAE-encoded from `cond_image` (row `image_row[idx]` of window `idx`) and stored in it.
+    Returns the latents and which windows came from the cache.
+    """
+    from_cache = np.array([latent_caches is not None and latent_caches[bdmap_ids[idx]].window_class[slice_idx[idx]] >= 0 
+                           for idx in window_idx], dtype=bool)
+    cond_latents = dict()   # window -> latent
+    encode_idx = window_idx[~from_cache]
+    if len(encode_idx) > 0:
+        encoded = pipe.vae_encode(cond_image[image_row[encode_idx]])
+        cond_latents.update(zip(encode_idx, encoded))
+        if latent_caches is not None:
+            encoded = encoded.to("cpu", torch.float16).numpy()
+            for bdmap_id in dict.fromkeys(bdmap_ids[idx] for idx in encode_idx):
+                rows = [row for row, idx in enumerate(encode_idx) if bdmap_ids[idx] == bdmap_id]
+                latent_caches[bdmap_id].put(slice_idx[encode_idx[rows]], encoded[rows],
+                                            [WINDOW_CLASSES.index(window_class[idx]) for idx in encode_idx[rows]])
+    read_idx = window_idx[from_cache]
+    for bdmap_id in dict.fromkeys(bdmap_ids[idx] for idx in read_idx):
+        case_idx = np.asarray([idx for idx in read_idx if bdmap_ids[idx] == bdmap_id])
+        latents = torch.from_numpy(latent_caches[bdmap_id].get(slice_idx[case_idx])).to(pipe.device, dtype=pipe.dtype)
+        cond_latents.update(zip(case_idx, latents))
+    return torch.stack([cond_latents[idx] for idx in window_idx]), from_cache
+
+
+def sample_warm_started(pipe, lanes, lane_ids, window_starts, prompt, cond_latents, warm_start, pipe_kwargs):
+    """Sample windows on `lane_ids`, each one restarting from the previous window of its lane.
+
+    `lanes` maps a lane to (first slice of its last window, final latents, noise) and is
+    updated in place. A window that shares slices with the last window of its lane (starts
+    less than 3 slices after it) starts from those latents, noised with the lane's noise to `warm_start` of the schedule (`strength`), and
+    only runs the remaining steps; the other windows are sampled from scratch.
+    Returns the images and the number of warm-started windows.
+    """
+    warm = np.array([lane in lanes and 0 < start - lanes[lane][0] < 3 for lane, start in zip(lane_ids, window_starts)], dtype=bool)
+    final = dict()
+
+    def keep_latents(pipe, step, timestep, callback_kwargs):     # the last call leaves the final latents
+        final["latents"] = callback_kwargs["latents"]
+        return callback_kwargs
+
+    images = [None] * len(lane_ids)
+    for is_warm in (False, True):
+        idx = np.flatnonzero(warm == is_warm)
+        if len(idx) == 0:
+            continue
+        kwargs = dict(pipe_kwargs)
+        if is_warm:
+            noise = torch.stack([lanes[lane_ids[i]][2] for i in idx])
+            kwargs.update(strength=warm_start, init_latents=torch.stack([lanes[lane_ids[i]][1] for i in idx]))
+        else:
+            noise = torch.randn_like(cond_latents[idx])
+        generated = pipe(prompt=[prompt[i] for i in idx], latents=noise, cond_latents=cond_latents[idx], output_type="pt",
+                         callback_on_step_end=keep_latents, **kwargs).images
+        for row, i in enumerate(idx):
+            images[i] = generated[row]
+            lanes[lane_ids[i]] = (window_starts[i], final["latents"][row], noise[row])
+    return torch.stack(images), int(warm.sum())
+
+
+def enhance_ct_volumes(pipe, ct_datasets, save_dir, chunk_size=16, num_workers=16, pipe_kwargs=None, mode="sample",
+                       checkpoints=None, prefetch_cases=2, decode_dir=None, max_pending_slices=64, writer_kwargs=None,
+                       skip_background=False, background_fill="passthrough", latent_caches=None, warm_start=None):
+    """Enhance many CT volumes through ONE dataloader (one persistent worker pool).
+
+    Slice triplets of all volumes are streamed back to back, so every batch is full 
+    except the very last one. Outputs are re-assembled by `(bdmap_id, slice_idx)` and 
+    each `ct_care.nii.gz` is written as soon as all triplets of its volume are done.
+    `pipe_kwargs` (sampler settings, e.g. `num_inference_steps`, `guidance_scale`) go to `pipe(...)`, 
+    or to `pipe.predict_direct(...)` (e.g. `timestep`) in the one-step `mode="direct"`.
+    `checkpoints` (bdmap_id -> `SlabCheckpoint`) keep finished slabs for resuming a case;
+    the datasets must already skip the slices restored from them.
+
+    Reading, denoising and writing overlap: the next `prefetch_cases` input volumes are 
+    decoded in background threads (`VolumePrefetcher`), and finished slices are compressed
+    and written by one writer thread per open volume (`AsyncSliceWriter`, at most
+    `max_pending_slices` queued, `writer_kwargs` e.g. `compresslevel` / `threads` go to
+    `StreamingNiftiWriter`). The time the denoising loop waits on either side is 
+    reported as read / write stall.
+    With `skip_background`, windows classified "empty" (`dataset.classify_window`) are not
+    denoised: the input is passed through (`background_fill="passthrough"`) or air is filled in.
+    With `latent_caches` (bdmap_id -> `latent_cache.CaseLatents`), cached condition latents are
+    reused and the datasets do not read their slices (`CTDatasetInference.cached_classes`).
+    With `warm_start` (experimental, sampling only), every volume is denoised in `chunk_size`
+    lanes of consecutive windows (`LaneBatchSampler`) and each window starts from the previous
+    window of its lane, see `sample_warm_started`.
+    With early stopping (`convergence_threshold` in `pipe_kwargs`), the sampler steps used per
+    slice (mean over its windows, 0: background) are written to `<case>/steps_used.csv`.
+    Returns per-case statistics (number of slices / windows / skipped slices, denoising and stall seconds).
+    """
+    pipe_kwargs = dict(num_inference_steps=50) if pipe_kwargs is None else pipe_kwargs
+    checkpoints = dict() if checkpoints is None else checkpoints
+    writer_kwargs = dict() if writer_kwargs is None else writer_kwargs
+    # volumes of the same input shape back to back, so that few batches are cut short (`ShapeGroupedBatchSampler`)
+    ct_datasets = sorted(ct_datasets, key=lambda ct_dataset: ct_dataset.input_shape or (0, 0))
+    ct_datasets = {ct_dataset.bdmap_id: ct_dataset for ct_dataset in ct_datasets}
+    volumes = dict()    # bdmap_id -> volume under construction
+    writers = []        # writer threads that may still be running
+    stage_seconds = {"read_stall": 0., "denoise": 0., "write_stall": 0.}
+    stats = []
+
+    def open_volume(bdmap_id):
+        ct_dataset = ct_datasets[bdmap_id]
+        print(bdmap_id, list(ct_dataset.ct_xyz_shape))
+        if prefetcher is not None:
+            prefetcher.advance(case_indices[bdmap_id])
+        writer = AsyncSliceWriter(StreamingNiftiWriter(os.path.join(save_dir, bdmap_id, "ct_care.nii.gz"),
+                                                       ct_dataset.ct_xyz_shape,
+                                                       ct_dataset.ct_volume_nii.affine,
+                                                       ct_dataset.ct_volume_nii.header,
+                                                       **writer_kwargs),
+                                  max_pending=max_pending_slices)
+        writers.append(writer)
+        volumes[bdmap_id] = {
+            "accumulator": SliceAccumulator(writer, ct_dataset.window_starts, checkpoints.get(bdmap_id)),
+            "num_done": 0,
+            "seconds": 0.,
+            "read_stall_seconds": 0.,
+            "window_classes": {window_class: 0 for window_class in WINDOW_CLASSES},
+            "skipped_starts": [],
+            "num_cached_windows": 0,
+            "num_warm_windows": 0,
+            "steps_used": [],   # (first slice, sampler steps) of every window, with early stopping
+        }
+
+    def close_volume(bdmap_id):     # volume complete, emit it (in the background)
+        volume = volumes.pop(bdmap_id)
+        accumulator = volume["accumulator"]
+        assert accumulator.done
+        accumulator.close()
+        if prefetcher is not None:
+            prefetcher.release(case_indices[bdmap_id])
+        if latent_caches is not None:
+            latent_caches[bdmap_id].close()
+        for lane in [lane for lane in lanes if lane[0] == bdmap_id]:
+            del lanes[lane]
+        steps_stats = dict()
+        if len(volume["steps_used"]) > 0:
+            steps, counts = np.zeros(accumulator.z_shape), np.zeros(accumulator.z_shape)
+            for start, window_steps in volume["steps_used"]:
+                steps[start:start + 3] += window_steps
+                counts[start:start + 3] += 1
+            pd.DataFrame({"slice": np.arange(accumulator.z_shape),  # NaN: restored from a slab checkpoint
+                          "steps_used": np.where(counts > 0, steps / np.maximum(counts, 1), np.nan)}
+                         ).to_csv(os.path.join(save_dir, bdmap_id, "steps_used.csv"), index=False)
+            steps_stats = dict(mean_steps_used=np.mean([window_steps for _, window_steps in volume["steps_used"]]))
+        # a slice is skipped when every window covering it was skipped
+        covered, skipped = np.zeros(accumulator.z_shape, int), np.zeros(accumulator.z_shape, int)
+        for start in ct_datasets[bdmap_id].window_starts:
+            covered[start:start + 3] += 1
+        for start in volume["skipped_starts"]:
+            skipped[start:start + 3] += 1
+        stats.append({
+            "bdmap_id": bdmap_id,
+            "num_slices": accumulator.z_shape,
+            "num_windows": volume["num_done"],
+            "num_resumed_slices": accumulator.first_slice,
+            "seconds": volume["seconds"],
+            "read_stall_seconds": volume["read_stall_seconds"],
+            "write_stall_seconds": accumulator.writer.stall_seconds,
+            "peak_memory_gb": peak_memory_bytes(pipe.device) / GB,  # of the whole process so far
+            **{f"num_{window_class}_windows": count for window_class, count in volume["window_classes"].items()},
+            "num_skipped_slices": int(((covered > 0) & (skipped == covered)).sum()),
+            "num_cached_windows": volume["num_cached_windows"],  # condition latents read from the latent cache
+            "num_warm_windows": volume["num_warm_windows"],
+            **steps_stats,
+        })
+
+    lanes = dict()  # (bdmap_id, lane) -> state of the lane, see `sample_warm_started`
+    prefetcher = None
+    for bdmap_id in [b for b, ct_dataset in ct_datasets.items() if len(ct_dataset) == 0]:
+        open_volume(bdmap_id)   # every slice was restored from the checkpoint
+        close_volume(bdmap_id)
+        del ct_datasets[bdmap_id]
+
+    if len(ct_datasets) > 0:
+        case_indices = {bdmap_id: idx for idx, bdmap_id in enumerate(ct_datasets)}
+        if prefetch_cases > 0:
+            prefetcher = VolumePrefetcher([None if all(map(ct_dataset.is_cached, ct_dataset.window_starts)) else ct_dataset.file_path
+                                           for ct_dataset in ct_datasets.values()],  # NOTE: fully cached cases are not decoded
+                                          decode_dir=decode_dir, max_ahead=prefetch_cases)
+            for bdmap_id, ct_dataset in ct_datasets.items():    # before the workers get their copies
+                ct_dataset.decoded_path = prefetcher.decoded_paths[case_indices[bdmap_id]]
+        ct_dataloader = torch.utils.data.DataLoader(
+            torch.utils.data.ConcatDataset(list(ct_datasets.values())),   # keeps the volume order
+            batch_sampler=(ShapeGroupedBatchSampler(ct_datasets.values(), chunk_size) if warm_start is None  # in order, one input shape per batch
+                           else LaneBatchSampler(ct_datasets.values(), chunk_size)),   # window i of a batch is on lane i
+            collate_fn=collate_fn_inference,    # prompt rather than token
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0, # workers are spawned once for all volumes
         )
-    # load unet (network required)
-    unet_args = SimpleNamespace(pretrained_model_name_or_path=args.sd_model_name_or_path)
-    unet = init_unet(unet_args.pretrained_model_name_or_path, zero_cond_conv_in=True)
-    unet_ckpt = safetensors.torch.load_file(os.path.join(finetuned_unet_name_or_path, "unet", "diffusion_pytorch_model.safetensors"))
-    unet.load_state_dict(unet_ckpt, strict=True)
-    unet = unet.half()
-    # construct pipeline
-    pipe = ConcatInputStableDiffusionPipeline.from_pretrained(
-        args.sd_model_name_or_path, 
-        unet=unet,
-        vae=vae,
-        safety_checker=None,
-        torch_dtype=torch.float16)
-    pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)  
-    pipe.set_progress_bar_config(disable=True)
-    pipe = pipe.to("cuda")
-
-    # Dataset settings"
-    data_dir = args.input_path
-    save_dir = args.output_path
-    os.makedirs(save_dir, exist_ok=True)
-    # os.makedirs(os.path.join(save_dir, "original"), exist_ok=True)
-    # os.makedirs(os.path.join(save_dir, "enhanced"), exist_ok=True)
-    target_bdmap_ids_raw = pd.read_csv("splits/BDMAP_O_AV_meta_test.csv")["bdmap_id"].apply(lambda x: x[:-2]).tolist()
+
+        def read_batches():     # time spent waiting for the dataloader is the read stall
+            batches = iter(ct_dataloader)
+            while True:
+                tic = time.time()
+                batch = next(batches, None)
+                stage_seconds["read_stall"] += time.time() - tic
+                if batch is None:
+                    return
+                batch["read_stall_seconds"] = time.time() - tic
+                yield batch
+
+        try:
+            for batch in tqdm(read_batches(), total=len(ct_dataloader)):
+                tic = time.time()
+                # --- Step 1: 图像编码为潜变量 ---
+                cond_image = batch["cond_pixel_values"].to(pipe.device, dtype=pipe.dtype)   # same thing as `pixel_values`
+                image_row = np.cumsum(~np.asarray(batch["cached"])) - 1    # window -> row of `cond_image` (cached: not read)
+                prompt = batch["input_prompt"]
+                slice_idx = np.asarray(batch["slice_idx"])    # (B,) first slice of each window
+                bdmap_ids = batch["bdmap_id"]
+                channel_weights = batch["channel_weights"].numpy()    # (B 3) blending weights of each window
+                window_class = np.asarray(batch["window_class"])
+                skip = (window_class == "empty") if skip_background else np.zeros(len(window_class), dtype=bool)
+                run_idx = np.flatnonzero(~skip)     # windows that go through the model
+                from_cache = np.zeros(len(skip), dtype=bool)
+                images, num_warm = None, 0
+                window_steps = np.zeros(len(skip), dtype=int)   # sampler steps of every window, with early stopping
+                if len(run_idx) > 0:
+                    with torch.no_grad():
+                        cond_latents, from_cache[run_idx] = get_cond_latents(pipe, cond_image, image_row, run_idx, bdmap_ids,
+                                                                             slice_idx, window_class, latent_caches)
+                        latents = torch.randn_like(cond_latents)    # useless
+
+                    # --- Step 3: reverse process (or one direct step) to generate a slice ---
+                    generate = pipe.predict_direct if mode == "direct" else pipe
+                    if warm_start is not None:
+                        generated, num_warm = sample_warm_started(pipe, lanes, [(bdmap_ids[idx], idx) for idx in run_idx],
+                                                                  slice_idx[run_idx], [prompt[idx] for idx in run_idx],
+                                                                  cond_latents, warm_start, pipe_kwargs)
+                    else:
+                        generated = generate(
+                            prompt=[prompt[idx] for idx in run_idx],
+                            latents=latents,  
+                            cond_latents=cond_latents,
+                            output_type="pt",   # (B 3 h w) in [0, 1], stays on the device
+                            **pipe_kwargs
+                        ).images
+                        if "convergence_threshold" in pipe_kwargs:
+                            window_steps[run_idx] = pipe.steps_used.numpy()
+                    images = torch.empty((len(skip),) + generated.shape[1:], device=generated.device, dtype=generated.dtype)
+                    images[run_idx] = generated
+                if skip.any():  # background windows: the input itself or air, in [0, 1]
+                    skip_idx = np.flatnonzero(skip)
+                    background = cond_image[image_row[skip_idx]]
+                    background = (background / 2 + 0.5).clamp(0, 1) if background_fill == "passthrough" else torch.zeros_like(background)
+                    if images is None:
+                        images = torch.empty((len(skip),) + background.shape[1:], device=background.device, dtype=background.dtype)
+                    images[skip_idx] = background.to(images.dtype)
+
+                # --- Step 4: resize the whole batch back and blend it into the volumes ---
+                for bdmap_id in dict.fromkeys(bdmap_ids):   # windows of one case are contiguous, keep their order
+                    batch_idx = [idx for idx, b in enumerate(bdmap_ids) if b == bdmap_id]
+                    if bdmap_id not in volumes:     # first triplet of a new volume
+                        open_volume(bdmap_id)
+                    volume = volumes[bdmap_id]
+                    accumulator = volume["accumulator"]
+                    for idx in batch_idx:
+                        volume["window_classes"][window_class[idx]] += 1
+                        if skip[idx]:
+                            volume["skipped_starts"].append(slice_idx[idx])
+                    volume["num_cached_windows"] += int(from_cache[batch_idx].sum())
+                    volume["num_warm_windows"] += num_warm  # NOTE: 0, or a lane batch of this volume only
+                    if "convergence_threshold" in pipe_kwargs:
+                        volume["steps_used"] += zip(slice_idx[batch_idx], window_steps[batch_idx])
+                    if ct_datasets[bdmap_id].native_resolution:    # crop the padding off
+                        enhanced_windows = images[batch_idx, :, :accumulator.height, :accumulator.width].float()
+                    else:
+                        # NOTE: bilinear, as the former `cv2.resize(img, dsize, cv2.INTER_CUBIC)` passed the flag as `dst`
+                        enhanced_windows = torch.nn.functional.interpolate(
+                            images[batch_idx].float(), size=(accumulator.height, accumulator.width), 
+                            mode="bilinear", align_corners=False)
+                    accumulator.add(slice_idx[batch_idx], enhanced_windows, channel_weights[batch_idx])  # finished slices go to the writer
+                    volume["num_done"] += len(batch_idx)
+
+                batch_seconds = time.time() - tic
+                stage_seconds["denoise"] += batch_seconds
+                for bdmap_id in dict.fromkeys(bdmap_ids):
+                    volume = volumes[bdmap_id]
+                    share = bdmap_ids.count(bdmap_id) / len(images)
+                    volume["seconds"] += batch_seconds * share
+                    volume["read_stall_seconds"] += batch["read_stall_seconds"] * share
+                    if volume["num_done"] == len(ct_datasets[bdmap_id]):
+                        close_volume(bdmap_id)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    tic = time.time()
+    for writer in writers:  # wait for the last volumes to be written
+        writer.join()
+    stage_seconds["write_stall"] += time.time() - tic + sum(writer.stall_seconds for writer in writers)
+    print("stages: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_seconds.items()) 
+          + (f", decoding (background) {prefetcher.decode_seconds:.1f}s" if prefetcher is not None else ""))
+    return stats
+
+
+TORCH_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+
+
+def resolve_dtype(device, dtype=None):
+    """float16 on GPU, float32 on CPU unless asked otherwise (float16 is very slow on CPU)."""
+    if dtype is None:
+        dtype = "float16" if torch.device(device).type == "cuda" else "float32"
+    return TORCH_DTYPES[dtype]
+
+
+def get_proc_cores(proc_id, num_procs, cores_per_proc=None):
+    """The block of CPU cores that process `proc_id` out of `num_procs` is pinned to."""
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_proc is None:
+        cores_per_proc = max(len(cores) // num_procs, 1)
+    assert cores_per_proc * num_procs <= len(cores), \
+        f"{num_procs} processes x {cores_per_proc} cores > {len(cores)} available cores"
+    return cores[proc_id * cores_per_proc:(proc_id + 1) * cores_per_proc]
+
+
+def launch_pinned_processes(args):
+    """Re-run this script `num_procs` times, each on its own cores and its own share of the cases.
+
+    On CPU a few processes with a few threads each are usually faster than one process with
+    all threads. The per-process statistics are merged into `stats_csv` at the end.
+    """
+    procs, proc_stats_csvs = [], []
+    for proc_id in range(args.num_procs):
+        cores = get_proc_cores(proc_id, args.num_procs, args.cores_per_proc)
+        cmd = [sys.executable, "-W", "ignore"] + sys.argv + ["--proc_id", str(proc_id)]
+        if args.stats_csv is not None:
+            proc_stats_csvs.append(f"{args.stats_csv}.proc{proc_id}")
+            cmd += ["--stats_csv", proc_stats_csvs[-1]]
+        env = dict(os.environ, OMP_NUM_THREADS=str(args.num_threads or len(cores)))
+        print(f"process {proc_id}: cores {cores[0]}-{cores[-1]}")
+        procs.append(subprocess.Popen(cmd, env=env))
+    return_codes = [proc.wait() for proc in procs]
+    if args.stats_csv is not None:
+        stats = [pd.read_csv(csv) for csv in proc_stats_csvs if os.path.exists(csv)]
+        if len(stats) > 0:
+            write_inference_stats(pd.concat(stats).to_dict("records"), args.stats_csv)
+        for csv in proc_stats_csvs:
+            if os.path.exists(csv):
+                os.remove(csv)
+    if any(return_codes):
+        raise RuntimeError(f"enhancement processes failed with return codes {return_codes}")
+
+
+def select_cases(args, save_dir):
+    """Cases of `split_csv` still to be enhanced in `save_dir` (this process' share with `--num_procs`)."""
+    target_bdmap_ids_raw = pd.read_csv(args.split_csv)["bdmap_id"].apply(lambda x: x[:-2]).tolist()[:args.max_cases]
+    if args.proc_id is not None:    # this process' share of the cases
+        target_bdmap_ids_raw = target_bdmap_ids_raw[args.proc_id::args.num_procs]
     target_bdmap_ids = []
     for _, bdmap_id in enumerate(target_bdmap_ids_raw):
         if not args.overwrite and os.path.exists(os.path.join(save_dir, bdmap_id, "ct_care.nii.gz")):
+            if os.path.isdir(os.path.join(save_dir, bdmap_id, ".ct_care_resume")):  # interrupted clean-up
+                shutil.rmtree(os.path.join(save_dir, bdmap_id, ".ct_care_resume"))
             # print("already inferenced", os.path.join(save_dir, bdmap_id, "ct_care.nii.gz"), 
             #         "and `overwrite` is set to false, so skip.")
             continue
         else:
             target_bdmap_ids.append(bdmap_id)
             pass
-    print(f"w.r.t to `overwrite`=={args.overwrite}, will inference on {len(target_bdmap_ids)} cases!")
-    inference_transforms = A.Compose([      # resize 
-        A.Resize(512, 512, interpolation=cv2.INTER_CUBIC), # model requires 512
-    ])
-    weights_RGB = np.array([1., 1., 1.])    # weights of each channel in a CT slice
-    chunk_size = 16  # NOTE: how many 3-channel images to input at once
+    return target_bdmap_ids
+
+
+def get_dataset_paths(args, dataset_name):
+    """Input folder, output folder and model of a `--datasets` entry (`{dataset}` in the paths is replaced by it)."""
+    return [path if dataset_name is None else path.format(dataset=dataset_name)
+            for path in (args.input_path, args.output_path, args.onnx_dir or args.care_bundle or args.finetuned_unet_name_or_path)]
+
+
+def is_case_done(lock_path):
+    return os.path.exists(lock_path.replace("ct_care.lock", "ct_care.nii.gz"))
+
+
+def iter_dataset_passes(args, queue=None):
+    """The `--datasets` in order; in `--queue` mode again, until no case is left to other workers.
+
+    A stale claim is only broken when a worker tries to claim it, so a worker does not exit
+    while other workers hold unfinished cases: it waits `queue.poll_interval` seconds and
+    claims again, and redoes the cases of crashed workers once their locks expire.
+    """
+    dataset_names = args.datasets or [None]
+    yield from dataset_names
+    while queue is not None:
+        lock_paths = [os.path.join(save_dir, bdmap_id, "ct_care.lock") 
+                      for _, save_dir, _ in (get_dataset_paths(args, dataset_name) for dataset_name in dataset_names)
+                      for bdmap_id in select_cases(args, save_dir)]
+        pending = queue.pending(lock_paths, is_case_done)
+        if len(pending) == 0:
+            return
+        print(f"{len(pending)} cases are held by other workers, claiming again in {queue.poll_interval:.0f}s")
+        time.sleep(queue.poll_interval)
+        yield from dataset_names
+
+
+def get_planning_resolution(args):
+    """Input size probed by `plan_batch_sizes`: 512, or with `--native_resolution` the largest padded (H W) of the cases to enhance."""
+    if not args.native_resolution:
+        return 512
+    shapes = []
+    for dataset_name in (args.datasets or [None]):
+        data_dir, save_dir, _ = get_dataset_paths(args, dataset_name)
+        for bdmap_id in select_cases(args, save_dir):
+            ct_path = os.path.join(data_dir, bdmap_id, "ct.nii.gz")
+            if os.path.exists(ct_path):     # NOTE: only the header is read
+                shapes.append(get_padded_shape(nib.load(ct_path).shape[:2]))
+    return max(shapes, key=lambda shape: shape[0] * shape[1], default=512)
+
+
+def load_unet_weights(unet, finetuned_unet_name_or_path):
+    """Load a finetuned CARE UNet checkpoint (or the UNet of a CARE bundle file) into an `init_unet` model (keeps its device and dtype)."""
+    if os.path.isfile(finetuned_unet_name_or_path):
+        unet_ckpt = load_bundle_state_dict(finetuned_unet_name_or_path, "unet.", unet.dtype, unet.device)
+    else:
+        unet_ckpt = safetensors.torch.load_file(os.path.join(finetuned_unet_name_or_path, "unet", "diffusion_pytorch_model.safetensors"))
+    unet.load_state_dict(unet_ckpt, strict=True)
 
-    # Inference Loop!
-    for _, bdmap_id in enumerate(target_bdmap_ids):
-
-        # wrap the CT as a dataset for batch_size > 1
-        ct_dataset = CTDatasetInference(file_path=os.path.join(data_dir, bdmap_id, "ct.nii.gz"),    # from the reconstruction method
-                                        image_transforms=inference_transforms,
-                                        cond_transforms=inference_transforms)
-        # if ct_dataset.ct_xyz_shape[0] != 512 and ct_dataset.ct_xyz_shape[1] != 512:
-        #     continue
-        ct_dataloader = torch.utils.data.DataLoader(
-            ct_dataset,
-            shuffle=False,  
-            collate_fn=collate_fn_inference,    # prompt rather than token
-            batch_size=chunk_size,
-            num_workers=chunk_size if chunk_size <= 16 else 16, # maximum 16 workers
-            drop_last=False
-        )
 
-        # nii = nib.load(os.path.join(data_dir, bdmap_id, "ct.nii.gz"))
-        nii_shape = list(ct_dataset.ct_xyz_shape)
-        # nii_shape[2] = 100
-        print(bdmap_id, nii_shape)
-        z_shape = nii_shape[2]
-
-        enhanced_ct = np.zeros(nii_shape)
-        weights_vector = np.zeros(z_shape)
-
-        for batch in tqdm(ct_dataloader):
-            # --- Step 1: 图像编码为潜变量 ---
-            # image = (torch.from_numpy(input_image.copy())[None].permute(0, 3, 1, 2)).to("cuda").half() * 2 - 1  # [-1, 1]
-            # raw_image = batch["pixel_values"].to("cuda").half()   
-            cond_image = batch["cond_pixel_values"].to("cuda").half()   # same thing as `pixel_values`
-            prompt = batch["input_prompt"]
-            slice_idx = batch["slice_idx"]
-            with torch.no_grad():
-                cond_latents = pipe.vae.encode(cond_image).latent_dist.sample() * pipe.vae.config.scaling_factor
-                latents = torch.randn_like(cond_latents)    # useless
-
-            # --- Step 3: reverse process to generate a slice ---
-            images = pipe(
-                num_inference_steps=50, 
-                prompt=prompt,
-                latents=latents,  
-                cond_latents=cond_latents,
-                output_type="np"
-            ).images
-            # print(len(image), image[0].shape)
-
-            real_chunk_size = len(images)
-            
-            for idx in range(real_chunk_size):
-                slice_id = slice_idx[idx]
-                enhanced_slice = cv2.resize(images[idx], nii_shape[:2][::-1], cv2.INTER_CUBIC) # W H -> (H W C)... so ugly...
-                weighted_slice = enhanced_slice * weights_RGB[None, None, :] # weighting each frame
-                enhanced_ct[:, :, slice_id:slice_id+3] += weighted_slice    
-                weights_vector[slice_id:slice_id+3] += weights_RGB
+def get_inference_transforms():
+    return A.Compose([      # resize 
+        A.Resize(512, 512, interpolation=cv2.INTER_CUBIC), # model requires 512
+    ])
 
-        enhanced_ct[:, :] /= weights_vector[None, None, :]  # weighting each frame!
-        enhanced_ct = (enhanced_ct * 2 - 1) * 1000  # [0, 1] --> [-1000, 1000]
-        enhanced_ct = enhanced_ct.astype(np.int16)
 
-        # os.makedirs(os.path.join(save_dir, "original", bdmap_id), exist_ok=True)
-        # os.makedirs(os.path.join(save_dir, "enhanced", bdmap_id), exist_ok=True)
-        os.makedirs(os.path.join(save_dir, bdmap_id), exist_ok=True)
-        # import shutil   # for reader study
-        # shutil.copy(os.path.join(data_dir, bdmap_id, "ct.nii.gz"), os.path.join(save_dir, "original", bdmap_id, "ct.nii.gz"))
-        out_nii = nib.Nifti1Image(enhanced_ct, ct_dataset.ct_volume_nii.affine, ct_dataset.ct_volume_nii.header)
-        # Optionally enforce int16 if needed:
-        out_nii.header.set_data_dtype(np.int16)
-        out_nii.to_filename(os.path.join(save_dir, bdmap_id, "ct_care.nii.gz"))
+def prepare_cases(args, data_dir, save_dir, finetuned_unet_name_or_path, bdmap_ids, pipe_kwargs, torch_dtype):
+    """Datasets of the cases to enhance, their slab checkpoints (datasets skip the restored slices) and latent caches."""
+    inference_transforms = get_inference_transforms()
+
+    # wrap every CT as a dataset, all of them share one dataloader
+    ct_datasets = [CTDatasetInference(file_path=os.path.join(data_dir, bdmap_id, "ct.nii.gz"),    # from the reconstruction method
+                                      image_transforms=inference_transforms,
+                                      cond_transforms=inference_transforms,
+                                      slice_stride=args.slice_stride,
+                                      blending=args.blending,
+                                      native_resolution=args.native_resolution,
+                                      background_kwargs=dict(body_hu=args.body_hu, empty_fraction=args.empty_fraction,
+                                                             body_fraction=args.body_fraction))
+                   for bdmap_id in bdmap_ids]
+
+    # finished slabs of interrupted runs with the same model and sampler settings are reused
+    checkpoints = dict()
+    if args.slab_size > 0:
+        for ct_dataset in ct_datasets:
+            if args.backend == "onnx":
+                model_key = dict(onnx_dir=os.path.abspath(finetuned_unet_name_or_path))
+            elif args.care_bundle is not None:
+                model_key = dict(care_bundle=os.path.abspath(finetuned_unet_name_or_path))
+            else:
+                model_key = dict(finetuned_vae=os.path.abspath(args.finetuned_vae_name_or_path),
+                                 finetuned_unet=os.path.abspath(finetuned_unet_name_or_path),
+                                 sd_model=args.sd_model_name_or_path)
+            checkpoint = SlabCheckpoint(os.path.join(save_dir, ct_dataset.bdmap_id, ".ct_care_resume"),
+                                        key=dict(bdmap_id=ct_dataset.bdmap_id,
+                                                 input_path=os.path.abspath(ct_dataset.file_path),
+                                                 **model_key,
+                                                 mode=args.mode, scheduler=args.scheduler, pipe_kwargs=pipe_kwargs,
+                                                 slice_stride=args.slice_stride, blending=args.blending,
+                                                 native_resolution=args.native_resolution, quantize=args.quantize,
+                                                 warm_start=args.warm_start, preview_decoder=args.preview_decoder,
+                                                 background=[args.background_fill, args.body_hu, args.empty_fraction] 
+                                                 if args.skip_background else None,
+                                                 dtype=str(torch_dtype)),
+                                        slab_size=args.slab_size)
+            if checkpoint.num_slices > 0:
+                print(f"{ct_dataset.bdmap_id}: resume from slice {checkpoint.num_slices}")
+                ct_dataset.skip_slices(checkpoint.num_slices)
+            checkpoints[ct_dataset.bdmap_id] = checkpoint
+
+    # condition latents of earlier runs with the same input, VAE and resize settings
+    latent_caches = None
+    if args.latent_cache_dir is not None:
+        cache = LatentCache(args.latent_cache_dir, max_gb=args.latent_cache_gb)
+        if args.backend == "onnx":
+            vae_key = dict(onnx_dir=os.path.abspath(finetuned_unet_name_or_path),
+                           vae_weights=weights_stamp(os.path.join(finetuned_unet_name_or_path, "vae_encoder")))
+        elif args.care_bundle is not None:
+            vae_key = dict(care_bundle=os.path.abspath(finetuned_unet_name_or_path),
+                           vae_weights=weights_stamp(finetuned_unet_name_or_path))
+        else:
+            vae_dir = os.path.join(args.finetuned_vae_name_or_path, "vae")
+            vae_key = dict(finetuned_vae=os.path.abspath(args.finetuned_vae_name_or_path), vae_weights=weights_stamp(vae_dir))
+        latent_caches = dict()
+        for ct_dataset in ct_datasets:
+            case = cache.open(ct_dataset.bdmap_id, ct_dataset.file_path, ct_dataset.ct_z_shape,
+                              settings=dict(**vae_key, quantize=args.quantize, dtype=str(torch_dtype),
+                                            input_shape=ct_dataset.input_shape or "resize_512_cubic",
+                                            background_kwargs=ct_dataset.background_kwargs))
+            ct_dataset.cached_classes = np.array(case.window_class)     # NOTE: a copy, the workers never see the memmap
+            ct_dataset.skip_empty = args.skip_background
+            latent_caches[ct_dataset.bdmap_id] = case
+    return ct_datasets, checkpoints, latent_caches
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process input and output paths along with a BDMAP ID.")
+    parser.add_argument("--input_path", type=str, required=True, 
+                        help="Path to the input directory, may contain `{dataset}` (see `--datasets`).")
+    parser.add_argument("--output_path", type=str, required=True, 
+                        help="Path to the output directory, may contain `{dataset}` (see `--datasets`).")
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, default=None, help="Path to the output directory.")
+    parser.add_argument("--finetuned_unet_name_or_path", type=str, default=None, 
+                        help="Trained CARE model, may contain `{dataset}`, e.g. `logs/{dataset}/checkpoint-50000`.")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"],
+                        help="`onnx`: DDIM on ONNX Runtime CPU sessions of the graphs of `export_onnx.py` (`--onnx_dir`).")
+    parser.add_argument("--onnx_dir", type=str, default=None, 
+                        help="Output folder of `export_onnx.py`, may contain `{dataset}`. Replaces the model paths.")
+    parser.add_argument("--preview_decoder", type=str, default=None,
+                        help="Preview mode: decode with the tiny decoder of this `train_tiny_decoder.py` checkpoint instead of "
+                             "the full VAE decoder (faster, slightly lower fidelity, see `eval_tiny_decoder.py`).")
+    parser.add_argument("--care_bundle", type=str, default=None,
+                        help="Single-file CARE bundle of `export_care_bundle.py`, may contain `{dataset}`. "
+                             "Replaces the three model paths and starts faster.")
+    parser.add_argument("--datasets", type=str, nargs="+", default=None,
+                        help="e.g. nerf_50 nerf_200 FDK_50: enhance all of them, `{dataset}` in the paths is replaced by each.")
+    parser.add_argument("--queue", action="store_true",
+                        help="Work-queue mode: claim cases with lock files, so any number of workers can share the job.")
+    parser.add_argument("--claim_size", type=int, default=16, 
+                        help="Cases claimed at once in `--queue` mode. Every claim is one `enhance_ct_volumes` call, which "
+                             "re-spawns the dataloader workers and re-opens the cases; smaller claims share the last "
+                             "cases more evenly between the workers, larger ones pay that start-up less often.")
+    parser.add_argument("--lock_timeout", type=int, default=1800, 
+                        help="Seconds after which the claim of a crashed worker is considered stale (and redone by the waiting workers).")
+    parser.add_argument("--sd_model_name_or_path", type=str, default=None, help="Path to the output directory.")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--batch_size", type=int, default=16, 
+                        help="How many 3-channel images to input at once (the upper bound with `--max_memory_gb`).")
+    parser.add_argument("--max_memory_gb", type=float, default=None,
+                        help="Memory budget of the process (GPU memory, or RAM with --device cpu): picks the largest batch "
+                             "size and the VAE slicing / tiling that fit.")
+    parser.add_argument("--vae_batch_size", type=int, default=None, 
+                        help="Images per VAE encode / decode call (default: the whole batch; the upper bound with `--max_memory_gb`).")
+    parser.add_argument("--num_workers", type=int, default=16, help="Number of persistent dataloader workers shared by all cases.")
+    parser.add_argument("--slice_stride", type=int, default=1, choices=[1, 2, 3], 
+                        help="Step between 3-slice windows: 1 denoises every slice 3 times, 3 only once (~3x fewer UNet calls).")
+    parser.add_argument("--blending", type=str, default="uniform", choices=list(BLENDING_WEIGHTS.keys()),
+                        help="How the overlapping windows of a slice are averaged.")
+    parser.add_argument("--skip_background", action="store_true",
+                        help="Do not denoise windows of air / table only (`dataset.classify_window`), see `--background_fill`.")
+    parser.add_argument("--background_fill", type=str, default="passthrough", choices=["passthrough", "air"],
+                        help="Output of skipped windows: the input CT, or -1000 HU.")
+    parser.add_argument("--body_hu", type=float, default=-500., help="Body mask threshold of the background pre-pass.")
+    parser.add_argument("--empty_fraction", type=float, default=0.005, 
+                        help="A window is empty below this fraction of body pixels (and without bone).")
+    parser.add_argument("--body_fraction", type=float, default=0.02, help="A window is body above this fraction, uncertain in between.")
+    parser.add_argument("--native_resolution", action="store_true",
+                        help="Denoise slices at their own size (zero-padded to a multiple of 64 px) instead of resizing to 512x512 and back.")
+    parser.add_argument("--split_csv", type=str, default="splits/BDMAP_O_AV_meta_test.csv", help="Cases to enhance.")
+    parser.add_argument("--max_cases", type=int, default=None, help="Only enhance the first N cases of `split_csv`.")
+    parser.add_argument("--stats_csv", type=str, default=None, help="Where to write per-case timing statistics.")
+    parser.add_argument("--mode", type=str, default="sample", choices=["sample", "direct"],
+                        help="`sample`: full reverse process. `direct`: one UNet pass + x0 prediction (as the CARE loss).")
+    parser.add_argument("--direct_timestep", type=int, default=499, help="Timestep of the one-step `direct` mode.")
+    parser.add_argument("--scheduler", type=str, default="ddim", choices=list(SCHEDULERS.keys()), help="Sampler of the reverse process.")
+    parser.add_argument("--num_inference_steps", type=int, default=50, help="Number of sampler steps per window.")
+    parser.add_argument("--guidance_scale", type=float, default=7.5, 
+                        help="Classifier-free guidance scale, <= 1 disables CFG (half the UNet batch).")
+    parser.add_argument("--guidance_interval", type=float, nargs=2, default=None, metavar=("START", "END"),
+                        help="Only guide the steps in [START, END) of the schedule (fractions), e.g. 0 0.3.")
+    parser.add_argument("--strength", type=float, default=1.0, 
+                        help="< 1 starts from the noised input CT latents and only runs this fraction of the steps.")
+    parser.add_argument("--convergence_threshold", type=float, default=None,
+                        help="Early stopping: a window stops once its predicted x0 changes by less than this fraction per step, e.g. 0.005.")
+    parser.add_argument("--convergence_min_steps", type=int, default=10, help="Steps every window runs before it may stop.")
+    parser.add_argument("--warm_start", type=float, default=None,
+                        help="Experimental: denoise each volume in `batch_size` lanes in z order, every window after the first "
+                             "of a lane starts from the previous window's latents and only runs this fraction of the steps, e.g. 0.3.")
+    parser.add_argument("--slab_size", type=int, default=32, 
+                        help="Finished slices are checkpointed every N slices to resume an interrupted case, 0 disables.")
+    parser.add_argument("--prefetch_cases", type=int, default=2, 
+                        help="Input volumes decoded ahead in background threads, 0 reads the .nii.gz directly.")
+    parser.add_argument("--decode_dir", type=str, default=None, help="Where decoded input volumes are kept (default: $TMPDIR).")
+    parser.add_argument("--write_queue", type=int, default=64, help="Finished slices queued per writer thread.")
+    parser.add_argument("--latent_cache_dir", type=str, default=None,
+                        help="Keep the VAE latents of the inputs here (float16), later runs with the same VAE skip reading and encoding.")
+    parser.add_argument("--latent_cache_gb", type=float, default=20., help="Size cap of the latent cache, least recently used cases go first.")
+    add_writer_args(parser)
+    parser.add_argument("--device", type=str, default="cuda", help="e.g. cuda, cuda:1 or cpu.")
+    parser.add_argument("--dtype", type=str, default=None, choices=list(TORCH_DTYPES.keys()),
+                        help="Default: float16 on GPU, float32 on CPU. bfloat16 is faster on CPUs with AVX512-BF16/AMX.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of torch (per process).")
+    parser.add_argument("--num_procs", type=int, default=1, 
+                        help="CPU only: split the cases over N processes, each pinned to its own block of cores.")
+    parser.add_argument("--cores_per_proc", type=int, default=None, help="Default: all available cores / `num_procs`.")
+    parser.add_argument("--proc_id", type=int, default=None, help=argparse.SUPPRESS)   # set by `launch_pinned_processes`
+    parser.add_argument("--quantize", type=str, default="none", choices=QUANTIZE_MODES,
+                        help="CPU only: int8 UNet and VAE, `dynamic` (linear layers) or the experimental `static` (also convolutions, "
+                             "calibrated; per-layer quantize / dequantize, often slower than float32).")
+    parser.add_argument("--calibration_split_csv", type=str, default="splits/BDMAP_O_AV_meta_train.csv",
+                        help="`--quantize static`: calibration cases, read from the `--input_path` folder.")
+    parser.add_argument("--calibration_cases", type=int, default=4)
+    parser.add_argument("--calibration_windows", type=int, default=8, help="Evenly spaced windows per calibration case.")
+    parser.add_argument("--calibration_steps", type=int, default=10, help="Sampling steps of the calibration runs.")
+    args = parser.parse_args()
+    if args.queue and args.overwrite:
+        parser.error("`--queue` cannot be combined with `--overwrite`: existing outputs tell the workers what is done.")
+    if args.backend == "onnx":
+        if args.onnx_dir is None:
+            parser.error("`--backend onnx` needs `--onnx_dir`.")
+        if args.device != "cpu" or args.scheduler != "ddim" or args.quantize != "none" or args.max_memory_gb is not None:
+            parser.error("`--backend onnx` runs DDIM on CPU, without `--quantize` / `--max_memory_gb`.")
+        if args.preview_decoder is not None:
+            parser.error("`--preview_decoder` needs the torch backend.")
+    elif args.care_bundle is None and None in (args.finetuned_vae_name_or_path, args.finetuned_unet_name_or_path, 
+                                               args.sd_model_name_or_path):
+        parser.error("give `--care_bundle`, or `--finetuned_vae_name_or_path`, `--finetuned_unet_name_or_path` and `--sd_model_name_or_path`.")
+    if args.quantize != "none" and (args.device != "cpu" or args.dtype not in (None, "float32")):
+        parser.error("`--quantize` needs `--device cpu` and float32 (the int8 kernels are CPU kernels).")
+    if args.warm_start is not None and (args.mode != "sample" or args.backend != "torch" or args.strength < 1):
+        parser.error("`--warm_start` needs `--mode sample`, the torch backend and `--strength 1`.")
+    if args.warm_start is not None and args.slice_stride >= 3:
+        parser.error("`--warm_start` needs overlapping windows, `--slice_stride` 1 or 2.")
+    if args.convergence_threshold is not None and (args.mode != "sample" or args.backend != "torch" or args.warm_start is not None):
+        parser.error("`--convergence_threshold` needs `--mode sample` and the torch backend, without `--warm_start`.")
+
+    if args.num_procs > 1 and args.proc_id is None:
+        launch_pinned_processes(args)
+        sys.exit(0)
+    if args.proc_id is not None:
+        cores = get_proc_cores(args.proc_id, args.num_procs, args.cores_per_proc)
+        os.sched_setaffinity(0, cores)  # dataloader workers inherit it
+        args.num_threads = args.num_threads or len(cores)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch_dtype = resolve_dtype(args.device, args.dtype)
+
+    loaded_unet_name_or_path = None
+    if args.backend == "onnx":
+        # exported graphs and phase embeddings, no torch model is built
+        loaded_unet_name_or_path = args.onnx_dir.format(dataset=(args.datasets or [None])[0])
+        pipe = load_onnx_pipeline(loaded_unet_name_or_path, num_threads=args.num_threads)
+    elif args.care_bundle is not None:
+        # one file: UNet, VAE and the cached phase embeddings, memory-mapped onto the device
+        loaded_unet_name_or_path = args.care_bundle.format(dataset=(args.datasets or [None])[0])
+        pipe = ConcatInputStableDiffusionPipeline.from_care_bundle(loaded_unet_name_or_path, torch_dtype=torch_dtype, 
+                                                                   device=args.device)
+        pipe.scheduler = get_scheduler(args.scheduler, pipe.scheduler.config)
+        pipe.set_progress_bar_config(disable=True)
+        pipe = pipe.to(args.device)
+    else:
+        """Method 1: StableDiffusionPipeline"""
+        # Setting up models in the pipeline.
+        finetuned_vae_name_or_path = args.finetuned_vae_name_or_path#"./VAE"
+        # load vae
+        vae = AutoencoderKL.from_pretrained(
+                finetuned_vae_name_or_path, subfolder="vae", #revision=args.revision, variant=args.variant,
+                torch_dtype=torch_dtype
+            )
+        # load unet (network required), the finetuned weights are loaded per dataset below
+        unet_args = SimpleNamespace(pretrained_model_name_or_path=args.sd_model_name_or_path)
+        unet = init_unet(unet_args.pretrained_model_name_or_path, zero_cond_conv_in=True)
+        unet = unet.to(torch_dtype)
+        # construct pipeline
+        pipe = ConcatInputStableDiffusionPipeline.from_pretrained(
+            args.sd_model_name_or_path, 
+            unet=unet,
+            vae=vae,
+            safety_checker=None,
+            torch_dtype=torch_dtype)
+        pipe.scheduler = get_scheduler(args.scheduler, pipe.scheduler.config)
+        pipe.set_progress_bar_config(disable=True)
+        pipe = pipe.to(args.device)
+        # text embeddings of the two CT phases are computed once, then the text encoder is released
+        pipe.build_prompt_cache(INFERENCE_PROMPTS)
+        pipe.free_text_encoder()
+
+    if args.preview_decoder is not None:
+        # NOTE: only the decoder is replaced, the condition latents still come from the VAE encoder
+        pipe.latent_decoder = load_tiny_decoder(args.preview_decoder, torch_dtype=torch_dtype, device=args.device)
+
+    if args.mode == "direct":
+        pipe_kwargs = dict(timestep=args.direct_timestep)
+    else:
+        pipe_kwargs = dict(num_inference_steps=args.num_inference_steps,
+                           guidance_scale=args.guidance_scale,
+                           guidance_interval=args.guidance_interval,
+                           strength=args.strength)
+        if args.convergence_threshold is not None:
+            pipe_kwargs.update(convergence_threshold=args.convergence_threshold,
+                               convergence_min_steps=args.convergence_min_steps)
+
+    # the UNet batch as large as the memory allows, the VAE works on slices of it
+    pipe.vae_batch_size = args.vae_batch_size
+    batch_size = args.batch_size
+    if args.max_memory_gb is not None:
+        batch_size = plan_batch_sizes(pipe, args.max_memory_gb, max_batch_size=args.batch_size,
+                                      max_vae_batch_size=args.vae_batch_size,
+                                      guidance=args.mode == "sample" and args.guidance_scale > 1,
+                                      resolution=get_planning_resolution(args))["batch_size"]
+
+    # with `--quantize`, the finetuned weights are loaded into the float models, then int8 copies are made
+    float_unet, float_vae = (pipe.unet, pipe.vae) if args.backend == "torch" else (None, None)
+    quantized_unet_name_or_path = None
 
+    # Inference Loop!
+    queue = CaseQueue(timeout=args.lock_timeout) if args.queue else None
+    stats = []
+    for dataset_name in iter_dataset_passes(args, queue):
+        # `{dataset}` in the paths is replaced by every entry of `--datasets`, e.g. nerf_50
+        data_dir, save_dir, finetuned_unet_name_or_path = get_dataset_paths(args, dataset_name)
+        os.makedirs(save_dir, exist_ok=True)
+        target_bdmap_ids = select_cases(args, save_dir)
+        print(f"{dataset_name or data_dir}: w.r.t to `overwrite`=={args.overwrite}, will inference on {len(target_bdmap_ids)} cases!")
+
+        while len(target_bdmap_ids) > 0:
+            if queue is None:
+                bdmap_ids, claimed, target_bdmap_ids = target_bdmap_ids, [], []
+            else:   # a few cases at a time, the other workers take the rest
+                lock_paths = {os.path.join(save_dir, bdmap_id, "ct_care.lock"): bdmap_id for bdmap_id in target_bdmap_ids}
+                claimed = queue.claim(lock_paths, args.claim_size, is_done=is_case_done)
+                if len(claimed) == 0:   # every remaining case is done or held by another worker, see `iter_dataset_passes`
+                    break
+                bdmap_ids = [lock_paths[lock_path] for lock_path in claimed]
+            if loaded_unet_name_or_path != finetuned_unet_name_or_path:
+                if args.backend == "onnx":
+                    pipe = load_onnx_pipeline(finetuned_unet_name_or_path, num_threads=args.num_threads)
+                    pipe.vae_batch_size = args.vae_batch_size
+                else:
+                    load_unet_weights(float_unet, finetuned_unet_name_or_path)
+                loaded_unet_name_or_path = finetuned_unet_name_or_path
+            if args.quantize != "none" and quantized_unet_name_or_path != finetuned_unet_name_or_path:
+                calibration_batches = None
+                if args.quantize == "static":   # a few slices of other cases of the same reconstruction method
+                    calibration_ids = [bdmap_id[:-2] for bdmap_id in pd.read_csv(args.calibration_split_csv)["bdmap_id"]
+                                       if os.path.exists(os.path.join(data_dir, bdmap_id[:-2], "ct.nii.gz"))]
+                    assert len(calibration_ids) > 0, f"no case of {args.calibration_split_csv} in {data_dir}"
+                    calibration_batches = get_calibration_batches(data_dir, calibration_ids[:args.calibration_cases],
+                                                                  get_inference_transforms(),
+                                                                  num_windows=args.calibration_windows,
+                                                                  batch_size=batch_size,
+                                                                  native_resolution=args.native_resolution)
+                calibration_kwargs = dict(pipe_kwargs)
+                if args.mode == "sample":
+                    calibration_kwargs["num_inference_steps"] = min(args.num_inference_steps, args.calibration_steps)
+                tic = time.time()
+                quantize_pipeline(pipe, args.quantize, float_unet, float_vae, calibration_batches, 
+                                  mode=args.mode, pipe_kwargs=calibration_kwargs)
+                quantized_unet_name_or_path = finetuned_unet_name_or_path
+                print(f"{args.quantize} int8 quantization: {time.time() - tic:.1f}s")
+            ct_datasets, checkpoints, latent_caches = prepare_cases(args, data_dir, save_dir, finetuned_unet_name_or_path, bdmap_ids, 
+                                                     pipe_kwargs, torch_dtype)
+            try:
+                case_stats = enhance_ct_volumes(pipe, ct_datasets, save_dir,
+                                                chunk_size=batch_size, 
+                                                num_workers=min(args.num_workers, 16),   # maximum 16 workers
+                                                pipe_kwargs=pipe_kwargs,
+                                                mode=args.mode,
+                                                checkpoints=checkpoints,
+                                                prefetch_cases=args.prefetch_cases,
+                                                decode_dir=args.decode_dir,
+                                                max_pending_slices=args.write_queue,
+                                                writer_kwargs=dict(compresslevel=args.compresslevel,
+                                                                   threads=args.compress_threads),
+                                                skip_background=args.skip_background,
+                                                background_fill=args.background_fill,
+                                                latent_caches=latent_caches,
+                                                warm_start=args.warm_start)
+            finally:
+                if queue is not None:
+                    queue.release(claimed)
+            for row in case_stats:
+                if dataset_name is not None:
+                    row["dataset"] = dataset_name
+            stats += case_stats
+
+    if args.stats_csv is not None and len(stats) > 0:
+        write_inference_stats(stats, args.stats_csv)
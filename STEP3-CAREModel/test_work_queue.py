@@ -0,0 +1,142 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from work_queue import CaseLock, CaseQueue
+
+NUM_WORKERS = 3
+NUM_ROUNDS = 30
+
+
+def write_lock(lock_path, token, age):
+    """A lock file of `token` that was last refreshed `age` seconds ago."""
+    with open(lock_path, "w") as f:
+        json.dump({"token": token, "time": time.time() - age}, f)
+    os.utime(lock_path, (time.time() - age, time.time() - age))
+
+
+def race_worker(lock_path, timeout, barrier, results):
+    """Every round: wait for the setup, try to claim the lock at the same time as the others."""
+    for round_idx in range(NUM_ROUNDS):
+        barrier.wait()
+        lock = CaseLock(lock_path, timeout)
+        results.put((round_idx, lock.acquire(), lock.token))
+        barrier.wait()
+
+
+def owner_worker(lock_path, timeout, stop, results):
+    """A live owner that keeps refreshing its lock, reports every failed refresh."""
+    lock = CaseLock(lock_path, timeout)
+    assert lock.acquire()
+    results.put(("token", lock.token))
+    while not stop.is_set():
+        if not lock.touch():
+            results.put(("lost", time.time()))
+        time.sleep(timeout / 20)
+    lock.release()
+
+
+def crashed_worker(lock_path, timeout):
+    """Claims a case and dies without a heartbeat or a release."""
+    assert CaseLock(lock_path, timeout).acquire()
+    os._exit(0)
+
+
+def breaker_worker(lock_path, timeout, stop, results):
+    """Hammers `acquire` on a lock that only looks stale between two refreshes of its owner."""
+    while not stop.is_set():
+        lock = CaseLock(lock_path, timeout)
+        if lock.acquire():
+            results.put(("won", lock.token))
+            lock.release()
+
+
+class CaseLockRaceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.tmpdir.name, "BDMAP_O0000001.lock")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_three_workers_break_a_stale_lock_once(self):
+        ctx = multiprocessing.get_context("fork")
+        barrier, results = ctx.Barrier(NUM_WORKERS + 1, timeout=30), ctx.Queue()  # NOTE: a crashed worker breaks it
+        workers = [ctx.Process(target=race_worker, args=(self.lock_path, 60, barrier, results)) for _ in range(NUM_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for round_idx in range(NUM_ROUNDS):
+            write_lock(self.lock_path, "crashed-worker", age=120)
+            barrier.wait()  # NOTE: all workers race for the stale lock
+            barrier.wait()
+            round_results = [results.get(timeout=10) for _ in range(NUM_WORKERS)]
+            winners = [token for _, won, token in round_results if won]
+            self.assertEqual(len(winners), 1, f"round {round_idx}: {round_results}")
+            with open(self.lock_path) as f:
+                self.assertEqual(json.load(f)["token"], winners[0])
+            os.remove(self.lock_path)
+        for worker in workers:
+            worker.join(timeout=10)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), [])  # no `.break` / `.stale` files left
+
+    def test_live_lock_is_never_taken(self):
+        ctx = multiprocessing.get_context("fork")
+        timeout = 1.0   # NOTE: the owner refreshes every timeout / 20, the lock never gets stale
+        stop_owner, stop_breakers, results = ctx.Event(), ctx.Event(), ctx.Queue()
+        owner = ctx.Process(target=owner_worker, args=(self.lock_path, timeout, stop_owner, results))
+        owner.start()
+        self.assertEqual(results.get(timeout=10)[0], "token")
+        breakers = [ctx.Process(target=breaker_worker, args=(self.lock_path, timeout, stop_breakers, results)) 
+                    for _ in range(NUM_WORKERS)]
+        for breaker in breakers:
+            breaker.start()
+        time.sleep(2)
+        stop_breakers.set()     # NOTE: before the owner releases, afterwards the case is free
+        for breaker in breakers:
+            breaker.join(timeout=10)
+        stop_owner.set()
+        owner.join(timeout=10)
+        events = []
+        while not results.empty():
+            events.append(results.get())
+        self.assertEqual(events, [])    # nobody won the case, the owner never lost its lock
+
+
+class CaseQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_claim_of_a_crashed_worker_is_redone(self):
+        timeout = 1.0
+        lock_paths = [os.path.join(self.tmpdir.name, f"BDMAP_O000000{idx}", "ct_care.lock") for idx in range(3)]
+        is_done = lambda lock_path: os.path.exists(lock_path.replace("ct_care.lock", "ct_care.nii.gz"))
+        crashed = multiprocessing.get_context("fork").Process(target=crashed_worker, args=(lock_paths[1], timeout))
+        crashed.start()
+        crashed.join(timeout=10)
+        self.assertTrue(os.path.exists(lock_paths[1]))
+
+        # NOTE: the loop of `testEnhanceCTPipeline.py --queue` (`iter_dataset_passes`)
+        queue, done, start = CaseQueue(timeout=timeout), [], time.time()
+        while time.time() - start < 30:
+            claimed = queue.claim(lock_paths, 2, is_done=is_done)
+            for lock_path in claimed:
+                open(lock_path.replace("ct_care.lock", "ct_care.nii.gz"), "w").close()
+                done.append(lock_path)
+            queue.release(claimed)
+            if len(claimed) == 0:
+                if len(queue.pending(lock_paths, is_done)) == 0:
+                    break
+                time.sleep(queue.poll_interval)
+        self.assertEqual(sorted(done), sorted(lock_paths))  # the crashed worker's case too, once
+        self.assertEqual(done[-1], lock_paths[1])   # NOTE: the free cases first, then the expired claim
+        self.assertFalse(any(os.path.exists(lock_path) for lock_path in lock_paths))
+
+
+if __name__ == "__main__":
+    unittest.main()
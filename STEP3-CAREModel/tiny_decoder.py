@@ -0,0 +1,31 @@
+"""
+Small CT latent decoder distilled from the fine-tuned `AutoencoderKL` decoder (`train_tiny_decoder.py`).
+
+The model is a TAESD-style diffusers `AutoencoderTiny` of which only the decoder is trained
+and used: it maps the scaled VAE latents (B 4 h w), i.e. `latent_dist.sample() * scaling_factor`
+as the UNet sees them and TAESD was trained on, to images in [-1, 1], like `AutoencoderKL.decode`
+of the unscaled latents, at a fraction of its cost. NOTE: `DecoderTiny` squashes its input
+with `tanh(x / 3) * 3`, unscaled latents would be clipped. It replaces the full decoder in the
+enhancer (`testEnhanceCTPipeline.py --preview_decoder`) and in the CARE loss
+(`train_text_to_image.py` / `train_distill.py --loss_decoder`).
+"""
+from diffusers import AutoencoderTiny
+
+SUBFOLDER = "tiny_decoder"  # <checkpoint>/tiny_decoder/
+
+
+def build_tiny_decoder(latent_channels=4, channels=64, num_blocks=(3, 3, 3, 1)):
+    """Untrained decoder, `channels` per block (64: TAESD, ~1.2M parameters in the decoder)."""
+    return AutoencoderTiny(
+        latent_channels=latent_channels,
+        encoder_block_out_channels=(channels,) * 4,     # NOTE: unused, only the decoder is trained
+        decoder_block_out_channels=(channels,) * len(num_blocks),
+        num_decoder_blocks=num_blocks,
+    )
+
+
+def load_tiny_decoder(path, torch_dtype=None, device="cpu"):
+    """Frozen decoder of a `train_tiny_decoder.py` checkpoint folder."""
+    decoder = AutoencoderTiny.from_pretrained(path, subfolder=SUBFOLDER, torch_dtype=torch_dtype)
+    decoder.requires_grad_(False)
+    return decoder.eval().to(device)
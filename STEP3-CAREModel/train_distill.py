@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Progressive distillation (Salimans & Ho, 2022) of a trained CARE UNet into a few-step student.
+
+Every stage trains a student to match TWO DDIM steps of its teacher with ONE DDIM step, on the
+exact timesteps `testEnhanceCTPipeline.py --scheduler ddim[_trailing] --num_inference_steps N`
+samples. The student of a stage is the teacher of the next one (`--distill_steps 16 8 4 2`:
+the CARE UNet at 32 steps -> 16 -> ... -> 2 steps). The student keeps the 8-channel concat UNet of
+`init_unet`, so its checkpoints load with `--finetuned_unet_name_or_path` as any CARE UNet:
+
+    <output_dir>/checkpoint-<step>/unet/            student of the current stage (accelerate state for resuming)
+    <output_dir>/student-<N>steps/unet/             final student of every stage
+    <output_dir>/student-<N>steps/distill.json      sampler settings of the enhancer for it
+
+The frozen fine-tuned VAE and, with `--seg_model_path`, the nnUNet CARE loss of
+`train_text_to_image.py` are applied to the x0 prediction of the student.
+
+NOTE: there is no 1-step student. The UNet predicts epsilon, and the single step of a
+1-step student starts at t=999 (alpha_cumprod ~ 0.0047), where x0 = (x_t - sqrt(1 - a) eps) / sqrt(a)
+amplifies every eps error ~15x; that needs an x0 / v-parameterized student.
+"""
+import argparse
+import json
+import math
+import os
+
+import safetensors
+import torch
+import torch.nn.functional as F
+from accelerate.logging import get_logger
+from diffusers import AutoencoderKL, DDIMScheduler
+from diffusers.optimization import get_scheduler
+from diffusers.utils.torch_utils import is_compiled_module
+from tqdm.auto import tqdm
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from care_loss import load_seg_model, ct_preprocessing_for_nnunet
+from testEnhanceCTPipeline import init_unet, predict_start_from_noise
+from tiny_decoder import load_tiny_decoder
+from training_utils import add_training_args, setup_accelerator, register_checkpoint_hooks, get_train_case_dirs, \
+    get_train_dataloader, save_checkpoint, resume_from_checkpoint, skip_resumed_batches
+
+logger = get_logger(__name__, log_level="INFO")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Progressive step distillation of a CARE UNet.")
+    parser.add_argument("--sd_model_name_or_path", type=str, required=True,
+                        help="Template Stable Diffusion model (UNet config, text encoder, scheduler).")
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, required=True, help="Fine-tuned VAE (STEP1).")
+    parser.add_argument("--teacher_unet_name_or_path", type=str, required=True,
+                        help="Trained CARE UNet checkpoint (STEP3 `train_text_to_image.py`), the first teacher.")
+    parser.add_argument("--seg_model_path", type=str, default=None,
+                        help="nnUNet anatomy segmentator, enables the CARE segmentation loss on the student x0.")
+    parser.add_argument("--output_dir", type=str, default="logs/distill")
+    parser.add_argument("--distill_steps", type=int, nargs="+", default=[16, 8, 4, 2],
+                        help="Student steps of every stage (>= 2), each stage distills 2 steps of its teacher into 1.")
+    parser.add_argument("--steps_per_stage", type=int, default=5000, help="Optimization steps of every stage.")
+    parser.add_argument("--timestep_spacing", type=str, default="trailing", choices=["leading", "trailing"],
+                        help="DDIM timesteps of the student, `trailing` (`--scheduler ddim_trailing`) starts few-step "
+                             "students at t=999 instead of the low-noise start of the SD `leading` default.")
+    parser.add_argument("--guidance_scale", type=float, default=1.0,
+                        help="Classifier-free guidance of the first teacher, > 1 distills it into the student "
+                             "(run the student with `--guidance_scale 1`).")
+    parser.add_argument("--loss_decoder", type=str, default=None,
+                        help="Decode the student x0 with this tiny decoder (`train_tiny_decoder.py`) instead of the full VAE decoder.")
+    parser.add_argument("--image_loss_weight", type=float, default=1.0, help="L1 of the decoded student x0 (HU / 1000).")
+    parser.add_argument("--seg_loss_weight", type=float, default=0.001, help="nnUNet CARE loss, needs `--seg_model_path`.")
+    parser.add_argument("--gradient_checkpointing", action="store_true")
+    add_training_args(parser)
+    parser.set_defaults(tracker_project_name="CARE-distill")
+    args = parser.parse_args()
+
+    if any(steps < 2 for steps in args.distill_steps):
+        raise ValueError("`--distill_steps` must be >= 2, a 1-step epsilon student is not supported (see the module docstring)")
+    if args.seg_model_path is None:
+        args.seg_loss_weight = 0.
+    return args
+
+
+def get_student_timesteps(scheduler, num_steps):
+    """Timesteps of the `num_steps` DDIM schedule of the enhancer and the ones each step goes to (< 0: last step)."""
+    scheduler.set_timesteps(num_steps)
+    timesteps = scheduler.timesteps.long()
+    return timesteps, timesteps - scheduler.config.num_train_timesteps // num_steps   # as `DDIMScheduler.step`
+
+
+def get_alpha(scheduler, t):
+    """alpha_bar of the timesteps `t`, as (B 1 1 1). Negative timesteps are past the last step (`final_alpha_cumprod`)."""
+    alphas_cumprod = scheduler.alphas_cumprod.to(t.device)
+    alpha = torch.where(t >= 0, alphas_cumprod[t.clamp(min=0)], scheduler.final_alpha_cumprod.to(t.device))
+    return alpha.view(-1, 1, 1, 1)
+
+
+def ddim_step(x_t, eps, alpha_t, alpha_prev):
+    """Deterministic DDIM step (eta 0) of an epsilon prediction."""
+    x0 = (x_t - (1 - alpha_t).sqrt() * eps) / alpha_t.sqrt()
+    return alpha_prev.sqrt() * x0 + (1 - alpha_prev).sqrt() * eps
+
+
+def ddim_x0_target(x_t, x_prev, alpha_t, alpha_prev):
+    """x0 for which ONE DDIM step from `x_t` lands on `x_prev` (Salimans & Ho, 2022, Algorithm 2)."""
+    ratio = ((1 - alpha_prev) / (1 - alpha_t)).sqrt()
+    return (x_prev - ratio * x_t) / (alpha_prev.sqrt() - ratio * alpha_t.sqrt())
+
+
+def predict_eps(unet, x_t, t, cond_latents, encoder_hidden_states, uncond_hidden_states=None, guidance_scale=1.):
+    """Epsilon prediction (float32) of the frozen concat UNet, with classifier-free guidance when `guidance_scale > 1`."""
+    model_input = torch.cat([x_t.to(cond_latents.dtype), cond_latents], dim=1)
+    eps = unet(model_input, t, encoder_hidden_states, return_dict=False)[0]
+    if guidance_scale > 1:
+        eps_uncond = unet(model_input, t, uncond_hidden_states, return_dict=False)[0]
+        eps = eps_uncond + guidance_scale * (eps - eps_uncond)
+    return eps.float()
+
+
+def student_dir(args, num_steps):
+    return os.path.join(args.output_dir, f"student-{num_steps}steps")
+
+
+def main():
+    args = parse_args()
+    accelerator, weight_dtype = setup_accelerator(args, logger)
+
+    # NOTE: the DDIM sampler of the enhancer, built from the same SD scheduler config
+    scheduler = DDIMScheduler.from_pretrained(args.sd_model_name_or_path, subfolder="scheduler", timestep_spacing=args.timestep_spacing)
+    enhancer_scheduler = "ddim_trailing" if args.timestep_spacing == "trailing" else "ddim"
+    tokenizer = CLIPTokenizer.from_pretrained(args.sd_model_name_or_path, subfolder="tokenizer")
+    text_encoder = CLIPTextModel.from_pretrained(args.sd_model_name_or_path, subfolder="text_encoder")
+    vae = AutoencoderKL.from_pretrained(args.finetuned_vae_name_or_path, subfolder="vae")
+    text_encoder.requires_grad_(False).to(accelerator.device, dtype=weight_dtype)
+    vae.requires_grad_(False).to(accelerator.device, dtype=weight_dtype)
+    loss_decoder = vae if args.loss_decoder is None else load_tiny_decoder(args.loss_decoder, torch_dtype=weight_dtype, device=accelerator.device)
+
+    teacher_ckpt = safetensors.torch.load_file(os.path.join(args.teacher_unet_name_or_path, "unet", "diffusion_pytorch_model.safetensors"))
+    student = init_unet(args.sd_model_name_or_path, zero_cond_conv_in=True)
+    student.load_state_dict(teacher_ckpt, strict=True)
+    teacher = init_unet(args.sd_model_name_or_path, zero_cond_conv_in=True)
+    teacher.load_state_dict(teacher_ckpt, strict=True)
+    teacher.requires_grad_(False).eval().to(accelerator.device, dtype=weight_dtype)
+    student.train()
+    if args.gradient_checkpointing:
+        student.enable_gradient_checkpointing()
+
+    seg_model = None
+    if args.seg_model_path is not None:     # NOTE: the CARE loss of `train_text_to_image.py`
+        seg_model, predictor_trainset_meta = load_seg_model(args.seg_model_path, accelerator.device)
+
+    def unwrap_model(model):
+        model = accelerator.unwrap_model(model)
+        return model._orig_mod if is_compiled_module(model) else model
+
+    stage_state = {"stage": 0}  # NOTE: stage of the checkpoints written by `save_model_hook`
+
+    def save_model(output_dir):
+        unwrap_model(student).save_pretrained(os.path.join(output_dir, "unet"))
+        num_steps = args.distill_steps[stage_state["stage"]]
+        with open(os.path.join(output_dir, "distill.json"), "w") as f:
+            json.dump({"scheduler": enhancer_scheduler, "num_inference_steps": num_steps, "guidance_scale": 1.0}, f, indent=2)
+
+    def load_model(input_dir):
+        unwrap_model(student).load_state_dict(safetensors.torch.load_file(os.path.join(input_dir, "unet", "diffusion_pytorch_model.safetensors")))
+
+    register_checkpoint_hooks(accelerator, save_model, load_model)
+
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.learning_rate, betas=(args.adam_beta1, args.adam_beta2),
+                                  weight_decay=args.adam_weight_decay, eps=args.adam_epsilon)
+
+    # NOTE: same cases and augmentation as `train_text_to_image.py`
+    case_dirs = get_train_case_dirs(args.train_data_dir, args.train_split_csv)
+    if accelerator.is_local_main_process:
+        print(f"\033[32mFound {len(case_dirs)} CT scans for distillation...\033[0m")
+    train_dataset, train_dataloader = get_train_dataloader(case_dirs, tokenizer, args.resolution, args.train_batch_size,
+                                                           args.dataloader_num_workers)
+
+    max_train_steps = args.steps_per_stage * len(args.distill_steps)
+    lr_scheduler = get_scheduler(args.lr_scheduler, optimizer=optimizer, num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+                                 num_training_steps=max_train_steps * accelerator.num_processes)
+    student, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(student, optimizer, train_dataloader, lr_scheduler)
+    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    num_train_epochs = math.ceil(max_train_steps / num_update_steps_per_epoch)
+
+    if accelerator.is_main_process:
+        accelerator.init_trackers(args.tracker_project_name, {key: str(value) for key, value in vars(args).items()})
+
+    with torch.no_grad():   # NOTE: the unconditional embedding of the pipeline (empty negative prompt)
+        uncond_ids = tokenizer([""], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids
+        uncond_hidden_states = text_encoder(uncond_ids.to(accelerator.device), return_dict=False)[0]
+
+    global_step = resume_from_checkpoint(accelerator, args.output_dir, args.resume_from_checkpoint)
+    first_epoch = global_step // num_update_steps_per_epoch
+
+    def start_stage(stage):
+        """The teacher of `stage` is the final student of the previous one (the CARE UNet for the first)."""
+        stage_state["stage"] = stage
+        if stage > 0:
+            teacher_path = os.path.join(student_dir(args, args.distill_steps[stage - 1]), "unet", "diffusion_pytorch_model.safetensors")
+            teacher.load_state_dict(safetensors.torch.load_file(teacher_path, device=str(accelerator.device)))
+        timesteps, prev_timesteps = get_student_timesteps(scheduler, args.distill_steps[stage])
+        logger.info(f"Stage {stage}: {2 * args.distill_steps[stage]} teacher steps -> {args.distill_steps[stage]} student steps, "
+                    f"timesteps {timesteps.tolist()}")
+        return timesteps.to(accelerator.device), prev_timesteps.to(accelerator.device)
+
+    stage = min(global_step // args.steps_per_stage, len(args.distill_steps) - 1)
+    timesteps, prev_timesteps = start_stage(stage)
+
+    logger.info("***** Running distillation *****")
+    logger.info(f"  Num examples = {len(train_dataset)}")
+    logger.info(f"  Stages = {args.distill_steps}, {args.steps_per_stage} steps each")
+    logger.info(f"  Total optimization steps = {max_train_steps}")
+    progress_bar = tqdm(range(0, max_train_steps), initial=global_step, desc="Steps", disable=not accelerator.is_local_main_process)
+
+    for epoch in range(first_epoch, num_train_epochs):
+        epoch_dataloader = (skip_resumed_batches(accelerator, train_dataloader, global_step, args.gradient_accumulation_steps)
+                            if epoch == first_epoch else train_dataloader)
+        for step, batch in enumerate(epoch_dataloader):
+            with accelerator.accumulate(student):
+                raw_image = batch["pixel_values"].to(weight_dtype)
+                cond_image = batch["cond_pixel_values"].to(weight_dtype)
+                with torch.no_grad():
+                    latents = vae.encode(raw_image).latent_dist.sample() * vae.config.scaling_factor
+                    cond_latents = vae.encode(cond_image).latent_dist.sample() * vae.config.scaling_factor
+                    encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+                bsz = latents.shape[0]
+
+                # one random step of the student schedule per sample, the first one starts from pure noise as the pipeline
+                noise = torch.randn_like(latents)
+                step_idx = torch.randint(0, len(timesteps), (bsz,), device=latents.device)
+                t, t_prev = timesteps[step_idx], prev_timesteps[step_idx]
+                t_mid = torch.div(t + t_prev, 2, rounding_mode="floor")
+                alpha_t, alpha_mid, alpha_prev = get_alpha(scheduler, t), get_alpha(scheduler, t_mid), get_alpha(scheduler, t_prev)
+                noisy_latents = torch.where((step_idx == 0).view(-1, 1, 1, 1), noise.float(), 
+                                            alpha_t.sqrt() * latents.float() + (1 - alpha_t).sqrt() * noise.float())
+
+                # two DDIM steps of the teacher
+                with torch.no_grad():
+                    guidance_scale = args.guidance_scale if stage == 0 else 1.  # NOTE: later teachers already absorbed it
+                    uncond = uncond_hidden_states.expand(bsz, -1, -1)
+                    x_mid = ddim_step(noisy_latents, predict_eps(teacher, noisy_latents, t, cond_latents, encoder_hidden_states, uncond, guidance_scale),
+                                      alpha_t, alpha_mid)
+                    x_prev = ddim_step(x_mid, predict_eps(teacher, x_mid, t_mid, cond_latents, encoder_hidden_states, uncond, guidance_scale),
+                                       alpha_mid, alpha_prev)
+                    x0_target = ddim_x0_target(noisy_latents, x_prev, alpha_t, alpha_prev)
+
+                # one DDIM step of the student, loss on x0 with the truncated SNR weighting max(SNR, 1) of the paper
+                model_pred = student(torch.cat([noisy_latents.to(cond_latents.dtype), cond_latents], dim=1), t, encoder_hidden_states, return_dict=False)[0]
+                latents_pred = predict_start_from_noise(noisy_latents, t, model_pred.float(), scheduler.alphas_cumprod.to(latents.device))
+                snr_weight = (alpha_t / (1 - alpha_t)).clamp(min=1.)
+                distill_loss = (snr_weight * (latents_pred - x0_target) ** 2).mean()
+                loss = distill_loss
+
+                if args.image_loss_weight > 0 or seg_model is not None:
+                    # NOTE: the tiny decoder takes the scaled latents, `AutoencoderKL.decode` the unscaled ones
+                    loss_latents = latents_pred if args.loss_decoder is not None else latents_pred / vae.config.scaling_factor
+                    estimated_image = loss_decoder.decode(loss_latents.to(weight_dtype), return_dict=False)[0]
+                    estimated_image = estimated_image.clamp(-1, 1) * 1000
+                    loss = loss + args.image_loss_weight * F.l1_loss(estimated_image.float() / 1000., raw_image.float())
+                    if seg_model is not None:
+                        b, c, h, w = estimated_image.shape
+                        pred_logits = seg_model(ct_preprocessing_for_nnunet(estimated_image.reshape(b*c, 1, h, w), predictor_trainset_meta))
+                        gt_masks = batch["gt_pixel_values"].reshape(b*c, 1, h, w).squeeze().long()
+                        loss = loss + args.seg_loss_weight * F.cross_entropy(pred_logits, gt_masks)
+
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(student.parameters(), args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+
+            if accelerator.sync_gradients:
+                progress_bar.update(1)
+                global_step += 1
+                accelerator.log({"train_loss": loss.detach().item(), "distill_loss": distill_loss.detach().item(),
+                                 "student_steps": args.distill_steps[stage]}, step=global_step)
+
+                if global_step % args.checkpointing_steps == 0 and accelerator.is_main_process:
+                    save_checkpoint(accelerator, args.output_dir, global_step, args.checkpoints_total_limit, logger)
+
+                if global_step % args.steps_per_stage == 0:     # NOTE: end of a stage, its student becomes the next teacher
+                    if accelerator.is_main_process:
+                        save_path = student_dir(args, args.distill_steps[stage])
+                        unwrap_model(student).save_pretrained(os.path.join(save_path, "unet"))
+                        with open(os.path.join(save_path, "distill.json"), "w") as f:
+                            json.dump({"scheduler": enhancer_scheduler, "num_inference_steps": args.distill_steps[stage],
+                                       "guidance_scale": 1.0, "global_step": global_step}, f, indent=2)
+                        logger.info(f"Saved the {args.distill_steps[stage]}-step student to {save_path}")
+                    accelerator.wait_for_everyone()
+                    if stage + 1 < len(args.distill_steps):
+                        stage += 1
+                        timesteps, prev_timesteps = start_stage(stage)
+
+            progress_bar.set_postfix(loss=loss.detach().item(), student_steps=args.distill_steps[stage], lr=lr_scheduler.get_last_lr()[0])
+            if global_step >= max_train_steps:
+                break
+        if global_step >= max_train_steps:
+            break
+
+    accelerator.wait_for_everyone()
+    accelerator.end_training()
+
+
+if __name__ == "__main__":
+    main()
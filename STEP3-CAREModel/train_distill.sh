@@ -0,0 +1,29 @@
+export SD_MODEL_NAME="stable-diffusion-v1-5/stable-diffusion-v1-5"
+export FT_VAE_NAME="../STEP1-AutoEncoderModel/klvae/logs/klvae/checkpoint-150000"
+export SEG_MODEL_NAME="./AnatomySegmentator2D"
+DATASET_NAME=$1
+
+export TEACHER_UNET_NAME="logs/$DATASET_NAME/checkpoint-100000"    # trained by train.sh
+export TRAIN_DATA_DIR="../ReconstructionPipeline/BDMAP_O_$DATASET_NAME/" 
+
+
+accelerate launch --mixed_precision="no" train_distill.py \
+  --sd_model_name_or_path=$SD_MODEL_NAME \
+  --finetuned_vae_name_or_path=$FT_VAE_NAME \
+  --teacher_unet_name_or_path=$TEACHER_UNET_NAME \
+  --seg_model_path=$SEG_MODEL_NAME \
+  --train_data_dir=$TRAIN_DATA_DIR \
+  --resume_from_checkpoint="latest" \
+  --distill_steps 16 8 4 2 \
+  --steps_per_stage=5000 \
+  --resolution=512 \
+  --train_batch_size=2 \
+  --gradient_accumulation_steps=2 \
+  --dataloader_num_workers=1 \
+  --learning_rate=1e-05 \
+  --max_grad_norm=1 \
+  --lr_scheduler="constant" \
+  --report_to=wandb \
+  --checkpointing_steps=1000 \
+  --checkpoints_total_limit=1 \
+  --output_dir="logs/distill_$DATASET_NAME"
@@ -19,10 +19,8 @@ import logging
 import math
 import os
 import random
-import shutil
 from contextlib import nullcontext
 from pathlib import Path
-import pandas as pd
 
 import accelerate
 import datasets
@@ -59,15 +57,16 @@ from PIL import Image
 from dataset import (
     load_CT_slice, 
     HWCarrayToCHWtensor, 
-    ReconCTDataset, 
     varifyh5, 
-    collate_fn
 )
 from diffusers import DDIMScheduler, StableDiffusionImg2ImgPipeline
-from testEnhanceCTPipeline import ConcatInputStableDiffusionPipeline, init_unet
+from testEnhanceCTPipeline import ConcatInputStableDiffusionPipeline, init_unet, predict_start_from_noise
+from tiny_decoder import load_tiny_decoder
 import safetensors
 
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from care_loss import load_seg_model, ct_preprocessing_for_nnunet
+from training_utils import get_train_case_dirs, get_train_transforms, get_train_dataloader, save_checkpoint, \
+    resume_from_checkpoint, skip_resumed_batches
 
 if is_wandb_available():
     import wandb
@@ -79,21 +78,6 @@ if is_wandb_available():
 logger = get_logger(__name__, log_level="INFO")
 
 
-
-# got these from latent diffusion code:
-def predict_start_from_noise(x_t, t, noise, alphas_cumprod):
-    def extract_into_tensor(a, t, x_shape):
-        b, *_ = t.shape
-        out = a.gather(-1, t)
-        return out.reshape(b, *((1,) * (len(x_shape) - 1)))
-    
-    sqrt_recip_alphas_cumprod = torch.sqrt(1. / alphas_cumprod)
-    sqrt_recipm1_alphas_cumprod = torch.sqrt(1. / alphas_cumprod - 1)
-    return (
-            extract_into_tensor(sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract_into_tensor(sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
-    )
-
 # DATASET_NAME_MAPPING = {
 #     "lambdalabs/naruto-blip-captions": ("image", "text"),
 # }
@@ -243,7 +227,7 @@ def log_validation(vae, text_encoder, tokenizer, unet, scheduler, args, accelera
                                 cond_latents=cond_latents).images[0]
 
         # NOTE: pixel-space, segmentation
-        image4seg = (torch.from_numpy(np.asarray(image).copy()).permute(2, 0, 1)[None].float().cuda()/255. * 2 - 1) * 1000
+        image4seg = (torch.from_numpy(np.asarray(image).copy()).permute(2, 0, 1)[None].float().to(accelerator.device)/255. * 2 - 1) * 1000
         # image4seg = ((((cond_image + 1)/2)*255).int().float()/255*2-1)*1000
         # image4seg = cond_image*1000
         b, c, h, w = image4seg.shape
@@ -252,12 +236,12 @@ def log_validation(vae, text_encoder, tokenizer, unet, scheduler, args, accelera
         # print(gt_image.shape, seg_image.shape)
 
         # NOTE: directly get result from noising adding formula
-        final_tiemstep = torch.Tensor([499]).long().cuda()
-        input_ids = tokenizer(args.validation_prompts[i], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids.cuda()
+        final_tiemstep = torch.Tensor([499]).long().to(accelerator.device)
+        input_ids = tokenizer(args.validation_prompts[i], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt").input_ids.to(accelerator.device)
         encoder_hidden_states = text_encoder(input_ids, return_dict=False)[0]
-        noisy_latents_with_cond = torch.cat([latents, cond_latents], dim=1).cuda()  # original latents for conditioning
+        noisy_latents_with_cond = torch.cat([latents, cond_latents], dim=1).to(accelerator.device)  # original latents for conditioning
         model_pred = unet(noisy_latents_with_cond, final_tiemstep, encoder_hidden_states, return_dict=False)[0]
-        latents_pred = predict_start_from_noise(latents, final_tiemstep, model_pred, scheduler.alphas_cumprod.cuda())   # SDSeg equation (2) lol
+        latents_pred = predict_start_from_noise(latents, final_tiemstep, model_pred, scheduler.alphas_cumprod.to(accelerator.device))   # SDSeg equation (2) lol
         direct_image = vae.decode(latents_pred / vae.config.scaling_factor, return_dict=False, generator=None)[0]
         direct_image = (direct_image.clamp(-1, 1) * 1000)
         b, c, h, w = direct_image.shape
@@ -650,6 +634,12 @@ def parse_args():
         default=500,
         help="Run validation every X epochs.",
     )
+    parser.add_argument(
+        "--loss_decoder",
+        type=str,
+        default=None,
+        help="Decode the x0 prediction of the CARE loss with this tiny decoder (`train_tiny_decoder.py` checkpoint) instead of the full VAE decoder.",
+    )
     parser.add_argument(
         "--vae_loss",
         type=str,
@@ -797,30 +787,7 @@ def main():
     text_encoder.requires_grad_(False)
     unet.train()
 
-    predictor = nnUNetPredictor(
-        tile_step_size=0.5,
-        use_gaussian=True,
-        use_mirroring=True,
-        perform_everything_on_device=False,     # False when encountering memory constraints
-        device=torch.device('cuda', 0),
-        verbose=False,
-        verbose_preprocessing=False,
-        allow_tqdm=True
-    )
-    predictor.initialize_from_trained_model_folder(
-        args.seg_model_path,
-        use_folds=('all',),
-        checkpoint_name='checkpoint_final.pth',
-    )
-    seg_model = predictor.network.cuda()   # will send to cuda device later in the accelerator
-    seg_model.eval()                       
-    seg_model.requires_grad_(False)
-    predictor_trainset_meta = predictor.plans_manager.plans["foreground_intensity_properties_per_channel"]["0"]
-    def ct_preprocessing_for_nnunet(image, trainset_meta):
-        image = torch.clamp(image, trainset_meta["percentile_00_5"],trainset_meta["percentile_99_5"])
-        image -= trainset_meta["mean"]
-        image /= trainset_meta["std"]
-        return image
+    seg_model, predictor_trainset_meta = load_seg_model(args.seg_model_path, accelerator.device)
 
 
     # Create EMA for the unet.
@@ -960,12 +927,7 @@ def main():
         # dataset["train"] = sorted([entry.path.replace("ct.h5", "") 
         #                             for path in  dataset["train"] for entry in os.scandir(path) 
         #                                 if entry.name == "ct.h5"]) # check if h5 file exist and is valid ( `and varifyh5(entry.path)`)
-        bdmap_id_train = pd.read_csv("splits/BDMAP_O_AV_meta_train.csv")["bdmap_id"].apply(lambda x: x[:-2]).tolist()
-        dataset["train"] = [entry.path for entry in os.scandir(args.train_data_dir)
-                            if entry.name in bdmap_id_train]    # FELIX data
-        dataset["train"] = sorted([entry.path.replace("ct.h5", "") 
-                                    for path in  dataset["train"] for entry in os.scandir(path) 
-                                        if entry.name == "ct.h5"]) # check if h5 file exist and is valid ( `and varifyh5(entry.path)`)
+        dataset["train"] = get_train_case_dirs(args.train_data_dir)    # NOTE: shared with `train_distill.py` / `train_tiny_decoder.py`
         if accelerator.is_local_main_process:
             print(f"\033[32mFound {len(dataset['train'])} CT scans for training...\033[0m")
 
@@ -1021,19 +983,7 @@ def main():
     #         transforms.Normalize([0.5], [0.5]),
     #     ]
     # )
-    train_transforms = A.Compose([
-        A.Resize(args.resolution, args.resolution, interpolation=cv2.INTER_LINEAR),
-        A.RandomResizedCrop((args.resolution, args.resolution), scale=(0.75, 1.0), ratio=(1., 1.), p=0.5),
-        A.HorizontalFlip(p=0.5),
-        A.RandomRotate90(p=0.5),
-        # A.Normalize(
-        #     mean=(0.5, 0.5, 0.5),
-        #     std=(0.5, 0.5, 0.5),
-        #     max_pixel_value=1.0,
-        #     p=1.0
-        # ),
-        # HWCarrayToCHWtensor(p=1.),
-    ], additional_targets={'cond': 'image', 'mask': 'image'})    # NOTE: conduct the exact same transformation for `cond` and `mask`
+    train_transforms = get_train_transforms(args.resolution)  # NOTE: conduct the exact same transformation for `cond` and `mask`
     cond_transforms = train_transforms
     # downsampling_factor = 4
     # cond_transforms = A.Compose([   # NOTE: degrade!!! for the model to recover details
@@ -1061,7 +1011,6 @@ def main():
         # HWCarrayToCHWtensor(p=1.),
     ])
 
-    train_dataset = ReconCTDataset(dataset["train"], image_transforms=train_transforms, cond_transforms=cond_transforms, tokenizer=tokenizer)
 
     # def preprocess_train(examples):
     #     images = [image.convert("RGB") for image in examples[image_column]]
@@ -1076,14 +1025,9 @@ def main():
     #     train_dataset = dataset["train"].with_transform(preprocess_train)
 
 
-    # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        shuffle=True,
-        collate_fn=collate_fn,
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
-    )
+    # DataLoaders creation: `ReconCTDataset` with `train_transforms`
+    train_dataset, train_dataloader = get_train_dataloader(dataset["train"], tokenizer, args.resolution, args.train_batch_size,
+                                                           args.dataloader_num_workers)
 
     # Scheduler and math around the number of training steps.
     # Check the PR https://github.com/huggingface/diffusers/pull/8312 for detailed explanation.
@@ -1128,6 +1072,8 @@ def main():
     # Move text_encode and vae to gpu and cast to weight_dtype
     text_encoder.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
+    # NOTE: frozen, gradients still flow through it to the UNet; validation keeps the full VAE decoder
+    loss_decoder = vae if args.loss_decoder is None else load_tiny_decoder(args.loss_decoder, torch_dtype=weight_dtype, device=accelerator.device)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -1169,32 +1115,9 @@ def main():
     first_epoch = 0
 
     # Potentially load in the weights and states from a previous save
-    if args.resume_from_checkpoint:
-        if args.resume_from_checkpoint != "latest":
-            path = os.path.basename(args.resume_from_checkpoint)
-        else:
-            # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-            path = dirs[-1] if len(dirs) > 0 else None
-
-        if path is None:
-            accelerator.print(
-                f"Checkpoint '{args.resume_from_checkpoint}' does not exist. Starting a new training run."
-            )
-            args.resume_from_checkpoint = None
-            initial_global_step = 0
-        else:
-            accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
-            global_step = int(path.split("-")[1])
-
-            initial_global_step = global_step
-            first_epoch = global_step // num_update_steps_per_epoch
-
-    else:
-        initial_global_step = 0
+    global_step = resume_from_checkpoint(accelerator, args.output_dir, args.resume_from_checkpoint)
+    initial_global_step = global_step
+    first_epoch = global_step // num_update_steps_per_epoch
 
     progress_bar = tqdm(
         range(0, args.max_train_steps),
@@ -1206,7 +1129,10 @@ def main():
 
     for epoch in range(first_epoch, args.num_train_epochs):
         train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
+        # the batches of the resumed epoch seen before the checkpoint are skipped
+        epoch_dataloader = (skip_resumed_batches(accelerator, train_dataloader, global_step, args.gradient_accumulation_steps)
+                            if epoch == first_epoch else train_dataloader)
+        for step, batch in enumerate(epoch_dataloader):
             # # calculate rescale factor!!! before training starts
             # if global_step == initial_global_step: 
             #     print(f"### Changing `scaling_factor` from \033[31m{vae.config.scaling_factor}\033[0m", end=" ")
@@ -1282,7 +1208,9 @@ def main():
                 latents_pred = predict_start_from_noise(noisy_latents, timesteps, model_pred, noise_scheduler.alphas_cumprod)   # SDSeg equation (2) lol
                 # print(noisy_latents.shape, model_pred.shape, latents_pred.shape, timesteps)
                 # print(noise_scheduler.alphas_cumprod.shape)
-                estimated_image = vae.decode(latents_pred / vae.config.scaling_factor, return_dict=False, generator=None)[0]
+                # NOTE: the tiny decoder takes the scaled latents, `AutoencoderKL.decode` the unscaled ones
+                loss_latents = latents_pred if args.loss_decoder is not None else latents_pred / vae.config.scaling_factor
+                estimated_image = loss_decoder.decode(loss_latents, return_dict=False, generator=None)[0]
                 image_vis = (estimated_image * 0.5 + 0.5).permute(0, 2, 3, 1).clamp(0, 1).cpu().detach().float().numpy()   # (B C H W)[-1, 1] --> (B H W C)[0, 1]
                 estimated_image = (estimated_image.clamp(-1, 1) * 1000)#.cpu().detach().float().numpy()   # (B C H W)[-1, 1] --> (B H W C)[-1000, 10000]
                 b, c, h, w = estimated_image.shape
@@ -1367,29 +1295,7 @@ def main():
 
                 if global_step % args.checkpointing_steps == 0:
                     if accelerator.is_main_process:
-                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                        if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                            checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
-
-                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                            if len(checkpoints) >= args.checkpoints_total_limit:
-                                num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
-                                removing_checkpoints = checkpoints[0:num_to_remove]
-
-                                logger.info(
-                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                                )
-                                logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
-
-                                for removing_checkpoint in removing_checkpoints:
-                                    removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
-                                    shutil.rmtree(removing_checkpoint)
-
-                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
-                        accelerator.save_state(save_path)
-                        logger.info(f"Saved state to {save_path}")
+                        save_checkpoint(accelerator, args.output_dir, global_step, args.checkpoints_total_limit, logger)
 
             logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Distill a small CT latent decoder (`tiny_decoder.py`) from the fine-tuned VAE decoder.
+
+The scaled latents of the training slices, of both the ground-truth CT and the reconstruction
+that CARE enhances, are decoded by the frozen full decoder; the tiny decoder learns to reproduce
+these images (L1), plus an optional L1 to the CT itself. `--latent_noise` also feeds it
+perturbed latents, as the x0 predictions decoded by the CARE loss are off the VAE manifold.
+
+    <output_dir>/checkpoint-<step>/tiny_decoder/    for `--preview_decoder` / `--loss_decoder`
+
+`eval_tiny_decoder.py` reports its fidelity against the full decoder.
+"""
+import argparse
+import math
+import os
+
+import torch
+import torch.nn.functional as F
+from accelerate.logging import get_logger
+from diffusers import AutoencoderKL, AutoencoderTiny
+from diffusers.optimization import get_scheduler
+from tqdm.auto import tqdm
+from transformers import CLIPTokenizer
+
+from tiny_decoder import SUBFOLDER, build_tiny_decoder
+from training_utils import add_training_args, setup_accelerator, register_checkpoint_hooks, get_train_case_dirs, \
+    get_train_dataloader, save_checkpoint, resume_from_checkpoint, skip_resumed_batches
+
+logger = get_logger(__name__, log_level="INFO")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distill a tiny CT latent decoder from the fine-tuned VAE decoder.")
+    parser.add_argument("--sd_model_name_or_path", type=str, required=True, help="Template Stable Diffusion model (tokenizer).")
+    parser.add_argument("--finetuned_vae_name_or_path", type=str, required=True, help="Fine-tuned VAE (STEP1), the teacher.")
+    parser.add_argument("--output_dir", type=str, default="logs/tiny_decoder")
+    parser.add_argument("--decoder_channels", type=int, default=64, help="Channels of every decoder block (64: TAESD).")
+    parser.add_argument("--init_decoder_name_or_path", type=str, default=None,
+                        help="Start from a pretrained `AutoencoderTiny`, e.g. madebyollin/taesd, instead of scratch.")
+    parser.add_argument("--image_loss_weight", type=float, default=0.1, help="L1 to the CT slice, next to the L1 to the full decoder.")
+    parser.add_argument("--latent_noise", type=float, default=0.1,
+                        help="Std of the Gaussian noise added to half of the latents (relative to the latent std).")
+    parser.add_argument("--max_train_steps", type=int, default=50_000)
+    add_training_args(parser)
+    parser.set_defaults(train_batch_size=4, dataloader_num_workers=2, learning_rate=1e-4, lr_scheduler="cosine", lr_warmup_steps=500,
+                        tracker_project_name="CARE-tiny-decoder")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    accelerator, weight_dtype = setup_accelerator(args, logger)
+
+    vae = AutoencoderKL.from_pretrained(args.finetuned_vae_name_or_path, subfolder="vae")
+    vae.requires_grad_(False).to(accelerator.device, dtype=weight_dtype)
+    if args.init_decoder_name_or_path is not None:
+        tiny = AutoencoderTiny.from_pretrained(args.init_decoder_name_or_path)
+    else:
+        tiny = build_tiny_decoder(latent_channels=vae.config.latent_channels, channels=args.decoder_channels)
+    tiny.encoder.requires_grad_(False)
+    decoder = tiny.decoder.train()     # NOTE: `AutoencoderTiny.decode` is this module, only it is trained and prepared
+    logger.info(f"Tiny decoder: {sum(p.numel() for p in decoder.parameters()) / 1e6:.2f}M parameters, "
+                f"full decoder: {sum(p.numel() for p in vae.decoder.parameters()) / 1e6:.2f}M")
+
+    def save_model(output_dir):
+        tiny.save_pretrained(os.path.join(output_dir, SUBFOLDER))    # the whole `AutoencoderTiny`, sharing `decoder`
+
+    def load_model(input_dir):
+        load_model = AutoencoderTiny.from_pretrained(input_dir, subfolder=SUBFOLDER)
+        tiny.load_state_dict(load_model.state_dict())
+        del load_model
+
+    register_checkpoint_hooks(accelerator, save_model, load_model)
+
+    optimizer = torch.optim.AdamW(decoder.parameters(), lr=args.learning_rate, betas=(args.adam_beta1, args.adam_beta2),
+                                  weight_decay=args.adam_weight_decay, eps=args.adam_epsilon)
+
+    # NOTE: same cases and augmentation as `train_text_to_image.py`, the prompts are unused
+    tokenizer = CLIPTokenizer.from_pretrained(args.sd_model_name_or_path, subfolder="tokenizer")
+    case_dirs = get_train_case_dirs(args.train_data_dir, args.train_split_csv)
+    if accelerator.is_local_main_process:
+        print(f"\033[32mFound {len(case_dirs)} CT scans for the tiny decoder...\033[0m")
+    train_dataset, train_dataloader = get_train_dataloader(case_dirs, tokenizer, args.resolution, args.train_batch_size,
+                                                           args.dataloader_num_workers)
+
+    lr_scheduler = get_scheduler(args.lr_scheduler, optimizer=optimizer, num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+                                 num_training_steps=args.max_train_steps * accelerator.num_processes)
+    decoder, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(decoder, optimizer, train_dataloader, lr_scheduler)
+    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+    if accelerator.is_main_process:
+        accelerator.init_trackers(args.tracker_project_name, {key: str(value) for key, value in vars(args).items()})
+
+    global_step = resume_from_checkpoint(accelerator, args.output_dir, args.resume_from_checkpoint)
+    first_epoch = global_step // num_update_steps_per_epoch
+
+    logger.info("***** Running tiny decoder distillation *****")
+    logger.info(f"  Num examples = {len(train_dataset)}")
+    logger.info(f"  Total optimization steps = {args.max_train_steps}")
+    progress_bar = tqdm(range(0, args.max_train_steps), initial=global_step, desc="Steps", disable=not accelerator.is_local_main_process)
+
+    for epoch in range(first_epoch, num_train_epochs):
+        # the batches of the resumed epoch seen before the checkpoint are skipped
+        epoch_dataloader = (skip_resumed_batches(accelerator, train_dataloader, global_step, args.gradient_accumulation_steps)
+                            if epoch == first_epoch else train_dataloader)
+        for step, batch in enumerate(epoch_dataloader):
+            with accelerator.accumulate(decoder):
+                # ground-truth and reconstructed slices, both are decoded by CARE
+                image = torch.cat([batch["pixel_values"], batch["cond_pixel_values"]]).to(weight_dtype)
+                with torch.no_grad():
+                    # NOTE: scaled, as the UNet sees them; only `vae.decode` takes the unscaled latents
+                    latents = vae.encode(image).latent_dist.sample() * vae.config.scaling_factor
+                    noisy = torch.rand(len(latents), 1, 1, 1, device=latents.device) < 0.5
+                    latents = torch.where(noisy, latents + args.latent_noise * latents.std() * torch.randn_like(latents), latents)
+                    target = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0].clamp(-1, 1)
+
+                pred = decoder(latents.float())
+                distill_loss = F.l1_loss(pred.float(), target.float())
+                loss = distill_loss + args.image_loss_weight * F.l1_loss(pred.float(), image.float())
+
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(decoder.parameters(), args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+
+            if accelerator.sync_gradients:
+                progress_bar.update(1)
+                global_step += 1
+                accelerator.log({"train_loss": loss.detach().item(), "distill_l1_hu": distill_loss.detach().item() * 1000}, step=global_step)
+
+                if global_step % args.checkpointing_steps == 0 and accelerator.is_main_process:
+                    save_checkpoint(accelerator, args.output_dir, global_step, args.checkpoints_total_limit, logger)
+
+            progress_bar.set_postfix(loss=loss.detach().item(), lr=lr_scheduler.get_last_lr()[0])
+            if global_step >= args.max_train_steps:
+                break
+        if global_step >= args.max_train_steps:
+            break
+
+    accelerator.wait_for_everyone()
+    accelerator.end_training()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+export SD_MODEL_NAME="stable-diffusion-v1-5/stable-diffusion-v1-5"
+export FT_VAE_NAME="../STEP1-AutoEncoderModel/klvae/logs/klvae/checkpoint-150000"
+DATASET_NAME=$1
+
+export TRAIN_DATA_DIR="../ReconstructionPipeline/BDMAP_O_$DATASET_NAME/" 
+
+
+accelerate launch --mixed_precision="no" train_tiny_decoder.py \
+  --sd_model_name_or_path=$SD_MODEL_NAME \
+  --finetuned_vae_name_or_path=$FT_VAE_NAME \
+  --train_data_dir=$TRAIN_DATA_DIR \
+  --resume_from_checkpoint="latest" \
+  --resolution=512 \
+  --train_batch_size=4 \
+  --dataloader_num_workers=2 \
+  --max_train_steps=50_000 \
+  --learning_rate=1e-04 \
+  --checkpointing_steps=1000 \
+  --output_dir="logs/tiny_decoder"
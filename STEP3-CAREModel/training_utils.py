@@ -0,0 +1,182 @@
+"""
+Training boilerplate shared by the STEP3 training scripts (`train_text_to_image.py`,
+`train_distill.py`, `train_tiny_decoder.py`): arguments, accelerator set-up, training
+cases and augmentation, checkpoint rotation and resuming.
+"""
+import logging
+import math
+import os
+import shutil
+
+import albumentations as A
+import cv2
+import diffusers
+import pandas as pd
+import torch
+import transformers
+from accelerate import Accelerator
+from accelerate.utils import ProjectConfiguration, set_seed
+
+from dataset import ReconCTDataset, collate_fn
+
+
+def add_training_args(parser):
+    """Data, optimizer, accelerator and checkpointing arguments, scripts change the defaults with `parser.set_defaults`."""
+    parser.add_argument("--train_data_dir", type=str, required=True, help="Folder of `BDMAP_*/ct.h5` training cases.")
+    parser.add_argument("--train_split_csv", type=str, default="splits/BDMAP_O_AV_meta_train.csv")
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--train_batch_size", type=int, default=2)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument("--dataloader_num_workers", type=int, default=1)
+    parser.add_argument("--learning_rate", type=float, default=1e-5)
+    parser.add_argument("--lr_scheduler", type=str, default="constant")
+    parser.add_argument("--lr_warmup_steps", type=int, default=0)
+    parser.add_argument("--adam_beta1", type=float, default=0.9)
+    parser.add_argument("--adam_beta2", type=float, default=0.999)
+    parser.add_argument("--adam_weight_decay", type=float, default=1e-2)
+    parser.add_argument("--adam_epsilon", type=float, default=1e-08)
+    parser.add_argument("--max_grad_norm", type=float, default=1.0)
+    parser.add_argument("--allow_tf32", action="store_true")
+    parser.add_argument("--mixed_precision", type=str, default=None, choices=["no", "fp16", "bf16"])
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--report_to", type=str, default="wandb", help="Tracker of `accelerate`, as every `.sh` script uses.")
+    parser.add_argument("--logging_dir", type=str, default="logs")
+    parser.add_argument("--tracker_project_name", type=str, default="CARE-loss")
+    parser.add_argument("--checkpointing_steps", type=int, default=1000)
+    parser.add_argument("--checkpoints_total_limit", type=int, default=None)
+    parser.add_argument("--resume_from_checkpoint", type=str, default=None, help="A `checkpoint-<step>` folder or `latest`.")
+    return parser
+
+
+def setup_accelerator(args, logger):
+    """Accelerator, logging, seed, `output_dir` and TF32 of a training run; returns it and the dtype of the frozen models."""
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
+        project_config=ProjectConfiguration(project_dir=args.output_dir, logging_dir=os.path.join(args.output_dir, args.logging_dir)),
+    )
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        transformers.utils.logging.set_verbosity_warning()
+        diffusers.utils.logging.set_verbosity_info()
+    else:
+        transformers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.set_verbosity_error()
+    if args.seed is not None:
+        set_seed(args.seed)
+    if accelerator.is_main_process:
+        os.makedirs(args.output_dir, exist_ok=True)
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+    return accelerator, weight_dtype
+
+
+def register_checkpoint_hooks(accelerator, save_model, load_model):
+    """`accelerator.save_state` / `load_state` call `save_model(output_dir)` / `load_model(input_dir)` instead of pickling the model."""
+    def save_model_hook(models, weights, output_dir):
+        if accelerator.is_main_process:
+            save_model(output_dir)
+            for _ in models:
+                weights.pop()   # NOTE: saved above, not again by accelerate
+
+    def load_model_hook(models, input_dir):
+        for _ in range(len(models)):
+            models.pop()
+        load_model(input_dir)
+
+    accelerator.register_save_state_pre_hook(save_model_hook)
+    accelerator.register_load_state_pre_hook(load_model_hook)
+
+
+def get_train_case_dirs(train_data_dir, split_csv="splits/BDMAP_O_AV_meta_train.csv"):
+    """`BDMAP_*/` folders of `train_data_dir` in the training split that hold a `ct.h5`."""
+    bdmap_id_train = pd.read_csv(split_csv)["bdmap_id"].apply(lambda x: x[:-2]).tolist()
+    case_dirs = [entry.path for entry in os.scandir(train_data_dir) if entry.name in bdmap_id_train]    # FELIX data
+    return sorted([entry.path.replace("ct.h5", "")
+                   for path in case_dirs for entry in os.scandir(path)
+                       if entry.name == "ct.h5"]) # check if h5 file exist and is valid ( `and varifyh5(entry.path)`)
+
+
+def get_train_transforms(resolution):
+    """Augmentation of the training slices, the exact same transformation for the CT, `cond` and `mask`."""
+    return A.Compose([
+        A.Resize(resolution, resolution, interpolation=cv2.INTER_LINEAR),
+        A.RandomResizedCrop((resolution, resolution), scale=(0.75, 1.0), ratio=(1., 1.), p=0.5),
+        A.HorizontalFlip(p=0.5),
+        A.RandomRotate90(p=0.5),
+    ], additional_targets={'cond': 'image', 'mask': 'image'})
+
+
+def get_train_dataloader(case_dirs, tokenizer, resolution=512, batch_size=2, num_workers=1):
+    """`ReconCTDataset` of the training cases with `get_train_transforms`, and its shuffled dataloader."""
+    train_transforms = get_train_transforms(resolution)
+    train_dataset = ReconCTDataset(case_dirs, image_transforms=train_transforms, cond_transforms=train_transforms, tokenizer=tokenizer)
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        shuffle=True,
+        collate_fn=collate_fn,
+        batch_size=batch_size,
+        num_workers=num_workers,
+    )
+    return train_dataset, train_dataloader
+
+
+def list_checkpoints(output_dir):
+    """`checkpoint-<step>` folders of `output_dir`, oldest first."""
+    checkpoints = [d for d in os.listdir(output_dir) if d.startswith("checkpoint")]
+    return sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+
+def save_checkpoint(accelerator, output_dir, global_step, checkpoints_total_limit=None, logger=None):
+    """`accelerator.save_state` to `checkpoint-<global_step>`, keeping at most `checkpoints_total_limit` of them (main process only)."""
+    # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
+    if checkpoints_total_limit is not None:
+        checkpoints = list_checkpoints(output_dir)
+        # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
+        if len(checkpoints) >= checkpoints_total_limit:
+            removing_checkpoints = checkpoints[0:len(checkpoints) - checkpoints_total_limit + 1]
+            if logger is not None:
+                logger.info(f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints")
+                logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+            for removing_checkpoint in removing_checkpoints:
+                shutil.rmtree(os.path.join(output_dir, removing_checkpoint))
+
+    save_path = os.path.join(output_dir, f"checkpoint-{global_step}")
+    accelerator.save_state(save_path)
+    if logger is not None:
+        logger.info(f"Saved state to {save_path}")
+    return save_path
+
+
+def resume_from_checkpoint(accelerator, output_dir, resume_from_checkpoint):
+    """Load a `checkpoint-<step>` folder (`latest`: the most recent one) into `accelerator`, returns its step (0: new run)."""
+    if not resume_from_checkpoint:
+        return 0
+    if resume_from_checkpoint != "latest":
+        path = os.path.basename(resume_from_checkpoint)
+    else:
+        checkpoints = list_checkpoints(output_dir) if os.path.isdir(output_dir) else []
+        path = checkpoints[-1] if len(checkpoints) > 0 else None
+    if path is None:
+        accelerator.print(f"Checkpoint '{resume_from_checkpoint}' does not exist. Starting a new training run.")
+        return 0
+    accelerator.print(f"Resuming from checkpoint {path}")
+    accelerator.load_state(os.path.join(output_dir, path))
+    return int(path.split("-")[1])
+
+
+def skip_resumed_batches(accelerator, train_dataloader, global_step, gradient_accumulation_steps=1):
+    """`train_dataloader` of the epoch a run resumes in, without the batches seen before the checkpoint of `global_step`."""
+    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / gradient_accumulation_steps)
+    resume_step = (global_step % num_update_steps_per_epoch) * gradient_accumulation_steps
+    if resume_step == 0:
+        return train_dataloader
+    return accelerator.skip_first_batches(train_dataloader, resume_step)
@@ -0,0 +1,168 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class CaseLock:
+    """Claim of ONE case by one enhancer process, an atomically created lock file.
+
+    `os.open(O_CREAT | O_EXCL)` is atomic on local disks and on NFS, so two workers
+    never hold the same case. The owner refreshes the mtime of the file (`touch`); a
+    lock that was not refreshed for `timeout` seconds belongs to a crashed worker and
+    may be broken by anyone, one worker at a time (`_break_stale`).
+    """
+    def __init__(self, lock_path, timeout=1800):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _create(self):
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": self.token, "time": time.time()}, f)
+        return True
+
+    def _read_token(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)["token"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _is_stale(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) >= self.timeout
+        except FileNotFoundError:
+            return False
+
+    def _remove_if_token(self, path, token):
+        """Remove the lock file `path` if it still holds `token`, True if it was removed.
+
+        The file is moved aside before its token is compared; a different lock that was
+        moved is linked back, which fails instead of overwriting a lock created meanwhile.
+        """
+        moved_path = f"{path}.stale.{self.token.replace(':', '_')}"
+        try:
+            os.rename(path, moved_path)
+        except FileNotFoundError:
+            return False
+        if self._read_token(moved_path) == token:
+            os.remove(moved_path)
+            return True
+        try:
+            os.link(moved_path, path)
+        except FileExistsError:
+            print(f"\033[31mlost lock {path} ({self._read_token(moved_path)}) while breaking {token}\033[0m")
+        os.remove(moved_path)
+        return False
+
+    def _break_stale(self):
+        """Remove the lock if its owner stopped refreshing it, True if there is no lock anymore.
+
+        Breakers of one lock are serialized by a second lock file (`<lock>.break`), and the
+        lock is only touched once it is confirmed stale while holding it, so a live lock is
+        never moved. A `.break` file left by a crashed breaker is itself broken after `timeout`.
+        """
+        if not os.path.exists(self.lock_path):
+            return True
+        if not self._is_stale(self.lock_path):
+            return False
+        breaker = CaseLock(self.lock_path + ".break", self.timeout)
+        if not breaker._create():
+            if not breaker._is_stale(breaker.lock_path):    # NOTE: another worker is breaking it
+                return False
+            breaker._remove_if_token(breaker.lock_path, breaker._read_token(breaker.lock_path))
+            if not breaker._create():
+                return False
+        try:
+            # NOTE: only breakers remove a lock that is not theirs, and they wait for the `.break` file
+            if not os.path.exists(self.lock_path):
+                return True
+            stale_token = self._read_token(self.lock_path)
+            if not self._is_stale(self.lock_path):  # broken and claimed again before we got the `.break` file
+                return False
+            if not self._remove_if_token(self.lock_path, stale_token):
+                return False
+            print(f"\033[31mbroke stale lock {self.lock_path} ({stale_token})\033[0m")
+            return True
+        finally:
+            breaker.release()
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        if self._create():
+            return True
+        return self._break_stale() and self._create()
+
+    def touch(self):
+        """Refresh the lock, False if it is not held by this worker anymore."""
+        if self._read_token(self.lock_path) != self.token:
+            return False
+        try:
+            os.utime(self.lock_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self):
+        if self._read_token(self.lock_path) == self.token:
+            os.remove(self.lock_path)
+
+
+class CaseQueue:
+    """Lock-file work queue: any number of workers, on one machine or on shared storage, claim cases.
+
+    Claimed locks are refreshed by a background thread every `timeout / 4` seconds, so
+    only the claims of crashed (or preempted) workers ever become stale. A stale claim is
+    only broken by `claim`: workers keep claiming every `poll_interval` seconds while
+    other workers hold unfinished cases (`pending`), and redo them once they expire.
+    """
+    def __init__(self, timeout=1800):
+        self.timeout = timeout
+        self.poll_interval = min(timeout / 4, 60)
+        self.locks = dict()     # lock path -> CaseLock held by this worker
+        self._mutex = threading.Lock()
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True)
+        self._heartbeat.start()
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.timeout / 4)
+            with self._mutex:
+                for lock_path, lock in self.locks.items():
+                    if not lock.touch():    # should not happen unless someone deleted it by hand
+                        print(f"\033[31mlock {lock_path} is not held by this worker anymore\033[0m")
+
+    def claim(self, lock_paths, max_claims, is_done=None):
+        """Claim up to `max_claims` free lock paths, in order. `is_done(path)` skips finished cases."""
+        claimed = []
+        for lock_path in lock_paths:
+            if len(claimed) == max_claims:
+                break
+            if lock_path in self.locks or (is_done is not None and is_done(lock_path)):
+                continue
+            lock = CaseLock(lock_path, self.timeout)
+            if not lock.acquire():
+                continue
+            if is_done is not None and is_done(lock_path):  # finished while we were looking
+                lock.release()
+                continue
+            with self._mutex:
+                self.locks[lock_path] = lock
+            claimed.append(lock_path)
+        return claimed
+
+    def pending(self, lock_paths, is_done):
+        """Lock paths of the unfinished cases that other workers hold (alive or crashed) or nobody claimed yet."""
+        return [lock_path for lock_path in lock_paths if lock_path not in self.locks and not is_done(lock_path)]
+
+    def release(self, lock_paths):
+        with self._mutex:
+            for lock_path in lock_paths:
+                self.locks.pop(lock_path).release()